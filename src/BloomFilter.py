@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import functools
+import hashlib
+import math
+import struct
+
+# Largest number of keys times hash functions of a filter for which 
+# optimalSize checks the exact false positive rate
+exactSizeLimit = 256
+
+# Returns the expected false positive rate of a filter of nBits bits and
+# nHashes hash functions holding nKeys keys. Computed exactly from the 
+# distribution of the number of bits set, so it takes O(nKeys * nHashes *
+# nBits) time
+def falsePositiveRate(nBits, nHashes, nKeys):
+   # setBits[x] is the probability of having x bits set
+   setBits = [ 1.0 ] + [ 0.0 ] * nBits
+   for _ in range(nKeys * nHashes):
+      setBits = [ setBits[x] * x / nBits + 
+                  (setBits[x - 1] * (nBits - x + 1) / nBits if x > 0 else 0)
+                  for x in range(nBits + 1) ]
+   return sum(p * (x / nBits) ** nHashes for x, p in enumerate(setBits))
+
+# Returns the number of bits and hash functions of a Bloom filter holding
+# nKeys keys with a false positive rate of fpRate. The usual formula gives
+# a rate above fpRate for the small filters, so for them the number of bits
+# is increased until the exact rate is low enough
+@functools.lru_cache(maxsize=1024)
+def optimalSize(nKeys, fpRate):
+   nKeys = max(1, nKeys)
+   nBits = math.ceil(-nKeys * math.log(fpRate) / math.log(2) ** 2)
+   nHashes = max(1, round(nBits / nKeys * math.log(2)))
+   if nKeys * nHashes <= exactSizeLimit:
+      while falsePositiveRate(nBits, nHashes, nKeys) > fpRate:
+         nBits += 1
+   return nBits, nHashes
+
+# A Bloom filter: a compact set that can answer "maybe in the set" or "not
+# in the set" for any key. Used by the dead drops to publish which
+# invitation tags they have, so clients only fetch the invitations that
+# can be for them.
+#
+# The positions of a key are independent 32 bit indices taken from BLAKE2b
+# digests of the key, 16 from every digest. Double hashing is cheaper, but
+# its positions are far from independent in the small filters (most
+# buckets hold a few invitations), which then get many more false
+# positives than expected. Filters are sent as the number of bits 
+# (4 bytes), the number of hash functions (1 byte) and then the bits.
+class BloomFilter:
+   headerFormat = struct.Struct("!IB")
+   indicesFormat = struct.Struct("!16I")
+
+   def __init__(self, nBits=8, nHashes=1):
+      self.nBits = max(8, nBits)
+      self.nHashes = nHashes
+      self.bits = bytearray((self.nBits + 7) // 8)
+
+   # Returns the positions of the bits of key, a bytes-like object
+   def positions(self, key):
+      positions = []
+      block = 0
+      while len(positions) < self.nHashes:
+         digest = hashlib.blake2b(key, digest_size=self.indicesFormat.size,
+                                  salt=block.to_bytes(16, "big")).digest()
+         positions.extend(index % self.nBits 
+                          for index in self.indicesFormat.unpack(digest))
+         block += 1
+      return positions[:self.nHashes]
+
+   def add(self, key):
+      for position in self.positions(key):
+         self.bits[position >> 3] |= 1 << (position & 7)
+
+   def __contains__(self, key):
+      return all(self.bits[position >> 3] & (1 << (position & 7))
+                 for position in self.positions(key))
+
+   # Size of the filter in bytes, once serialized
+   def __len__(self):
+      return self.headerFormat.size + len(self.bits)
+
+   def __bytes__(self):
+      return self.headerFormat.pack(self.nBits, self.nHashes) + \
+             bytes(self.bits)
+
+   # Reverse the __bytes__ method: given a bytes-like object, load the
+   # filter. Raises ValueError if it isn't a valid filter
+   def loadFromBuffer(self, buffer):
+      view = memoryview(buffer)
+      if len(view) < self.headerFormat.size:
+         raise ValueError("Invalid Bloom filter")
+      nBits, nHashes = self.headerFormat.unpack_from(view)
+      bits = view[self.headerFormat.size:]
+      if len(bits) != (nBits + 7) // 8:
+         raise ValueError("Invalid Bloom filter")
+      self.nBits, self.nHashes = nBits, nHashes
+      self.bits = bytearray(bits)
+
+# Returns a Bloom filter with all the keys, sized for a false positive
+# rate of fpRate
+def createBloomFilter(keys, fpRate):
+   keys = list(keys)
+   bloomFilter = BloomFilter(*optimalSize(len(keys), fpRate))
+   for key in keys:
+      bloomFilter.add(key)
+   return bloomFilter
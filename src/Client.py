@@ -4,13 +4,44 @@ import socket
 import threading
 import time
 import sys
-from message import Message
+from message import Message, RoundBatch
+from Framing import sendFrameBuffers, recvFrame
+from KeyPool import KeyPool
+from BloomFilter import BloomFilter
 import TorzelaUtils as TU
 import queue
+from concurrent.futures import ThreadPoolExecutor
+
+# An onion message built by the client, with everything needed to send it
+# and to decrypt its response
+class PreparedPayload:
+   def __init__(self, roundID, data, partnerPublicKey):
+      # The round the message was built for, the message itself (None if it
+      # is an empty message) and the partner it is sent to
+      self.roundID = roundID
+      self.data = data
+      self.partnerPublicKey = partnerPublicKey
+      
+      # The onion message, the shared secrets of its layers (one per server 
+      # in the chain + the dead drop server), the shared secret with the
+      # partner and the index of the dead drop server
+      self.payload = b""
+      self.layerSecrets = []
+      self.partnerSecret = None
+      self.deadDropServerIndex = 0
 
 class Client:   
+   # Number of dialing rounds whose tag tables are kept
+   keptTagTables = 2
+   
    # Configure the client with the IP and Port of the next server
-   def __init__(self, serverIP, serverPort, localPort, clientId):
+   # keyMode is the key agreement mode used by the network, one of 
+   # TU.keyModes. It must match the mode of the servers
+   # keyPoolSize is the number of ephemeral key pairs generated in advance
+   # If precompute is True, the message of the next round is built while 
+   # the current round is running, so it's ready to be sent when it starts
+   def __init__(self, serverIP, serverPort, localPort, clientId, 
+                keyMode=TU.classicMode, keyPoolSize=16, precompute=False):
       # serverIP and serverPort is the IP and port of the next
       # server in the chain
       self.serverIP = serverIP
@@ -23,12 +54,20 @@ class Client:
       
       # Queue of messages that will be sent to the Front Server, one per round
       self.messagesQueue = queue.Queue()
+      
+      # Public keys of the clients we want to dial. One of them is dialed in
+      # every dialing round
+      self.dialQueue = queue.Queue()
   
       # Will be used to create multiple key when sending each message
-      self.keyGenerator = TU.createKeyGenerator()
+      self.keyGenerator = TU.createKeyGenerator(keyMode)
    
       # Create the client keys
       self.__privateKey, self.publicKey = TU.generateKeys(self.keyGenerator)
+      
+      # The ephemeral keys of every message are taken from this pool, which
+      # is refilled in the background between rounds
+      self.keyPool = KeyPool(self.keyGenerator, keyPoolSize)
 
       # We need to spawn off a thread here, else we will block the
       # entire program (i.e. if we create the client then the server
@@ -40,8 +79,29 @@ class Client:
       # TODO: We get to know this key through the Dialing Protocol
       self.partnerPublicKey = ""
       
-      # Temporary keys. They are computed for each sent message.
-      self.temporaryKeys = []
+      # The PreparedPayload of the last sent message. Its shared secrets 
+      # are kept so that the response can be decrypted without doing the
+      # key exchanges again
+      self.sentPayload = None
+      
+      # Partner key and the shared secret with it. It's only computed again
+      # when the partner changes
+      self.partnerSecret = (None, None)
+      
+      # Contacts of the client, the ones we dialed or that dialed us:
+      # fingerprint of their raw key -> (public key, shared secret)
+      # The shared secret of the long term keys is computed only once
+      self.contacts = {}
+      
+      # Tags of the invitations from our contacts in the last dialing 
+      # rounds: dialRound -> { tag : contact public key }
+      self.tagTables = {}
+      
+      # Precomputation of the next message. precomputedPayload is the future
+      # of the PreparedPayload being built
+      self.precompute = precompute
+      self.precomputeExecutor = ThreadPoolExecutor(max_workers=1)
+      self.precomputedPayload = None
       
       # TODO: All the following values must be obtained from the Front Server
       # For now, set them manually during the test setup
@@ -57,6 +117,10 @@ class Client:
       # The conversational round we are currently in
       self.round = 1
       
+      # The dialing round we are currently in. Invitations are sent and
+      # downloaded for a dialing round, and expire after it
+      self.dialRound = 1
+      
       # The public keys from the n-1 servers in your chain.
       # Index 0 is the Front Server will index n-2 (the last one) is
       # the Spreading Server. These are provided by the Front Server 
@@ -76,21 +140,22 @@ class Client:
       # Connect to the next server to give it our listening port
       # and public key. The server will also be able to tell our ip
       # address just by receiving a connection from us
-      # This is the setup message below that will hold this information
-      setupMsg = Message()
-      setupMsg.setNetInfo(0)
-      serializedKey = TU.serializePublicKey(self.publicKey)
-      setupMsg.setPayload("{}|{}".format(self.localPort, serializedKey))
- 
+      # This is the setup message below that will hold this information.
+      # It ends with the registration tag of our address, which proves we
+      # own the key (see TU.registrationTag). It's keyed with the key of
+      # the Front Server, so we have to wait until we know it
       self.connectionMade = False
       self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
       # While we have not been able to connect to the next server
       # in the chain...
       while not self.connectionMade:
          try:
+            if len(self.chainServersPublicKeys) == 0:
+               raise ConnectionError("Front Server key unknown")
+            
             # Try to connect and send it our setup message
             self.sock.connect((self.serverIP, self.serverPort))
-            self.sock.sendall(str.encode(str(setupMsg)))
+            sendFrameBuffers(self.sock, self.setupMessage().toBuffers())
             self.connectionMade = True
          except:
             # Just keep trying to connect...
@@ -107,108 +172,190 @@ class Client:
 
       # Wait for a round to start, a message will be sent by the Front Server
       while True:
-         self.sock.listen(1) # listen for 1 connection
-         conn, server_addr = self.sock.accept()
-         recvStr = conn.recv(32768).decode("utf-8")
+         msg = self.receiveMessage()
          
-         print("Client {} got {}".format(self.clientId, recvStr))
+         print("Client {} got {}".format(self.clientId, msg))
          
-         msg = Message()
-         msg.loadFromString(recvStr)
          if msg.getNetInfo() != 5:
             print("Client error: waiting for round to start but received" +
                   " a different type of message")
+         self.round = msg.getRoundID()
             
          response = self.sendAndRecvMsg()
-         if response.getPayload() != "":
+         if len(response.getPayload()) > 0:
             print("Client {} received: {}".format(self.clientId,
-                  response.getPayload()))
+                  str(response.getPayload(), "utf-8")))
          else:
             print("Client {} received empty message".format(self.clientId))
             
-   # Returns the dead drop chosen and the dead drop server where it's located.
-   def computeDeadDrop(self, sharedSecret):
+   # Returns the message registering this client in the Front Server, 
+   # through the connection self.sock:
+   #    "<Port>|<Public key>|<Registration tag in hex>"
+   def setupMessage(self):
+      sharedSecret = TU.computeSharedSecret(self.__privateKey,
+                                            self.chainServersPublicKeys[0])
+      address = (self.sock.getsockname()[0], self.localPort)
+      setupMsg = Message()
+      setupMsg.setNetInfo(0)
+      setupMsg.setPayload("{}|{}|{}".format(
+            self.localPort, TU.serializePublicKey(self.publicKey),
+            TU.registrationTag(sharedSecret, address).hex()))
+      return setupMsg
+            
+   # Waits for the next message sent by the Front Server to our listening
+   # socket and returns it. The dialing rounds can start at any moment, so
+   # their messages (netinfo 7) are handled here and never returned
+   def receiveMessage(self):
+      while True:
+         self.sock.listen(1) # listen for 1 connection
+         conn, server_addr = self.sock.accept()
+         msg = Message()
+         msg.loadFromBuffer(recvFrame(conn))
+         conn.close()
+         
+         if msg.getNetInfo() != 7:
+            return msg
+         self.dialRound = msg.getRoundID()
+         self.sendInvitation(self.dialRound)
+            
+   # Returns the dead drop chosen in round roundID and the dead drop server 
+   # where it's located.
+   def computeDeadDrop(self, sharedSecret, roundID):
       aux = int.from_bytes(sharedSecret, 
-                           byteorder=sys.byteorder) * (self.round + 1)
+                           byteorder=sys.byteorder) * (roundID + 1)
       deadDrop = aux % self.nDD
       deadDropServer = deadDrop % self.nDDS
       return deadDrop, deadDropServer
 
-   # Creates a pair (sk, pk) for each server in the chain + the dead drop server.
-   def generateTemporaryKeys(self):
-      self.temporaryKeys = []
-      for _ in range( len(self.chainServersPublicKeys) + 1):
-         self.temporaryKeys.append( TU.generateKeys(self.keyGenerator) )
+   # Returns the shared secret with the partner key ppk
+   def getPartnerSecret(self, ppk):
+      partnerSecretKey, partnerSecret = self.partnerSecret
+      if ppk is not partnerSecretKey:
+         partnerSecret = TU.computeSharedSecret(self.__privateKey, ppk)
+         self.partnerSecret = (ppk, partnerSecret)
+      return partnerSecret
 
    # Applies onion routing to the messages and fits in it all the information
    # needed for the servers. data must be a string with the content of the 
-   # message and round an integer. Returns a string
-   def preparePayload(self, data):
-      self.generateTemporaryKeys()
-
-      ppk = self.partnerPublicKey
-
+   # message, or None if there is nothing to send, and roundID the round the
+   # message will be sent in. Returns a PreparedPayload
+   def buildPayload(self, data, roundID):
+      prepared = PreparedPayload(roundID, data, self.partnerPublicKey)
+      if data is None:
+         data = ""
+      
       # If we are not currently talking to anyone, create a fake message
       # and a fake reciever
-      if self.partnerPublicKey == "":
+      if prepared.partnerPublicKey == "":
          print('Client: Fake Partner')
-         _, ppk = TU.generateKeys(self.keyGenerator)
+         _, ppk = self.keyPool.take()
          data = TU.createRandomMessage(32)
+         sharedSecret = TU.computeSharedSecret(self.__privateKey, ppk)
+      else:
+         sharedSecret = self.getPartnerSecret(prepared.partnerPublicKey)
       
       # Compute the message for your partner   
-      sharedSecret = TU.computeSharedSecret(self.__privateKey, ppk)
-      deadDrop, self.deadDropServerIndex = self.computeDeadDrop(sharedSecret)
+      deadDrop, deadDropServerIndex = self.computeDeadDrop(sharedSecret, 
+                                                           roundID)
       data = TU.encryptMessage(sharedSecret, data)
 
+      prepared.payload, prepared.layerSecrets = self.wrapForDeadDrop(
+            data, deadDrop, deadDropServerIndex)
+      prepared.partnerSecret = sharedSecret
+      prepared.deadDropServerIndex = deadDropServerIndex
+      
+      return prepared
+   
+   # Fits data in a message for the dead drop deadDrop (an integer) in the
+   # dead drop server deadDropServerIndex and applies onion routing. 
+   # Returns the bytes of the message and the shared secrets of its layers
+   # (one per server in the chain + the dead drop server)
+   def wrapForDeadDrop(self, data, deadDrop, deadDropServerIndex):
+      # A pair (sk, pk) for each server in the chain + the dead drop server
+      temporaryKeys = self.keyPool.takeMany(
+            len(self.chainServersPublicKeys) + 1)
+
       # Compute the message for the Dead Drop Server. It includes how to 
       # send it back (the chain) and the dead drop.
       # It has the following form: 
-      # Before encryption: "myChain#deadDrop#data"
-      # After encryption: "deadDropServer#serialized_pk#encrypted_data"
-      data = "{}#{}#{}".format(self.myChain, deadDrop, data.decode("latin_1"))
-      server_pk = self.deadDropServersPublicKeys[self.deadDropServerIndex]
-      local_sk, local_pk = self.temporaryKeys[-1]
-      sharedSecret = TU.computeSharedSecret(local_sk, server_pk)  
-      data = TU.encryptMessage(sharedSecret, data)
-      serialized_local_pk = TU.serializePublicKey(local_pk)
-      data = "{}#{}#{}".format(self.deadDropServerIndex, serialized_local_pk,
-                               data.decode("latin_1"))
+      # Before encryption: "myChain|deadDrop|data"
+      # After encryption: "deadDropServer|raw_pk|encrypted_data"
+      # See the headers in TorzelaUtils
+      data = TU.packDeadDropHeader(self.myChain, deadDrop) + data
+      server_pk = self.deadDropServersPublicKeys[deadDropServerIndex]
+      local_sk, local_pk = temporaryKeys[-1]
+      deadDropSecret = TU.computeSharedSecret(local_sk, server_pk)  
+      data = TU.encryptMessage(deadDropSecret, data)
+      data = TU.deadDropServerFormat.pack(deadDropServerIndex) + \
+             TU.packOnionLayer(local_pk, data)
       
       # Apply onion routing
-      data = TU.applyOnionRouting(self.temporaryKeys[:-1], 
-                                  self.chainServersPublicKeys,
-                                  data)
-      
-      # Appends your public key to the front of the message so the front
-      # server knows where to send it back
-      data = "{}#{}".format(TU.serializePublicKey(self.publicKey), data)
+      data, chainSecrets = TU.applyOnionRouting(temporaryKeys[:-1], 
+                                                self.chainServersPublicKeys,
+                                                data)
       
-      return data
+      # Appends your public key (raw encoded, like the keys of the onion
+      # layers) to the front of the message so the front server knows where 
+      # to send it back
+      return TU.packOnionLayer(self.publicKey, data), \
+             chainSecrets + [ deadDropSecret ]
    
-   # data is a string containing the received message payload. Undo onion 
-   # routing to obtain the decrypted message. Returns a string.
+   # Builds the payload of data for the current round and keeps it as the
+   # sent message, so its response can be decrypted. Returns bytes
+   def preparePayload(self, data):
+      prepared = self.buildPayload(data, self.round)
+      self.setSentPayload(prepared)
+      return prepared.payload
+   
+   # Remember the message sent in this round
+   def setSentPayload(self, prepared):
+      self.sentPayload = prepared
+      self.deadDropServerIndex = prepared.deadDropServerIndex
+   
+   # data is a bytes-like object containing the received message payload. 
+   # Undo onion routing to obtain the decrypted message. Returns bytes.
+   # The secrets are the ones saved when the message was built
    def decryptPayload(self, data):
-      data = data.encode("latin_1")
-      
-      # Undo the onion routing
-      for local_keys, server_pk in zip (self.temporaryKeys[:-1], 
-                                        self.chainServersPublicKeys):
-         local_sk, local_pk = local_keys
-         sharedSecret = TU.computeSharedSecret(local_sk, server_pk)
-         data = TU.decryptMessage(sharedSecret, data).encode("latin_1")
-         
-      # The dead drop encryption layer 
-      local_sk, local_pk = self.temporaryKeys[-1]
-      server_pk = self.deadDropServersPublicKeys[self.deadDropServerIndex]
-      sharedSecret = TU.computeSharedSecret(local_sk, server_pk)
-      data = TU.decryptMessage(sharedSecret, data).encode("latin_1")
+      # Undo the onion routing, the last secret is the dead drop layer
+      for sharedSecret in self.sentPayload.layerSecrets:
+         data = TU.decryptMessage(sharedSecret, data)
          
       # Last layer of encryption includes how your partner encrypted it.
-      sharedSecret = TU.computeSharedSecret(self.__privateKey, 
-                                            self.partnerPublicKey)
-      data = TU.decryptMessage(sharedSecret, data)
+      data = TU.decryptMessage(self.sentPayload.partnerSecret, data)
+      
+      return bytes(data)
+   
+   # Returns the next message of the queue, or None if it's empty
+   def nextMessage(self):
+      try:
+         return self.messagesQueue.get_nowait()
+      except queue.Empty:
+         return None
+   
+   # Run by the precomputation thread. Builds the payload of the next 
+   # message for round roundID
+   def precomputePayload(self, roundID):
+      return self.buildPayload(self.nextMessage(), roundID)
+   
+   # Returns the payload precomputed for the current round, or None if
+   # there is none. If it was built for a different round or partner it's 
+   # built again, with the same message
+   def takePrecomputed(self):
+      if self.precomputedPayload is None:
+         return None
+      prepared = self.precomputedPayload.result()
+      self.precomputedPayload = None
+      
+      if prepared.roundID == self.round and \
+            prepared.partnerPublicKey is self.partnerPublicKey:
+         # An empty message is dropped if a message was queued meanwhile
+         if prepared.data is not None or self.messagesQueue.empty():
+            return prepared
       
-      return data
+      if prepared.data is None:
+         return None
+      print("Client {}: precomputed message is outdated".format(self.clientId))
+      return self.buildPayload(prepared.data, self.round)
    
    # Send and receive a message from Torzela
    # Because we always receive a response, it doesn't
@@ -222,15 +369,16 @@ class Client:
       while not self.connectionMade:
          time.sleep(1)
          
-      # If we don't have messages to send, create a new empty one
-      if self.messagesQueue.qsize() == 0:
-         self.newMessage("")
-      payload = self.messagesQueue.get()
-      msg = Message()
-      msg.setPayload(payload)
+      # Prepare the payload following the conversational protocol, unless
+      # it was already built while the previous round was running
+      prepared = self.takePrecomputed()
+      if prepared is None:
+         prepared = self.buildPayload(self.nextMessage(), self.round)
+      self.setSentPayload(prepared)
       
-      # Prepare the payload following the conversational protocol
-      msg.setPayload( self.preparePayload(msg.getPayload()) )
+      msg = Message()
+      msg.setPayload(prepared.payload)
+      msg.setRoundID(self.round)
       
       # This 1 means we are sending the message towards a dead drop 
       msg.setNetInfo(1)
@@ -240,28 +388,25 @@ class Client:
       tempSock.connect((self.serverIP, self.serverPort))
 
       # Send our message to the server
-      tempSock.sendall(str(msg).encode("utf-8"))
+      sendFrameBuffers(tempSock, msg.toBuffers())
       tempSock.close()
+      
+      # While this round is running, build the message of the next one
+      if self.precompute:
+         self.precomputedPayload = self.precomputeExecutor.submit(
+               self.precomputePayload, self.round + 1)
 
       # Listen for a response
-      self.sock.listen(1)
-      conn, server_addr = self.sock.accept()
-      # All messages are fixed to 32K
-      recvStr = conn.recv(32768).decode("utf-8")
-      conn.close()
-
-      # Convert response to message
-      m = Message()
-      m.loadFromString(recvStr)
+      m = self.receiveMessage()
       
       # Undo onion routing to the payload
-      if self.partnerPublicKey != "": 
+      if prepared.partnerPublicKey != "": 
          try:
             m.setPayload( self.decryptPayload(m.getPayload()) )
          except:
-            m.setPayload("")
+            m.setPayload(b"")
       else:
-         m.setPayload("")
+         m.setPayload(b"")
          
       return m
 
@@ -278,74 +423,189 @@ class Client:
             1. Invitation deaddrop assigned at the beginning of the round
             2. Message Contents = sender's pk, nonce, and MAC encrypted w/ recipient's pk
          2. All Users periodicallally poll their assigned invitation dead drop to checksfor invitations
+      The invitation is sent when the next dialing round starts (see 
+      sendInvitation)
       """
-      # If the initial setup has not gone through,
-      # then just block and wait. We can't send anything
-      # before we know the network is up and working
-      while not self.connectionMade:
-         time.sleep(1)
       print('Client {} dialing'.format(self.clientId))
-      # Connect to next server
-      self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-      self.sock.connect((self.serverIP, self.serverPort))
+      
+      # Set the user to receive the invitation as our partner
+      self.partnerPublicKey = recipient_public_key
+      self.dialQueue.put(recipient_public_key)
 
-      message = Message()
-      message.setPayload("User Invitation")
+   # Sends the next invitation of the dial queue in dialing round 
+   # dialRound, if there is any. Called when the dialing round starts
+   def sendInvitation(self, dialRound):
+      try:
+         recipientPublicKey = self.dialQueue.get_nowait()
+      except queue.Empty:
+         # TODO: Send a cover invitation, so that the dialing rounds don't
+         # tell who is dialing
+         return
 
-      # Set the user to receive the invitation
-      self.partnerPublicKey = recipient_public_key
-      data = self.preparePayload(message.getPayload())
-      message.setPayload(data)
+      message = Message()
+      message.setPayload(self.buildInvitation(recipientPublicKey, dialRound))
+      message.setRoundID(dialRound)
 
       # Send our message to the deaddrop; 3 Indicates we are initiating a conversation via dialing protocol
       message.setNetInfo(3)
-      self.sock.sendall(str(message).encode("utf-8"))
-      self.sock.close()
-
-      return
+      tempSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      tempSock.connect((self.serverIP, self.serverPort))
+      sendFrameBuffers(tempSock, message.toBuffers())
+      tempSock.close()
    
-   def download_invitations(self, invitationDeadDropPort, potential_partner_pks):
-      time.sleep(10)
-      self.invitationDeadDropPort = invitationDeadDropPort
+   # Returns the onion message with an invitation for the client with
+   # public key recipientPublicKey in dialing round dialRound. The dead drop
+   # of the message is the invitation bucket of the recipient (see 
+   # TU.invitationBucket)
+   def buildInvitation(self, recipientPublicKey, dialRound):
+      bucket = TU.invitationBucket(TU.encodePublicKey(recipientPublicKey))
+      tag = self.getInvitationTag(recipientPublicKey, dialRound)
+      invitation = TU.packInvitation(self.keyPool.take(), self.publicKey,
+                                     recipientPublicKey, tag)
+      payload, _ = self.wrapForDeadDrop(invitation, bucket, 
+                                        bucket % self.nDDS)
+      return payload
+   
+   # Adds the client with public key contactPublicKey to our contacts, if
+   # it isn't already. Returns the shared secret with it
+   def addContact(self, contactPublicKey):
+      fingerprint = TU.fingerprintPublicKey(
+            TU.encodePublicKey(contactPublicKey))
+      contact = self.contacts.get(fingerprint)
+      if contact is None:
+         contact = (contactPublicKey, 
+                    TU.computeSharedSecret(self.__privateKey, 
+                                           contactPublicKey))
+         self.contacts[fingerprint] = contact
+         
+         # Keep the tag tables already built up to date
+         for dialRound, tagTable in self.tagTables.items():
+            tagTable[ TU.invitationTag(contact[1], dialRound) ] = \
+                  contactPublicKey
+      return contact[1]
+   
+   # Returns the tag of the invitations between us and the client with 
+   # public key contactPublicKey in dialing round dialRound
+   def getInvitationTag(self, contactPublicKey, dialRound):
+      return TU.invitationTag(self.addContact(contactPublicKey), dialRound)
+   
+   # Returns the tag table of dialRound, which maps the tag of the 
+   # invitations each contact would send us in dialRound to its public key.
+   # It's built from the cached shared secrets the first time it's needed
+   def getTagTable(self, dialRound):
+      tagTable = self.tagTables.get(dialRound)
+      if tagTable is None:
+         tagTable = { TU.invitationTag(sharedSecret, dialRound) : publicKey
+                      for publicKey, sharedSecret in self.contacts.values() }
+         self.tagTables[ dialRound ] = tagTable
+         for oldRound in [ r for r in self.tagTables 
+                           if r <= dialRound - self.keptTagTables ]:
+            del self.tagTables[ oldRound ]
+      return tagTable
+   
+   # Sends a request for invitations of the given type (see the netinfo 6
+   # of Message) for our bucket in dialRound to the invitation dead drop.
+   # tags are appended to the request. Returns the response, which comes 
+   # back in a single frame on the same connection
+   def requestInvitations(self, msgType, dialRound, tags=b""):
+      bucket = TU.invitationBucket(TU.encodePublicKey(self.publicKey))
+      
       dial_message = Message()
       dial_message.setNetInfo(6)
-      dial_message.setPayload("{}|{}".format(self.localPort, TU.serializePublicKey(self.publicKey)))
+      dial_message.setType(msgType)
+      dial_message.setRoundID(dialRound)
+      dial_message.setPayload(TU.invitationRequestFormat.pack(bucket) + tags)
  
-      self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      tempSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
       while True:
          try:
-            self.sock.connect(('localhost', self.invitationDeadDropPort))
-            self.sock.sendall(str.encode(str(dial_message)))
+            tempSock.connect(('localhost', self.invitationDeadDropPort))
             break
-         except:
+         except OSError:
             time.sleep(1)
-
-      self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-      self.sock.bind(('localhost', self.localPort))
-      self.sock.listen(1) # listen for 1 connection
-      conn, server_addr = self.sock.accept()
-      # All messages are fixed to 4K
-      data = conn.recv(32768).decode("utf-8")
-
-      data = data.encode('latin_1')
-
-      m = Message()
-      for potential_partner_pk in potential_partner_pks:
-         try:
-            sharedSecret = TU.computeSharedSecret(self.__privateKey, potential_partner_pk)
-            data = TU.decryptMessage(sharedSecret, data)
-            m.setPayload(data)
-            self.partnerPublicKey = TU.deserializePublicKey(data)
-            print("Client {} received invitation".format(self.clientId))
-         except:
-            pass
-
-      return m
+      sendFrameBuffers(tempSock, dial_message.toBuffers())
+      response = Message()
+      response.loadFromBuffer(recvFrame(tempSock))
+      tempSock.close()
+      return response
+   
+   # Returns the public keys of the clients that sent the invitations. Only
+   # the invitations for us can be read, the rest belong to other clients.
+   # If tagTable is given (see getTagTable), only the invitations with the 
+   # tag of a contact are decrypted, and only if they come from it. The
+   # dialers become contacts, and the first one of them our partner
+   def readInvitations(self, invitations, tagTable=None):
+      dialers = []
+      for invitation in invitations:
+         if tagTable is not None:
+            contact = tagTable.get(bytes(invitation[:TU.invitationTagSize]))
+            if contact is None:
+               continue
+            
+         dialer = TU.unpackInvitation(self.__privateKey, invitation)
+         if dialer is None:
+            continue
+         if tagTable is not None and TU.encodePublicKey(dialer) != \
+               TU.encodePublicKey(contact):
+            continue
+         
+         self.addContact(dialer)
+         dialers.append(dialer)
+      
+      if len(dialers) > 0:
+         print("Client {} received {} invitations".format(self.clientId,
+                                                          len(dialers)))
+         self.partnerPublicKey = dialers[0]
+      return dialers
+   
+   # Downloads the invitations of our bucket in the given dialing round from
+   # the invitation dead drop listening on invitationDeadDropPort. Returns 
+   # the public keys of the clients that dialed us. The first one of them
+   # becomes our partner
+   def download_invitations(self, invitationDeadDropPort, dialRound=None):
+      if dialRound is None:
+         dialRound = self.dialRound
+      self.invitationDeadDropPort = invitationDeadDropPort
+      
+      invitations = RoundBatch()
+      invitations.loadFromMessage(self.requestInvitations(0, dialRound))
+      return self.readInvitations(invitations.getPayloads())
+   
+   # Like download_invitations, but only looks for invitations from our 
+   # contacts. The clients with public keys in contacts are added to them
+   # first. The Bloom filter of the tags of our bucket is downloaded, and
+   # only the invitations whose tag is in our tag table and may be in the
+   # filter are downloaded and decrypted
+   def download_contact_invitations(self, invitationDeadDropPort, 
+                                    contacts=(), dialRound=None):
+      if dialRound is None:
+         dialRound = self.dialRound
+      self.invitationDeadDropPort = invitationDeadDropPort
+      
+      for contact in contacts:
+         self.addContact(contact)
+      tagTable = self.getTagTable(dialRound)
+      
+      tagFilter = BloomFilter()
+      tagFilter.loadFromBuffer(self.requestInvitations(1, dialRound)
+                                   .getPayload())
+      tags = [ tag for tag in tagTable if tag in tagFilter ]
+      if len(tags) == 0:
+         return []
+      
+      invitations = RoundBatch()
+      invitations.loadFromMessage(self.requestInvitations(2, dialRound,
+                                                          b"".join(tags)))
+      return self.readInvitations(invitations.getPayloads(), tagTable)
 
    # Receives a string, adds a new message with the given payload to the
    # queue of messages that will be sent to the Front Server
    def newMessage(self, payload):
       self.messagesQueue.put(payload)
 
+   # Returns the hits and misses of the ephemeral key pool
+   def getKeyPoolStats(self):
+      return self.keyPool.getStats()
+
    def get_private(self):
       return self.__privateKey
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+import TorzelaUtils as TU
+
+# The clients registered in a Front Server. Every client is identified by
+# the fingerprint of its public key (see TU.fingerprintPublicKey), which
+# indexes a dict with the address where the client listens for responses.
+# Registering a client, checking if it exists and finding where to send a
+# response are O(1), no matter how many clients there are.
+class ClientRegistry:
+   def __init__(self):
+      # fingerprint -> (<IP>, <Port>)
+      self.clients = {}
+
+   # Registers the client with public key rawKey (raw encoded, see
+   # TU.encodePublicKey) listening on address (<IP>, <Port>), or moves it
+   # to address if it was already registered. Returns the fingerprint of 
+   # the client. Public keys are public: the caller must check that the 
+   # client owns the key (see TU.registrationTag)
+   def register(self, rawKey, address):
+      fingerprint = TU.fingerprintPublicKey(rawKey)
+      self.clients[fingerprint] = address
+      return fingerprint
+
+   # Returns the address of the client with the given fingerprint, or None
+   # if there is no such client
+   def getAddress(self, fingerprint):
+      return self.clients.get(fingerprint)
+
+   def __contains__(self, fingerprint):
+      return fingerprint in self.clients
+
+   def __len__(self):
+      return len(self.clients)
+
+   # Returns the addresses of all the registered clients
+   def addresses(self):
+      return self.clients.values()
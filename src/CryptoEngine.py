@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import ServerCore
+import TorzelaUtils as TU
+
+# Peels or wraps the onion layers of a whole round at once. The round is
+# split in chunks which are processed in parallel by a pool of processes,
+# so a server uses all the cores instead of one (the GIL doesn't let the
+# threads of a single process run the crypto in parallel).
+#
+# Every worker process gets a copy of the server private key when it
+# starts, only the payloads and the results travel between processes.
+# The processes are started with "spawn", so scripts that create servers
+# must do it under if __name__ == "__main__".
+
+# Private key of the server, set in every worker process by initWorker
+workerPrivateKey = None
+
+def initWorker(serializedPrivateKey, parentPid):
+   global workerPrivateKey
+   workerPrivateKey = TU.deserializePrivateKey(serializedPrivateKey)
+   threading.Thread(target=watchParent, args=(parentPid,), daemon=True).start()
+
+# The workers don't outlive the server: if it is killed, they exit too
+def watchParent(parentPid):
+   while os.getppid() == parentPid:
+      time.sleep(1)
+   os._exit(0)
+
+# Decrypts one layer of each payload, see TU.decryptOnionLayer. The
+# payloads in the results are bytes so they can be sent between processes.
+# The result of a payload that can't be decrypted is None, a single bad 
+# message doesn't stop the rest of the round
+def peelLayers(privateKey, payloads, serverType):
+   results = []
+   for payload in payloads:
+      try:
+         result = TU.decryptOnionLayer(privateKey, payload, serverType)
+         results.append(result[:-1] + (bytes(result[-1]),))
+      except Exception:
+         results.append(None)
+   return results
+
+# Encrypts one layer of each payload with its shared secret
+def wrapLayers(secrets, payloads):
+   return [ TU.encryptOnionLayer(secret, payload)
+            for secret, payload in zip(secrets, payloads) ]
+
+# Run by the worker processes
+def peelChunk(payloads, serverType):
+   return peelLayers(workerPrivateKey, payloads, serverType)
+
+class CryptoEngine:
+   # privateKey is the private key of the server. nWorkers is the number of
+   # processes of the pool, by default one per core. With 0 workers there
+   # is no pool and everything runs in the crypto threads of ServerCore
+   def __init__(self, privateKey, nWorkers=None):
+      self.privateKey = privateKey
+      self.nWorkers = os.cpu_count() if nWorkers is None else nWorkers
+
+      self.pool = None
+      if self.nWorkers > 0:
+         self.pool = ProcessPoolExecutor(
+               max_workers=self.nWorkers,
+               mp_context=multiprocessing.get_context("spawn"),
+               initializer=initWorker,
+               initargs=(TU.serializePrivateKey(privateKey), os.getpid()))
+
+   # Splits the indices [0, n) in at most one chunk per worker. Returns a
+   # list of (start, end)
+   def splitRound(self, n):
+      if n == 0:
+         return []
+      nChunks = max(1, min(self.nWorkers, n))
+      chunkSize = -(-n // nChunks)
+      return [ (start, min(start + chunkSize, n))
+               for start in range(0, n, chunkSize) ]
+
+   # Runs func(*args) in the pool, or in the crypto threads without pool
+   def run(self, func, *args):
+      if self.pool is None:
+         return ServerCore.runCrypto(func, *args)
+      return asyncio.get_running_loop().run_in_executor(self.pool, func,
+                                                        *args)
+
+   # Decrypts one layer of all the payloads of a round. Returns the list of
+   # results of TU.decryptOnionLayer, in the same order as payloads. The
+   # result of the payloads that can't be decrypted is None
+   async def peelRound(self, payloads, serverType):
+      if self.pool is None:
+         return await self.run(peelLayers, self.privateKey, payloads,
+                               serverType)
+
+      chunks = await asyncio.gather(*[
+            self.run(peelChunk, [ bytes(payload)
+                                  for payload in payloads[start:end] ],
+                     serverType)
+            for start, end in self.splitRound(len(payloads)) ])
+      return [ result for chunk in chunks for result in chunk ]
+
+   # Encrypts one layer of all the responses of a round. secrets[i] is the
+   # shared secret of payloads[i]. Returns the list of encrypted payloads
+   async def wrapRound(self, secrets, payloads):
+      if self.pool is None:
+         return await self.run(wrapLayers, secrets, payloads)
+
+      chunks = await asyncio.gather(*[
+            self.run(wrapLayers, secrets[start:end],
+                     [ bytes(payload) for payload in payloads[start:end] ])
+            for start, end in self.splitRound(len(payloads)) ])
+      return [ payload for chunk in chunks for payload in chunk ]
+
+   def shutdown(self):
+      if self.pool is not None:
+         self.pool.shutdown(wait=False)
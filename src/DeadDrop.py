@@ -1,18 +1,39 @@
 #!/usr/bin/env python3
 
-import socket
-import threading
-import time
-from collections import defaultdict
-from message import Message
+import asyncio
+from message import Message, RoundBatch
+from ServerLink import ServerLink
+import ServerCore
+import DeadDropMatcher
+from BloomFilter import createBloomFilter
+from CryptoEngine import CryptoEngine
 import TorzelaUtils as TU
 import sys
 
 
 
 class DeadDrop:
+   # Number of messages of each chunk decrypted before adding them to the
+   # dead drop index
+   chunkSize = 1024
+   
+   # Number of dialing rounds whose invitations can still be downloaded
+   keptDialRounds = 2
+   
+   # Number of closed rounds remembered to answer the parts that arrive 
+   # too late
+   keptClosedRounds = 16
+   
+   # False positive rate of the Bloom filters of invitation tags
+   filterFalsePositiveRate = 0.01
+
     # Set local port to listen on
-   def __init__(self, localPort):
+    # keyMode is the key agreement mode used by the network, one of 
+    # TU.keyModes. cryptoWorkers is the number of processes used for the
+    # crypto, see CryptoEngine. Once a spreading server sends a round, the
+    # others have upstreamTimeout seconds to send theirs
+   def __init__(self, localPort, keyMode=TU.classicMode, cryptoWorkers=None,
+                upstreamTimeout=30):
       self.localPort = localPort
 
       # This will hold the lists of server that have connected
@@ -21,196 +42,386 @@ class DeadDrop:
       # where <IP> is the previous server's IP address and <Port>
       # is the port the previous server is using
       self.previousServers = []
-
-      # This will hold the list of dead drop IDs that each message 
-      # wants to access. The idea here is that if two IDs match,
-      # we'll swap their positions in the clientMessages array
-      # so that the messages are properly exchanged.
-      self.deadDropIDs = []
-
-      # Used for onion routing in the conversational protocol  
-      # The keys and messages will be updated each round
-      self.clientLocalKeys = []
-      self.clientMessages = []
+      
+      # self.previousLinks[i] is the persistent link opened by 
+      # self.previousServers[i]. Responses are sent back through them
+      self.previousLinks = []
+      
+      # Every spreading server is the end of a chain. self.chainLinks maps
+      # the chain number of each one to its link, and self.connectionChains
+      # maps the connections they opened to their chain number
+      self.chainLinks = {}
+      self.connectionChains = {}
+
+      # Used for onion routing in the conversational protocol. Rounds are 
+      # run once all the spreading servers sent their part of the round:
+      # roundID -> DeadDropRound
+      self.pendingRounds = {}
+      self.upstreamTimeout = upstreamTimeout
+      
+      # The last keptClosedRounds rounds that were run, in the order they
+      # were closed: roundID -> chains that sent their part
+      self.closedRounds = {}
 
       # The server keys
       self.__privateKey, self.publicKey = TU.generateKeys(
-         TU.createKeyGenerator())
+         TU.createKeyGenerator(keyMode))
 
-      self.invitations = []
+      # Peels and wraps the onion layers of the rounds in a process pool
+      self.cryptoEngine = CryptoEngine(self.__privateKey, cryptoWorkers)
+
+      # Invitations of the dialing protocol, only the ones of the last 
+      # keptDialRounds dialing rounds are kept:
+      # dialRound -> { bucket : InvitationBucket }
+      self.invitations = {}
 
-      # Setup main listening socket to accept incoming connections
-      threading.Thread(target=self.listen, args=()).start()
+      # Everything runs in the shared event loop
+      self.server = None
+      self.setup = ServerCore.runInLoop(self.listen())
       
    def getPublicKey(self):
       return self.publicKey
 
-   # This is where all messages are handled
-   def listen(self):
-      # Listen for incoming connections
-      listenSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-      listenSock.bind(('localhost', self.localPort))
-      listenSock.listen(10)
-
-      while True:
-         print("Dead Drop awaiting connections")
-         conn, client_addr = listenSock.accept()
-
-         print("Dead Drop accepted connection from " + str(client_addr))
-
-         # Spawn a thread to handle the connection
-         threading.Thread(target=self.handleMsg,
-                           args=(conn, client_addr)).start()
-
-   # This runs in a thread and handles connections from other servers
-   def handleMsg(self, conn, client_addr):
-      # Receive data from previous server
-      clientData = conn.recv(32768).decode("utf-8")
-
-      # Format as message
-      clientMsg = Message()
-      clientMsg.loadFromString(clientData)
-
-      if clientMsg.getNetInfo() != 1:
-         print("Dead Drop Server got " + clientData)
-
+   # Stops the server: it stops listening, and the processes of its
+   # crypto engine exit. Can be called from any thread, returns a 
+   # concurrent.futures.Future
+   def stop(self):
+      return ServerCore.runInLoop(self.shutdown())
+
+   async def shutdown(self):
+      self.setup.cancel()
+      if self.server is not None:
+         self.server.close()
+      self.cryptoEngine.shutdown()
+
+   # Listen for incoming connections. All messages are handled by handleMsg
+   async def listen(self):
+      self.server = await ServerCore.listen(self.localPort, self.handleMsg)
+      print("Dead Drop listening on port {}".format(self.localPort))
+
+   # Handles every message received, both from new connections (links 
+   # opened by spreading servers or clients downloading invitations) and
+   # through the links. It runs as a task in the event loop
+   async def handleMsg(self, clientMsg, connection):
+      if clientMsg.getNetInfo() != 4:
+         print("Dead Drop Server got " + str(clientMsg))
 
       # Check if the packet is for setting up a connection
       if clientMsg.getNetInfo() == 0:
-         # Add previous server's IP and port to our list of clients
-         serverEntry = (client_addr[0], clientMsg.getPayload())
-         if serverEntry not in self.previousServers:
-               self.previousServers.append(serverEntry)
-
-      # Check if the packet is for sending a message
-      elif clientMsg.getNetInfo() == 1:
-         print("Dead Drop Server got a message from Spreading Server")
-         # In here, packets were trying to reach this server
-
-         # First, close the connection. This may seem
-         # weird, but at this point we already have the message
-         # and are going to send the message back to all of the
-         # connected servers anyways
-         conn.close()
-
-         # Onion routing stuff
-         clientLocalKey, clientChain, deadDrop, newPayload = TU.decryptOnionLayer(
-              self.__privateKey, clientMsg.getPayload(), serverType=2)
-         clientMsg.setPayload(newPayload)
-
-         # self.clientLocalKey -> the key used to encrypt the RESPONSE
-         # clientChain -> the SpreadingServer where the RESPONSE should be sent
-         # deadDrop -> the deadDrop this message is accessing
-         # newPayload -> RESPONSE message body
+         # Add previous server's IP and port to our list of clients and
+         # keep the connection as the link with it. If the server is 
+         # reconnecting, reuse its link
+         # The setup message is "<Port>|<Chain>"
+         serverPort, chain = clientMsg.getPayloadString().split("|")
+         chain = int(chain)
+         serverEntry = (connection.getPeerAddress()[0], serverPort)
+         
+         link = None
+         if serverEntry in self.previousServers:
+            link = self.previousLinks[ self.previousServers.index(serverEntry) ]
          
-         # Save the message data
-         self.deadDropIDs.append(deadDrop)
-         self.clientLocalKeys.append(clientLocalKey)
-         self.clientMessages.append(clientMsg)
-
-         if len(self.clientMessages) == self.nMessages:
-            self.runRound()
-    
+         # Each chain has a single spreading server. Another server 
+         # announcing a chain that is still connected is misconfigured 
+         # (two chains with the same chainID), its responses would go to
+         # the wrong chain
+         boundLink = self.chainLinks.get(chain)
+         if boundLink is not None and boundLink is not link and \
+               boundLink.isUp():
+            print("Dead Drop error: chain {} already bound to another spreading server, rejected {}".format(
+                  chain, serverEntry))
+            connection.close()
+            return
+         
+         if link is None:
+            link = ServerLink("Dead Drop", self.handleMsg)
+            self.previousServers.append(serverEntry)
+            self.previousLinks.append(link)
+         link.attach(connection)
+         self.chainLinks[ chain ] = link
+         self.connectionChains[ connection ] = chain
+         connection.onClose = lambda closed: self.chainConnectionLost(link, 
+                                                                      closed)
+
+      # Check if the packet is a whole round of messages or invitations
       elif clientMsg.getNetInfo() == 4: 
-         # In here, we handle the first message sent by the previous server.
-         # It notifies us of a new round and how many messages are coming
+         batch = RoundBatch()
+         batch.loadFromMessage(clientMsg)
+         chain = self.connectionChains.get(connection)
+         if batch.getNetInfo() == 3:
+            print("Dead Drop Server got dialing round {} from Spreading Server {}".format(
+                  batch.getRoundID(), chain))
+            await self.handleDialRound(batch)
+            return
          
-         # TODO -> Add lock to this whole part
-         # TODO -> make this per spreading server with a dict
+         print("Dead Drop Server got round {} from Spreading Server {}".format(
+               batch.getRoundID(), chain))
+         if chain is None:
+            print("Dead Drop error: round from an unknown spreading server")
+            return
          
-         self.nMessages = int(clientMsg.getPayload())
-         self.clientMessages = []
-         self.clientLocalKeys = []
-      
-      elif clientMsg.getNetInfo() == 3:
-         conn.close()
-         # Decrypt Dead Drop Layer
-         self.clientLocalKey, clientChain, deadDrop, invitation = TU.decryptOnionLayer(
-            self.__privateKey, clientMsg.getPayload(), serverType=2)
-
-         # Add message to list of invitations
-         self.invitations.append(invitation)
-         return
+         await self.handleRound(chain, batch)
 
       elif clientMsg.getNetInfo() == 6:
-         if not self.invitations:
+         # Answer through the connection the client opened, in a single 
+         # frame. The type of the message says what the client wants, see
+         # the netinfo 6 of Message
+         dialRound = clientMsg.getRoundID()
+         payload = clientMsg.getPayload()
+         bucket, = TU.invitationRequestFormat.unpack_from(payload)
+         invitationBucket = self.invitations.get(dialRound, {}).get(
+               bucket, InvitationBucket())
+         
+         if clientMsg.getType() == 1:
+            msg = Message()
+            msg.setNetInfo(6)
+            msg.setType(1)
+            msg.setRoundID(dialRound)
+            msg.setPayload(bytes(invitationBucket.getFilter(
+                  self.filterFalsePositiveRate)))
+            connection.send(msg)
             return
-
-         clientPort, clientPublicKey = clientMsg.getPayload().split("|")
-         clientPublicKey = TU.deserializePublicKey(clientPublicKey)
-
-         for invitation in self.invitations:
-            tempSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            tempSock.connect(('localhost', int(clientPort)))
-            data = str(invitation).encode("utf-8")
-            tempSock.sendall(data)
-            tempSock.close()
-         return
          
-   # This method matches the messages accessing equal dead drops and
-   # sends the responses back to the spreading servers
-   def runRound(self):
-      
-      # The following code computes the matches between different clients
-      # It creats a dictionary of dead drop IDs, linking each ID with their
-      # index of occurence in self.deadDropIDs
-
-      # If a dead drop ID has two indices, then we swap the values at those
-      # indexes in order to exchange messages
-
-      # If a dead drop ID has only one index, then we change that value at
-      # that index in the messages list to ""
-      
-      defaultList = defaultdict(list)
-
-      for index, element in enumerate(self.deadDropIDs):
-	      defaultList[element].append(index)
-
-      # Create two separate dictionaries, one for IDs which only appeared
-      # once and one for IDs which appeared twice
-      uniqueIDs = { k : v for k,v in defaultList.items() if len(v) == 1}
-      dupIDs = { k : v for k,v in defaultList.items() if len(v) == 2}
-
-      # Return an empty message to clients who received no response
-      for id, indices in uniqueIDs.items():
-         m = Message()
-         m.setPayload("")
-         self.clientMessages[indices[0]] = m
-
-      # Return the swapped messages for clients who are connected to the
-      # same dead drop
-      for id, indices in dupIDs.items():
-	      temp = self.clientMessages[indices[0]]
-	      self.clientMessages[indices[0]] = self.clientMessages[indices[1]]
-	      self.clientMessages[indices[1]] = temp
-
-      
-      # Encrypt all the messages before sending them back
-      for msg, clientLocalKey in zip(self.clientMessages, 
-                                     self.clientLocalKeys):
-         newPayload = TU.encryptOnionLayer(self.__privateKey, 
-                                           clientLocalKey, 
-                                           msg.getPayload())
-         msg.setPayload(newPayload)
+         invitations = invitationBucket.invitations
+         if clientMsg.getType() == 2:
+            tags = memoryview(payload)[TU.invitationRequestFormat.size:]
+            invitations = invitationBucket.match(
+                  [ bytes(tags[start : start + TU.invitationTagSize]) 
+                    for start in range(0, len(tags), TU.invitationTagSize) ])
+         connection.sendBuffers(RoundBatch(6, dialRound, 
+                                           invitations).toBuffers())
+      
+   # Called when the connection of a chain link is closed, either because
+   # it broke or because the link was attached to a new one
+   def chainConnectionLost(self, link, connection):
+      self.connectionChains.pop(connection, None)
+      link.connectionLost(connection)
+      
+      # The rounds that were only waiting for this chain can run now
+      for roundID, deadDropRound in list(self.pendingRounds.items()):
+         if self.isComplete(deadDropRound):
+            asyncio.get_running_loop().create_task(self.runRound(roundID))
+   
+   # Returns True once every chain whose link is up sent all its part of 
+   # the round. The chains whose spreading server went away are not 
+   # waited for, their messages can't be answered anyway
+   def isComplete(self, deadDropRound):
+      return all(deadDropRound.chains.get(chain, False) 
+                 for chain, link in self.chainLinks.items() if link.isUp()) \
+             and all(deadDropRound.chains.values())
+      
+   # In here, the invitations of a dialing round for this server arrive in
+   # a single batch. They are decrypted together and stored in the bucket
+   # of their recipient. The dead drop of an invitation is its bucket
+   async def handleDialRound(self, batch):
+      dialRound = batch.getRoundID()
+      results = await self.cryptoEngine.peelRound(batch.getPayloads(), 2)
+      nFailed = results.count(None)
+      if nFailed > 0:
+         print("Dead Drop error: couldn't decrypt {} invitations".format(
+               nFailed))
+      
+      unknown = 0
+      for _, _, deadDrop, invitation in filter(None, results):
+         bucket = int.from_bytes(deadDrop, "big")
+         if bucket >= TU.nInvitationBuckets:
+            unknown += 1
+            continue
+         self.storeInvitation(dialRound, bucket, invitation)
+      if unknown > 0:
+         print("Dead Drop error: {} invitations for unknown buckets".format(
+               unknown))
+      
+   # Stores the invitation for the given bucket and dialing round. The 
+   # invitations of the dialing rounds that are too old are removed
+   def storeInvitation(self, dialRound, bucket, invitation):
+      newestRound = max(self.invitations, default=dialRound)
+      if dialRound <= newestRound - self.keptDialRounds:
+         print("Dead Drop error: invitation for expired dialing round {}".format(
+               dialRound))
+         return
+      
+      buckets = self.invitations.setdefault(dialRound, {})
+      buckets.setdefault(bucket, InvitationBucket()).add(bytes(invitation))
+      for expiredRound in [ r for r in self.invitations 
+                            if r <= dialRound - self.keptDialRounds ]:
+         del self.invitations[ expiredRound ]
          
-         # We need to set this to 2 so that the other servers
-         # in the chain know to send this back to the client
-         msg.setNetInfo(2)
+   # In here, the part of a round sent by the spreading server of chain
+   # reaches this server. It is decrypted in chunks and every message is
+   # added to the dead drop index of the round as soon as its chunk is 
+   # ready. The round runs once every connected spreading server sent its
+   # part (see isComplete)
+   async def handleRound(self, chain, batch):
+      roundID = batch.getRoundID()
+      
+      # The round was already closed, by the timeout or because it was 
+      # complete, while this part was on its way. Its messages can't be
+      # matched anymore, answer them with empty responses so the chain
+      # doesn't lose the round
+      closedChains = self.closedRounds.get(roundID)
+      if closedChains is not None:
+         if chain in closedChains:
+            print("Dead Drop error: chain {} already sent round {}".format(
+                  chain, roundID))
+            return
+         print("Dead Drop error: chain {} sent round {} too late".format(
+               chain, roundID))
+         slots = batch.getSlots()
+         self.chainLinks[ chain ].sendBatch(RoundBatch(2, roundID, 
+               [ b"" ] * len(slots), slots))
+         return
+      
+      deadDropRound = self.pendingRounds.get(roundID)
+      if deadDropRound is None:
+         deadDropRound = DeadDropRound()
+         self.pendingRounds[ roundID ] = deadDropRound
          
+         # Don't wait forever for the spreading servers that don't send it
+         loop = asyncio.get_running_loop()
+         loop.call_later(self.upstreamTimeout, 
+                         lambda: loop.create_task(self.runRound(roundID)))
+      if chain in deadDropRound.chains:
+         print("Dead Drop error: chain {} already sent round {}".format(
+               chain, roundID))
+         return
+      deadDropRound.chains[ chain ] = False
       
-      # Send message back to all spreading servers
-      for prevServer in self.previousServers:
-         prevServerIP = prevServer[0]
-         prevServerPort = int(prevServer[1])
-         for msg in self.clientMessages:
-            tempSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            tempSock.connect((prevServerIP, prevServerPort))
-            tempSock.sendall(str(msg).encode("utf-8"))
-            tempSock.close()
+      # Onion routing stuff, done in the crypto engine. The round can't be
+      # closed until the chunks being peeled are added
+      payloads = batch.getPayloads()
+      slots = batch.getSlots()
+      async def peelChunk(start, end):
+         results = await self.cryptoEngine.peelRound(payloads[start:end], 2)
+         deadDropRound.add(chain, slots[start:end], results)
+      peeling = asyncio.gather(*[ peelChunk(start, start + self.chunkSize) 
+                                  for start in range(0, len(payloads), 
+                                                     self.chunkSize) ])
+      deadDropRound.peels.append(peeling)
+      await peeling
+      deadDropRound.chains[ chain ] = True
+      
+      if self.isComplete(deadDropRound):
+         await self.runRound(roundID)
          
+   # This method fills in the messages of the round with the matches found
+   # by the index and sends the responses back to the spreading servers.
+   # It's called once every chain sent its part, or by the timeout. In 
+   # that case, it waits for the parts that are still being peeled
+   async def runRound(self, roundID):
+      deadDropRound = self.pendingRounds.pop(roundID, None)
+      if deadDropRound is None:
+         return
+      self.closedRounds[ roundID ] = deadDropRound.chains
+      if len(self.closedRounds) > self.keptClosedRounds:
+         del self.closedRounds[ next(iter(self.closedRounds)) ]
+      await asyncio.gather(*deadDropRound.peels, return_exceptions=True)
+      for chain in self.chainLinks:
+         if chain not in deadDropRound.chains:
+            print("Dead Drop error: chain {} missed round {}".format(
+                  chain, roundID))
       
-      # Restart all the data for the next round. Right now this is duplicated
-      # But I think it will be necesary to do it here for multiple spreading
-      # servers so leaving it here so I remember later
-      self.clientMessages = []
+      # Exchange the messages of the pairs. Clients alone in a dead drop, 
+      # or in a dead drop accessed more than twice, get an empty message
+      # (see DeadDropMatcher)
+      clientMessages = DeadDropMatcher.exchangeMessages(
+            deadDropRound.clientMessages, deadDropRound.index.getPartners())
       
+      # Encrypt all the messages before sending them back. The messages 
+      # that couldn't be decrypted have no secret, their response is empty
+      encrypted = [ i for i, clientSecret in 
+                    enumerate(deadDropRound.clientSecrets) 
+                    if clientSecret is not None ]
+      responses = [ b"" ] * len(clientMessages)
+      wrapped = await self.cryptoEngine.wrapRound(
+            [ deadDropRound.clientSecrets[ i ] for i in encrypted ],
+            [ clientMessages[ i ] for i in encrypted ])
+      for i, response in zip(encrypted, wrapped):
+         responses[ i ] = response
+      
+      # Every response goes back only through the chain in its clientChain,
+      # see DeadDropRound.add
+      chainResponses = { chain : ([], []) for chain in deadDropRound.chains }
+      for (chain, slot), response in zip(deadDropRound.origins, responses):
+         payloads, slots = chainResponses[ chain ]
+         payloads.append(response)
+         slots.append(slot)
+         
+      # The batches have netinfo 2 so that the other servers in the chain 
+      # know to send this back to the client. Every response carries the 
+      # slot of the message it answers
+      for chain, (payloads, slots) in chainResponses.items():
+         self.chainLinks[ chain ].sendBatch(RoundBatch(2, roundID, payloads,
+                                                       slots))
+
+# The messages of a round received by a dead drop from all the chains. 
+# Position i-th of each array holds the data of the i-th message added:
+#    (chain, slot) it came from ; secret ; message -- respectively
+# and the dead drop it accesses is access i of the index. self.chains maps
+# every chain that sent its part to True once all of it was added, and 
+# self.peels holds the futures of the parts being peeled
+class DeadDropRound:
+   def __init__(self):
+      self.peels = []
+      self.chains = {}
+      self.origins = []
+      self.clientSecrets = []
+      self.clientMessages = []
+      self.index = DeadDropMatcher.DeadDropIndex()
+
+   # Adds the messages with the given slots from chain. Each result is 
+   # (clientSecret, clientChain, deadDrop, newPayload)
+   # clientSecret -> the shared secret used to encrypt the RESPONSE
+   # clientChain -> the SpreadingServer where the RESPONSE should be sent
+   # deadDrop -> the deadDrop this message is accessing (16 bytes)
+   # newPayload -> RESPONSE message body
+   # The result of a message that couldn't be decrypted is None, it gets
+   # an empty response that isn't encrypted
+   def add(self, chain, slots, results):
+      deadDrops = []
+      for slot, result in zip(slots, results):
+         if result is None:
+            print("Dead Drop error: couldn't decrypt message from chain {}".format(
+                  chain))
+            result = (None, chain, None, b"")
+         clientSecret, clientChain, deadDrop, newPayload = result
+         # The slot was given by the spreading server the message came 
+         # from, so a message naming another chain is answered through 
+         # its own chain with an empty response
+         if clientChain != chain:
+            print("Dead Drop error: message from chain {} for chain {}".format(
+                  chain, clientChain))
+            deadDrop, newPayload = None, b""
+         
+         self.origins.append((chain, slot))
+         self.clientSecrets.append(clientSecret)
+         self.clientMessages.append(newPayload)
+         deadDrops.append(deadDrop)
+      self.index.addChunk(deadDrops)
+
+# The invitations of a bucket in a dialing round. They are also indexed by
+# their tag, and the Bloom filter of the tags is built when a client asks
+# for it and kept until a new invitation arrives
+class InvitationBucket:
+   def __init__(self):
+      self.invitations = []
+      self.tags = {}
+      self.filter = None
+
+   def __len__(self):
+      return len(self.invitations)
+
+   def add(self, invitation):
+      tag = invitation[:TU.invitationTagSize]
+      self.invitations.append(invitation)
+      self.tags.setdefault(tag, []).append(invitation)
+      self.filter = None
+
+   def getFilter(self, fpRate):
+      if self.filter is None:
+         self.filter = createBloomFilter(self.tags, fpRate)
+      return self.filter
+
+   # Returns the invitations with any of the given tags
+   def match(self, tags):
+      return [ invitation for tag in tags 
+               for invitation in self.tags.get(tag, []) ]
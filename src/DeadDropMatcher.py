@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+# Matches the messages of a round that access the same dead drop. The dead
+# drop IDs (16 bytes each, see TU.deadDropFormat) are kept in a contiguous
+# array of n rows of two big endian uint64, sorted once, and the result is
+# an array of partners which exchanges all the messages in a single pass:
+#   partners[i] = j  -> message i gets the message j
+#   partners[i] = n  -> message i gets an empty response
+# Nothing is allocated per message apart from the final list of responses.
+#
+# Policy: a dead drop is for two clients. If it is accessed once, the
+# client gets an empty response. If it is accessed more than twice (a
+# collision or someone guessing dead drops), nobody gets a message through
+# it: all the clients accessing it get an empty response.
+
+# Width of a dead drop ID in bytes
+deadDropSize = 16
+
+# Returns the dead drop IDs as an array of shape (n, 2). deadDropIDs is a
+# list of the 16 bytes IDs
+def deadDropArray(deadDropIDs):
+   return np.frombuffer(b"".join(deadDropIDs),
+                        dtype=">u8").reshape(-1, 2)
+
+# Returns the array of partners of the messages accessing deadDropIDs, as
+# described above. deadDropIDs is a list of 16 bytes IDs or an array
+# returned by deadDropArray
+def matchDeadDrops(deadDropIDs):
+   ids = deadDropIDs if isinstance(deadDropIDs, np.ndarray) else \
+         deadDropArray(deadDropIDs)
+   n = len(ids)
+   partners = np.full(n, n, dtype=np.int64)
+   if n < 2:
+      return partners
+
+   # Sort the IDs, equal ones end up next to each other. lexsort sorts by
+   # the last key first
+   order = np.lexsort((ids[:, 1], ids[:, 0]))
+   sortedIDs = ids[order]
+
+   # Find the runs of equal IDs and keep the ones of length 2
+   newRun = np.empty(n, dtype=bool)
+   newRun[0] = True
+   np.any(sortedIDs[1:] != sortedIDs[:-1], axis=1, out=newRun[1:])
+   starts = np.flatnonzero(newRun)
+   lengths = np.diff(np.append(starts, n))
+   pairs = starts[lengths == 2]
+
+   first = order[pairs]
+   second = order[pairs + 1]
+   partners[first] = second
+   partners[second] = first
+   return partners
+
+# Exchanges the messages according to partners. Returns the list of
+# responses, responses[i] is the message for the client who sent messages[i]
+def exchangeMessages(messages, partners):
+   messages = list(messages) + [ b"" ]
+   return [ messages[partner] for partner in partners.tolist() ]
+
+# Matches the dead drop accesses of a round while they arrive, chunk by
+# chunk, so closing the round only has to fill the unmatched slots. Every
+# dead drop seen is kept in an open addressing table of numpy arrays keyed
+# by the two uint64 halves of its ID. The IDs are random, so the low half
+# is used as the hash. For each dead drop the table holds the first access
+# and the number of accesses (capped at 3):
+#    second access -> the pair is resolved
+#    third access  -> the pair is undone, the dead drop is contested
+# which is the policy of matchDeadDrops. Accesses without a dead drop never
+# match, they always get an empty response.
+class DeadDropIndex:
+   # Initial number of slots of the table, always a power of 2. The table
+   # doubles when it gets half full
+   initialCapacity = 2048
+   
+   def __init__(self):
+      self.nAccesses = 0
+      self.nDeadDrops = 0
+      
+      # partners[i] is the partner of access i, -1 while it has none
+      self.partners = np.empty(self.initialCapacity, dtype=np.int64)
+      self.createTable(self.initialCapacity)
+
+   def __len__(self):
+      return self.nAccesses
+
+   def createTable(self, capacity):
+      self.used = np.zeros(capacity, dtype=bool)
+      self.high = np.zeros(capacity, dtype=np.uint64)
+      self.low = np.zeros(capacity, dtype=np.uint64)
+      self.first = np.zeros(capacity, dtype=np.int64)
+      self.count = np.zeros(capacity, dtype=np.uint8)
+
+   # Returns the slots of the table holding the dead drops (high, low), 
+   # which must all be different. The ones that aren't in the table are 
+   # inserted with no accesses. Colliding dead drops move to the next slot,
+   # and when several want the same free slot only one of them gets it
+   def findSlots(self, high, low):
+      mask = len(self.used) - 1
+      slots = (low & np.uint64(mask)).astype(np.int64)
+      pending = np.arange(len(high))
+      while len(pending) > 0:
+         s = slots[ pending ]
+         used = self.used[ s ]
+         found = used & (self.high[ s ] == high[ pending ]) & \
+                 (self.low[ s ] == low[ pending ])
+         
+         free = np.flatnonzero(~used)
+         freeSlots, winners = np.unique(s[ free ], return_index=True)
+         winners = free[ winners ]
+         keys = pending[ winners ]
+         self.used[ freeSlots ] = True
+         self.high[ freeSlots ] = high[ keys ]
+         self.low[ freeSlots ] = low[ keys ]
+         self.count[ freeSlots ] = 0
+         self.nDeadDrops += len(freeSlots)
+         
+         # The losers try the same slot again, it has another dead drop now
+         collided = used & ~found
+         slots[ pending[ collided ] ] = (s[ collided ] + 1) & mask
+         found[ winners ] = True
+         pending = pending[ ~found ]
+      return slots
+   
+   # Doubles the table until it can hold nDeadDrops more dead drops
+   def reserve(self, nDeadDrops):
+      capacity = len(self.used)
+      while 2 * (self.nDeadDrops + nDeadDrops) > capacity:
+         capacity *= 2
+      if capacity == len(self.used):
+         return
+      
+      old = np.flatnonzero(self.used)
+      high, low = self.high[ old ], self.low[ old ]
+      first, count = self.first[ old ], self.count[ old ]
+      self.createTable(capacity)
+      self.nDeadDrops = 0
+      slots = self.findSlots(high, low)
+      self.first[ slots ] = first
+      self.count[ slots ] = count
+      
+   # Adds the next accesses, deadDrops is a list of 16 bytes IDs or None 
+   # for the accesses without dead drop. The pairs they complete are 
+   # resolved right away. Returns the index of the first one
+   def addChunk(self, deadDrops):
+      start, m = self.nAccesses, len(deadDrops)
+      self.nAccesses += m
+      if self.nAccesses > len(self.partners):
+         self.partners = np.resize(self.partners, 
+                                   max(self.nAccesses, 2 * len(self.partners)))
+      self.partners[ start : self.nAccesses ] = -1
+      
+      noDeadDrop = bytes(deadDropSize)
+      ids = deadDropArray([ noDeadDrop if deadDrop is None else deadDrop
+                            for deadDrop in deadDrops ])
+      accesses = np.flatnonzero([ deadDrop is not None 
+                                  for deadDrop in deadDrops ])
+      if len(accesses) == 0:
+         return start
+      ids = ids[ accesses ].astype(np.uint64)
+      accesses += start
+      
+      # Group the accesses of the chunk to the same dead drop. lexsort is
+      # stable, so the accesses of a dead drop stay in arrival order
+      order = np.lexsort((ids[:, 1], ids[:, 0]))
+      sortedIDs = ids[ order ]
+      newRun = np.empty(len(order), dtype=bool)
+      newRun[0] = True
+      np.any(sortedIDs[1:] != sortedIDs[:-1], axis=1, out=newRun[1:])
+      runs = np.flatnonzero(newRun)
+      lengths = np.diff(np.append(runs, len(order)))
+      firstAccess = accesses[ order[ runs ] ]
+      secondAccess = accesses[ order[ np.minimum(runs + 1, len(order) - 1) ] ]
+      
+      self.reserve(len(runs))
+      slots = self.findSlots(sortedIDs[ runs, 0 ], sortedIDs[ runs, 1 ])
+      previous = self.count[ slots ].astype(np.int64)
+      previousFirst = self.first[ slots ]
+      total = previous + lengths
+      
+      # A third access undoes the pair, which always has the first access
+      undone = previousFirst[ (previous == 2) & (total > 2) ]
+      self.partners[ self.partners[ undone ] ] = -1
+      self.partners[ undone ] = -1
+      
+      # The second access completes the pair, within the chunk or with the
+      # first access of an earlier one
+      paired = (total == 2) & (previous == 0)
+      self.partners[ firstAccess[ paired ] ] = secondAccess[ paired ]
+      self.partners[ secondAccess[ paired ] ] = firstAccess[ paired ]
+      paired = (total == 2) & (previous == 1)
+      self.partners[ previousFirst[ paired ] ] = firstAccess[ paired ]
+      self.partners[ firstAccess[ paired ] ] = previousFirst[ paired ]
+      
+      new = previous == 0
+      self.first[ slots[ new ] ] = firstAccess[ new ]
+      self.count[ slots ] = np.minimum(total, 3)
+      return start
+
+   # Returns the partners of all the accesses added, in the same format as
+   # matchDeadDrops
+   def getPartners(self):
+      n = self.nAccesses
+      partners = self.partners[:n]
+      return np.where(partners < 0, n, partners)
+
+# Checks the matching policy and that a DeadDropIndex gives the same 
+# partners as matchDeadDrops for random rounds
+def testMatching():
+   import os
+   from random import randrange, choice
+   error = False
+
+   # Dead drops accessed once, twice, three and four times
+   a, b, c, d = [ os.urandom(deadDropSize) for _ in range(4) ]
+   accesses = [ a, b, c, b, d, c, d, c, d, d ]
+   partners = matchDeadDrops(accesses).tolist()
+   n = len(accesses)
+   if partners != [ n, 3, n, 1, n, n, n, n, n, n ]:
+      print("FAILURE: matching policy. Partners: {}".format(partners))
+      error = True
+
+   for _ in range(1000):
+      deadDrops = [ os.urandom(deadDropSize) for _ in range(randrange(1, 20)) ]
+      accesses = [ choice(deadDrops + [ None ]) 
+                   for _ in range(randrange(0, 60)) ]
+
+      # Add them in chunks of random sizes, so that pairs and contested 
+      # dead drops span several chunks
+      index = DeadDropIndex()
+      start = 0
+      while start < len(accesses):
+         end = start + randrange(1, 10)
+         index.addChunk(accesses[start:end])
+         start = end
+
+      # The accesses without dead drop get a unique one, so they can't
+      # match anything either
+      expected = matchDeadDrops([ os.urandom(deadDropSize) 
+                                  if deadDrop is None else deadDrop
+                                  for deadDrop in accesses ])
+      if index.getPartners().tolist() != expected.tolist():
+         print("FAILURE: index. Accesses: {}".format(accesses))
+         error = True
+
+   if not error:
+      print("SUCESS")
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+import socket
+import struct
+
+# Every message sent over a socket is wrapped in a frame: a 4 byte big endian
+# length followed by the content of the message. This way the receiver knows
+# exactly where each message ends and several messages can travel over the
+# same connection
+frameHeader = struct.Struct("!I")
+
+# Maximum number of buffers given to a single sendmsg call
+maxBuffersPerSend = 512
+
+# Default maximum size of a frame received, in bytes. It only has to fit the
+# biggest round batch between servers. Ports that only get single client 
+# messages should use a much smaller maximum
+defaultMaxFrameSize = 2**30
+
+# Raised by a FrameReader when a peer announces a frame bigger than the 
+# maximum allowed. The connection can't be read anymore and must be closed
+class FrameTooLargeError(ValueError):
+   pass
+
+# Sends data (an array of bytes) as a single frame
+def sendFrame(sock, data):
+   sendFrameBuffers(sock, [data])
+
+# Sends the concatenation of buffers as a single frame without copying them
+# into a contiguous array first (scatter-gather)
+def sendFrameBuffers(sock, buffers):
+   buffers = [ memoryview(buf).cast("B") for buf in buffers ]
+   length = sum(len(buf) for buf in buffers)
+   buffers.insert(0, memoryview(frameHeader.pack(length)))
+   
+   while buffers:
+      sent = sock.sendmsg(buffers[:maxBuffersPerSend])
+      # Drop everything that was sent. sendmsg may stop in the middle
+      # of a buffer
+      nSent = 0
+      while nSent < len(buffers) and sent >= len(buffers[nSent]):
+         sent -= len(buffers[nSent])
+         nSent += 1
+      del buffers[:nSent]
+      if sent > 0:
+         buffers[0] = buffers[0][sent:]
+
+# Opens a new connection to address, sends a single frame and closes it.
+# Used for the short lived connections between clients and servers
+def sendFrameTo(address, data):
+   sock = socket.create_connection(address)
+   try:
+      sendFrame(sock, data)
+   finally:
+      sock.close()
+
+# Returns the content of the next frame received on sock, or None if the
+# connection was closed. Only meant for connections carrying a single 
+# message, use a FrameReader to read several frames from the same connection.
+# Raises FrameTooLargeError if the frame is bigger than defaultMaxFrameSize
+def recvFrame(sock):
+   frame = FrameReader(sock, bufferSize=4096).readFrame()
+   return None if frame is None else bytes(frame)
+
+# Reads frames from a connection. All the data is received with recv_into
+# in a single buffer which is reused for every frame, and the frames are
+# parsed incrementally as the data arrives, no matter how TCP splits it.
+#
+# Frames bigger than maxFrameSize are refused. The buffer grows only as 
+# the data of a frame actually arrives, doubling each time it is full, so 
+# a length header alone never makes us allocate the size it announces.
+# Frames are returned as memoryviews over the buffer: they are only valid 
+# until the next call to readFrame or nextFrame, copy them if they are 
+# needed for longer.
+class FrameReader:
+   def __init__(self, sock=None, bufferSize=65536, 
+                maxFrameSize=defaultMaxFrameSize):
+      self.sock = sock
+      self.maxFrameSize = maxFrameSize
+      self.buffer = bytearray(bufferSize)
+      self.view = memoryview(self.buffer)
+      
+      # self.buffer[self.start:self.end] holds the data received but not 
+      # consumed yet
+      self.start = 0
+      self.end = 0
+      
+      # Size of the frame we are waiting for, including its header. 0 if
+      # we don't know it yet
+      self.needed = 0
+
+   # Returns the next complete frame received on self.sock, blocking until
+   # it arrives. Returns None if the connection is closed
+   def readFrame(self):
+      frame = self.nextFrame()
+      while frame is None:
+         n = self.sock.recv_into(self.getBuffer())
+         if n == 0:
+            return None
+         self.bufferUpdated(n)
+         frame = self.nextFrame()
+      return frame
+
+   # Returns the next complete frame already in the buffer, or None if more
+   # data is needed. Raises FrameTooLargeError if the next frame is bigger
+   # than self.maxFrameSize
+   def nextFrame(self):
+      available = self.end - self.start
+      if available < frameHeader.size:
+         return None
+      
+      length, = frameHeader.unpack_from(self.buffer, self.start)
+      if length > self.maxFrameSize:
+         raise FrameTooLargeError("Frame of {} bytes, the maximum is {}".format(
+               length, self.maxFrameSize))
+      frameEnd = self.start + frameHeader.size + length
+      if self.end < frameEnd:
+         self.needed = frameHeader.size + length
+         return None
+
+      frame = self.view[self.start + frameHeader.size : frameEnd]
+      self.start = frameEnd
+      self.needed = 0
+      return frame
+
+   # Returns a writable memoryview where the next received bytes should be 
+   # stored. Call bufferUpdated with the number of bytes written
+   def getBuffer(self):
+      pending = self.end - self.start
+      if pending == 0:
+         self.start, self.end = 0, 0
+      
+      if self.end == len(self.buffer):
+         # Move the pending data to the front when we run out of space
+         if self.start > 0:
+            self.view[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+         # The buffer is full of the frame we are waiting for: double it,
+         # but never beyond the size of that frame
+         else:
+            size = max(pending + 1, min(self.needed, 2 * len(self.buffer)))
+            newBuffer = bytearray(size)
+            newBuffer[:pending] = self.view[:pending]
+            self.buffer = newBuffer
+            self.view = memoryview(newBuffer)
+            
+      return self.view[self.end:]
+
+   def bufferUpdated(self, nbytes):
+      self.end += nbytes
+
+# Checks that a stream of frames fed to a FrameReader in chunks of random
+# sizes gives back the same frames, that the buffer only grows with the data
+# received and that a frame bigger than the maximum is refused
+def testFrameReader():
+   import os
+   from random import randrange
+   error = False
+
+   for _ in range(200):
+      frames = [ os.urandom(randrange(0, 5000)) for _ in range(randrange(50)) ]
+      stream = b"".join(frameHeader.pack(len(frame)) + frame 
+                        for frame in frames)
+      reader = FrameReader(bufferSize=randrange(1, 1024))
+      
+      received = []
+      start = 0
+      while start < len(stream):
+         buffer = reader.getBuffer()
+         n = min(len(buffer), randrange(1, 3000), len(stream) - start)
+         buffer[:n] = stream[start:start + n]
+         reader.bufferUpdated(n)
+         start += n
+         
+         frame = reader.nextFrame()
+         while frame is not None:
+            received.append(bytes(frame))
+            frame = reader.nextFrame()
+      
+      if received != frames:
+         print("FAILURE: {} frames, {} received".format(len(frames), 
+                                                        len(received)))
+         error = True
+
+   # A header alone doesn't make the reader allocate the frame it announces
+   reader = FrameReader(bufferSize=1024)
+   buffer = reader.getBuffer()
+   buffer[:frameHeader.size] = frameHeader.pack(10**8)
+   reader.bufferUpdated(frameHeader.size)
+   if reader.nextFrame() is not None or len(reader.getBuffer()) > 1024:
+      print("FAILURE: buffer allocated for a frame that didn't arrive")
+      error = True
+
+   reader = FrameReader(maxFrameSize=1000)
+   buffer = reader.getBuffer()
+   buffer[:frameHeader.size] = frameHeader.pack(1001)
+   reader.bufferUpdated(frameHeader.size)
+   try:
+      reader.nextFrame()
+      print("FAILURE: frame bigger than the maximum accepted")
+      error = True
+   except FrameTooLargeError:
+      pass
+
+   if not error:
+      print("SUCESS")
@@ -1,296 +1,432 @@
 #!/usr/bin/env python3
 
-import socket
-import threading
 import asyncio
-import time
-from message import Message
+import hmac
+from message import Message, RoundBatch
+from ServerLink import ServerLink
+from RoundScheduler import RoundScheduler
+from ClientRegistry import ClientRegistry
+from RoundSlots import RoundSlots
+from RoundIngestor import RoundIngestor
+import ServerCore
+from CryptoEngine import CryptoEngine
 import TorzelaUtils as TU
 
-# Initialize a class specifically for the round info.
-# This class will track if a round is currently ongoing or not, the
-# actual identifying number of the round, the time it ended, and the lock 
-# (so that no other messages are sent during the time of the round)
-class RoundInfo:
-   def __init__(self, newRound, endTime):
-      self.open = True
-      self.round = newRound
-      self.endTime = endTime
-
 class FrontServer:
+   # Maximum number of connections opened at the same time to send messages
+   # to the clients
+   maxClientConnections = 256
+   
+   # Maximum size in bytes of a frame received from a client. Clients only
+   # send single messages (an onion, an invitation or a registration), and
+   # the onion layers add a few hundred bytes to the text of a message
+   maxClientFrameSize = 2**20
+   
+   # Maximum number of client messages handled at once. Once it is reached
+   # because the ingestors are saturated, the Front Server stops reading 
+   # from the clients until some of them are admitted
+   maxClientHandlers = 1024
+   
    # Set the IP and Port of the next server. Also set the listening port
    # for incoming connections. The next server in the chain can
    # be a Middle Server or even a Spreading Server
-   def __init__(self, nextServerIP, nextServerPort, localPort):
+   # keyMode is the key agreement mode used by the network, one of 
+   # TU.keyModes. cryptoWorkers is the number of processes used for the
+   # crypto, see CryptoEngine
+   # Every round is open for roundWindow seconds, and the next one starts
+   # roundGap seconds after it ends. If the responses of a round don't
+   # arrive in roundTimeout seconds the round is dropped
+   # Dialing rounds are scheduled the same way with dialWindow and dialGap
+   def __init__(self, nextServerIP, nextServerPort, localPort, 
+                keyMode=TU.classicMode, cryptoWorkers=None, roundWindow=2, 
+                roundGap=10, roundTimeout=60, dialWindow=2, dialGap=10):
       self.nextServerIP = nextServerIP
       self.nextServerPort = nextServerPort
       self.localPort = localPort
 
       # Initialize round variables. This will allow us to track what
       # current round the server is on, in addition to the state that the
-      # previous rounds are in
+      # previous rounds are in (see RoundScheduler)
       self.roundID = 1
-      self.rounds = {}
-      self.lock = asyncio.Lock()
-      self.roundDuration = 2
-      self.currentRound = ""
+      self.currentRound = None
+      self.roundTimeout = roundTimeout
+      self.scheduler = RoundScheduler(self.startRound, self.runRound, 
+                                      roundWindow, roundGap, self.roundID,
+                                      "Round scheduler")
+      self.rounds = self.scheduler.rounds
+      
+      # Dialing rounds run on their own schedule. The invitations of each 
+      # one are collected and forwarded together once it is closed
+      self.dialRoundID = 1
+      self.currentDialRound = None
+      self.dialScheduler = RoundScheduler(self.startDialRound, 
+                                          self.runDialRound, dialWindow, 
+                                          dialGap, self.dialRoundID,
+                                          "Dialing scheduler")
+      
+      # Future of the responses of the round that is running. It's set by
+      # handleMsg when they arrive from the next server
+      self.responses = None
+      
+      # Return path state of the round that is running (see RoundSlots).
+      # The responses are stored in it as they arrive
+      self.roundSlots = None
 
       # This will allow us to associate a client with it's public key
       # So that we can figure out which client should get which packet
-      # Entries are in the form
-      # ((<IP>,<Port>), <Public Key>)     (i.e. (('localhost', 80), "mykey") )
-      # where <IP> is the client's IP address, <Port> is the client's
-      # listening port, and <Public Key> is the client's public key
-      self.clientList = []
+      # Clients are indexed by the fingerprint of their public key and 
+      # mapped to (<IP>, <Port>), where <IP> is the client's IP address and
+      # <Port> is the client's listening port
+      self.clients = ClientRegistry()
+      
+      # Limits the connections opened by sendToClients, which can run for 
+      # a round and a dialing round at the same time
+      self.clientConnections = asyncio.Semaphore(self.maxClientConnections)
 
-      # These arrays hold their information during each round. Position i-th
-      # of each array represents their respective data:
-      #    key ; (ip, port) ; message -- respectively
-      # for the message that arrived the i-th in the current round.
-      self.clientLocalKeys = []
-      self.clientMessages = []
-      self.clientPublicKeys = []
+      # Fingerprints of the clients that already sent a message in the
+      # current round. Each client can only send one
+      self.roundClients = set()
+      
+      # Same for the invitations of the current dialing round
+      self.dialClients = set()
       
-      # The server keys
+      # The server keys. The key mode is also needed to read the client 
+      # keys in front of the messages
+      self.keyMode = keyMode
       self.__privateKey, self.publicKey = TU.generateKeys( 
-            TU.createKeyGenerator() )         
+            TU.createKeyGenerator(keyMode) )
 
-      # We need to spawn off a thread here, else we will block
-      # the entire program
-      threading.Thread(target=self.setupConnection, args=()).start()
- 
-      # Setup main listening socket to accept incoming connections
-      threading.Thread(target=self.listen, args=()).start()
+      # Peels and wraps the onion layers of the rounds in a process pool
+      self.cryptoEngine = CryptoEngine(self.__privateKey, cryptoWorkers)
+      
+      # The messages of the clients are peeled and stored in the round they
+      # belong to by the ingestion pipeline (see RoundIngestor)
+      self.ingestor = RoundIngestor(self.cryptoEngine, 0)
+      self.dialIngestor = RoundIngestor(self.cryptoEngine, 0)
+
+      # Persistent link with the next server. Messages are sent and the
+      # responses received through it during every round
+      self.nextLink = ServerLink("FrontServer", self.handleMsg)
+      self.connectionMade = False
 
-      # Create a new thread to handle the round timings
-      threading.Thread(target=self.manageRounds, args=()).start() 
+      # The network runs in the shared event loop, setupConnection also
+      # starts listening and running rounds once we are connected to the 
+      # next server
+      self.server = None
+      self.setup = ServerCore.runInLoop(self.setupConnection())
 
    def getPublicKey(self):
       return self.publicKey
+
+   # Stops the server: it stops listening and running rounds, and the 
+   # processes of its crypto engine exit. Can be called from any thread,
+   # returns a concurrent.futures.Future
+   def stop(self):
+      return ServerCore.runInLoop(self.shutdown())
+
+   async def shutdown(self):
+      self.setup.cancel()
+      for runner in (self.scheduler, self.dialScheduler, self.ingestor, 
+                     self.dialIngestor):
+         runner.stop()
+      if self.server is not None:
+         self.server.close()
+      self.cryptoEngine.shutdown()
       
-   def setupConnection(self):
+   async def setupConnection(self):
       # Before we can connect to the next server, we need
       # to send a setup message to the next server
       setupMsg = Message()
       setupMsg.setType(0)
       setupMsg.setPayload("{}".format(self.localPort))
 
-      self.connectionMade = False
-      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-      while not self.connectionMade:
-         try:
-            sock.connect((self.nextServerIP, self.nextServerPort))
-            sock.sendall(str.encode(str(setupMsg)))
-            self.connectionMade = True
-         except:
-            # Put a delay here so we don't burn CPU time
-            time.sleep(1)
-      sock.close()
+      # Open the link with the next server. It keeps retrying until the
+      # next server is up
+      await self.nextLink.connect((self.nextServerIP, self.nextServerPort), 
+                                  setupMsg)
+      self.connectionMade = True
       print("FrontServer successfully connected!")
+      
+      await self.listen()
+      
+      # Start the rounds, they are run by the scheduler in the event loop
+      self.ingestor.start()
+      self.dialIngestor.start()
+      self.scheduler.start()
+      self.dialScheduler.start()
 
-
-   # This is where all messages are handled
-   def listen(self):
-      # Wait until we have connected to the next server
-      while not self.connectionMade:
-         time.sleep(1)
-
-      # Listen for incoming connections
-      self.listenSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-      self.listenSock.bind(('localhost', self.localPort))
-      self.listenSock.listen(10) # buffer 10 connections  
-   
-      while True:
-         print("FrontServer awaiting connection")
-         
-         conn, client_addr = self.listenSock.accept()
-         print("FrontServer accepted connection from " + str(client_addr))
-
-         # Spawn a thread to handle the client
-         threading.Thread(target=self.handleMsg, args=(conn, client_addr,)).start()
+   # Listen for incoming connections. All messages are handled by handleMsg
+   async def listen(self):
+      self.server = await ServerCore.listen(
+            self.localPort, self.handleMsg, 
+            maxFrameSize=self.maxClientFrameSize, 
+            maxHandlers=self.maxClientHandlers)
+      print("FrontServer listening on port {}".format(self.localPort))
    
-   # This runs in a thread and handles messages from clients
-   def handleMsg(self, conn, client_addr):
-      # Receive data from client
-      clientData = conn.recv(32768).decode("utf-8")
+   # Handles messages from clients and, through the link, from the next 
+   # server. It runs as a task in the event loop
+   async def handleMsg(self, clientMsg, connection):
+      clientIP = connection.getPeerAddress()[0]
 
-      # Format as message
-      clientMsg = Message()
-      clientMsg.loadFromString(clientData)
-      clientIP = client_addr[0]
-
-      if clientMsg.getNetInfo() != 1 and clientMsg.getNetInfo() != 2:
-         print("FrontServer got " + clientData)
+      if clientMsg.getNetInfo() not in (1, 3, 4):
+         print("FrontServer got " + str(clientMsg))
 
       # Check if the packet is for setting up a connection
       if clientMsg.getNetInfo() == 0:
-         # Add client's public key to our list of clients
-         clientPort, clientPublicKey = clientMsg.getPayload().split("|")
+         # Add client's public key to our list of clients. The message is
+         # "<Port>|<Public key>|<Registration tag in hex>"
+         clientPort, clientPublicKey, tag = \
+               clientMsg.getPayloadString().split("|")
+         clientPublicKey = TU.deserializePublicKey(clientPublicKey)
+         address = (clientIP, int(clientPort))
          
-         # Build the entry for the client. See clientList above
-         # Store the public key as a string
-         clientEntry = ((clientIP, clientPort), clientPublicKey)
-
-         if clientEntry not in self.clientList:
-            self.clientList.append(clientEntry)
-         conn.close()
+         # Only the owner of the key can compute the tag of the address 
+         # (see TU.registrationTag). A client registering again, from 
+         # another port for instance, moves to the new address
+         sharedSecret = await ServerCore.runCrypto(
+               TU.computeSharedSecret, self.__privateKey, clientPublicKey)
+         if not hmac.compare_digest(bytes.fromhex(tag), 
+               TU.registrationTag(sharedSecret, address)):
+            print("Front server error: wrong registration tag, " +
+                  "rejected registration from {}".format(address))
+            return
+         
+         # The client is registered with its public key raw encoded, the 
+         # same way it arrives with every message
+         self.clients.register(TU.encodePublicKey(clientPublicKey), address)
       elif clientMsg.getNetInfo() == 1: 
          print("Front Server received message from client")
          # Process packets coming from a client and headed towards
          # a dead drop only if the current round is active and the client 
-         # hasn't already send a msessage
-         clientPublicKey, payload = clientMsg.getPayload().split("#", 1)
-         if self.currentRound.open and clientPublicKey not in self.clientPublicKeys:
-            
-            # Decrypt one layer of the onion message
-            clientLocalKey, newPayload = TU.decryptOnionLayer(
-                  self.__privateKey, payload, serverType=0)
-            clientMsg.setPayload(newPayload)
+         # is registered and hasn't already send a msessage
+         clientPublicKey, payload = TU.unpackOnionLayer(clientMsg.getPayload(),
+                                                        self.keyMode)
+         fingerprint = TU.fingerprintPublicKey(clientPublicKey)
+         if self.acceptsMessage(clientMsg, fingerprint):
             
-            # Save the message data
-            # TODO (jose) -> use the lock here. Multiple threads could try to 
-            # access this info at the same time. In fact, we should process 
-            # messages with netinfo == 1 ONE AT A TIME or could create inconsistences.
-            self.clientPublicKeys.append(clientPublicKey)
-            self.clientLocalKeys.append(clientLocalKey)
-            self.clientMessages.append(clientMsg)
+            # The ingestor decrypts one layer of the onion message and 
+            # stores it in its round. The client can't send another one
+            self.roundClients.add(fingerprint)
+            await self.ingestor.submit(clientMsg.getRoundID(), fingerprint,
+                                       payload)
          
-      elif clientMsg.getNetInfo() == 2:
-         print("FrontServer received message from Middle server")
-         # TODO -> add a lock here, same as with netinfo == 1
+      elif clientMsg.getNetInfo() == 4:
+         # The responses of the whole round, sent back by the Middle server
+         batch = RoundBatch()
+         batch.loadFromMessage(clientMsg)
+         print("FrontServer received responses from Middle server")
+         roundSlots, responses = self.roundSlots, self.responses
+         if responses is None or responses.done() or \
+               batch.getRoundID() != roundSlots.roundID:
+            print("Front server error: received responses for a different round")
+            return
          
-         # Encrypt one layer of the onion message
-         clientLocalKey = self.clientLocalKeys[ len(self.clientMessages) ] 
-         newPayload = TU.encryptOnionLayer(self.__privateKey, 
-                                           clientLocalKey, 
-                                           clientMsg.getPayload())
-         clientMsg.setPayload(newPayload)
-         self.clientMessages.append(clientMsg)
+         # Encrypt one layer of each onion message. Each response carries 
+         # the slot of the message it answers, which tells the secret to use
+         slots, payloads = roundSlots.selectPending(batch.getSlots(), 
+                                                    batch.getPayloads())
+         newPayloads = await self.cryptoEngine.wrapRound(
+               roundSlots.getSecrets(slots), payloads)
+         
+         # The responses are written in the position of the message they
+         # answer, once all of them arrived the round can be delivered
+         if roundSlots.store(slots, newPayloads) and \
+               roundSlots.isComplete() and not responses.done():
+            responses.set_result(roundSlots.responses)
 
       elif clientMsg.getNetInfo() == 3: 
          # Dialing Protocol: Client -> DeadDrop
-
-         _, newPayload = TU.decryptOnionLayer(
-               self.__privateKey, clientMsg.getPayload(), serverType=0)
-         clientMsg.setPayload(newPayload)
-         
-         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-         sock.connect((self.nextServerIP, self.nextServerPort))
-         sock.sendall(str(clientMsg).encode("utf-8"))
-         sock.close()
+         # Invitations are admitted to the current dialing round the same 
+         # way as messages, one per client. They are forwarded when the 
+         # dialing round closes
+         clientPublicKey, payload = TU.unpackOnionLayer(clientMsg.getPayload(),
+                                                        self.keyMode)
+         fingerprint = TU.fingerprintPublicKey(clientPublicKey)
+         if self.acceptsInvitation(clientMsg, fingerprint):
+            self.dialClients.add(fingerprint)
+            await self.dialIngestor.submit(clientMsg.getRoundID(), 
+                                           fingerprint, payload)
    
-   # A thread running this method will be in charge of the different rounds
-   def manageRounds(self):
-      while True:
-         time.sleep(10)
-         
-         # Reset the saved info about the messages for the round before it starts
-         self.clientLocalKeys = []
-         self.clientIPsAndPorts = []
-         self.clientMessages = []
-         
-         # Create the new round using our class above
-         self.currentRound = RoundInfo(round, self.roundDuration)
-         self.rounds[self.roundID] = self.currentRound
-         print("Front Server starts round: ", self.roundID)
+   # Returns True if the message of a client (whose public key fingerprint
+   # is fingerprint) can be added to the current round: the round is open,
+   # the message belongs to it, the client is registered and it hasn't sent
+   # another message in this round
+   def acceptsMessage(self, clientMsg, fingerprint):
+      return self.currentRound is not None and self.currentRound.open and \
+             clientMsg.getRoundID() == self.currentRound.roundID and \
+             fingerprint in self.clients and \
+             fingerprint not in self.roundClients
+   
+   # Same as acceptsMessage, for the invitations of the dialing rounds
+   def acceptsInvitation(self, clientMsg, fingerprint):
+      return self.currentDialRound is not None and \
+             self.currentDialRound.open and \
+             clientMsg.getRoundID() == self.currentDialRound.roundID and \
+             fingerprint in self.clients and \
+             fingerprint not in self.dialClients
+   
+   # Called by the scheduler when a round starts. Resets the saved info 
+   # about the messages and tells the clients that the round just started
+   async def startRound(self, roundInfo):
+      self.ingestor.openRound(roundInfo.roundID)
+      self.roundClients = set()
+      self.roundID = roundInfo.roundID
+      self.currentRound = roundInfo
+      print("Front Server starts round: ", self.roundID)
+   
+      # Tell all the clients that a new round just started
+      firstMsg = Message()
+      firstMsg.setNetInfo(5)
+      firstMsg.setRoundID(self.roundID)
+      await self.sendToClients([ (address, firstMsg) 
+                                 for address in self.clients.addresses() ])
+   
+   # Sends each message to its client. messages is a list of 
+   # ((<IP>, <Port>), msg). They are sent concurrently, with at most 
+   # maxClientConnections connections open at once
+   async def sendToClients(self, messages):
+      async def sendToClient(address, msg):
+         async with self.clientConnections:
+            await ServerCore.sendMessageTo(address, msg)
       
-         # Tell all the clients that a new round just started
-         firstMsg = Message()
-         firstMsg.setNetInfo(5)
-         for clientIpAndPort, clientPK in self.clientList:
-            tempSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            tempSock.connect((clientIpAndPort[0], int(clientIpAndPort[1])))
-            tempSock.sendall(str.encode(str(firstMsg)))
-            tempSock.close()
-            
-         # Start timer
-         startTime = time.process_time()
+      results = await asyncio.gather(*[ 
+            sendToClient(address, msg) 
+            for address, msg in messages ], return_exceptions=True)
+      for (address, _), result in zip(messages, results):
+         if isinstance(result, Exception):
+            print("Front server error: couldn't send message to client " +
+                  "{}: {!r}".format(address, result))
    
-         # Allow clients to send messages for duration of round
-         # Clients can only send message while self.currentRound.open == True
-         while time.process_time() - startTime < self.roundDuration:
+   # Returns the list of ((<IP>, <Port>), msg) to send each response to its
+   # client. responses[i] is the payload for the client with fingerprint 
+   # clientFingerprints[i]
+   def buildResponses(self, clientFingerprints, responses):
+      messages = []
+      for fingerprint, payload in zip(clientFingerprints, responses):
+         msg = Message()
+         msg.setNetInfo(2)
+         msg.setPayload(payload)
+         # Find the client ip and port using the clients keys
+         address = self.clients.getAddress(fingerprint)
+         if address is None:
+            print("Front server error: couldn't find client where to send the response")            
             continue
-         
-         # Now that round has ended, mark current round as closed
-         self.currentRound.open = False
-         
-         # TODO -> Once the noice addition is added, the rounds should ALWAYS 
-         # run, no matter if there are no messages
-         if len(self.clientMessages) > 0:
-            # Now that all the messages are stored in self.clientMessages,
-            # run the round
-            self.runRound()
-         
-         print("Front Server finished round: ", self.roundID)
-         self.roundID += 1
+         messages.append((address, msg))
+      return messages
    
-   # Runs server round. Assuming that the messages are stores in 
-   # self.clientMessages, adds noise, shuffles them and forwards them to
-   # the next server
-   def runRound(self):
+   # Runs server round, called by the scheduler once the round is closed. 
+   # Takes the messages of the round from the ingestor, adds 
+   # noise, shuffles them and forwards them to the next server. Then waits
+   # for the responses and sends them back to the clients
+   async def runRound(self, roundInfo):
+      
+      # Take the messages of the round from the ingestor, once the ones
+      # still being decrypted are stored. Position i-th of each array 
+      # represents the data of the i-th message stored in the round
+      roundBuffer = await self.ingestor.closeRound(roundInfo.roundID)
+      roundInfo.endPhase("ingest")
+      
+      if roundBuffer is None:
+         print("Front Server finished round: ", self.roundID)
+         return
+      
+      # The clients whose message couldn't be decrypted get an empty 
+      # response, so they don't keep waiting for one
+      if len(roundBuffer.failedKeys) > 0:
+         print("Front server error: couldn't decrypt {} messages".format(
+               len(roundBuffer.failedKeys)))
+         await self.sendToClients(self.buildResponses(
+               roundBuffer.failedKeys, [ b"" ] * len(roundBuffer.failedKeys)))
+      
+      # TODO -> Once the noice addition is added, the rounds should ALWAYS 
+      # run, no matter if there are no messages
+      if len(roundBuffer) == 0:
+         print("Front Server finished round: ", self.roundID)
+         return
+      
+      clientFingerprints = roundBuffer.keys
+      clientSecrets = [ clientSecret for clientSecret, _ in roundBuffer.results ]
+      clientMessages = [ newPayload for _, newPayload in roundBuffer.results ]
       
       # TODO (jose): Noise addition goes here
       
       # Apply the mixnet by shuffling the messages
-      nMessages = len(self.clientMessages)
+      nMessages = len(clientMessages)
       permutation = TU.generatePermutation(nMessages)
-      shuffledMessages = TU.shuffleWithPermutation(self.clientMessages,
+      shuffledMessages = TU.shuffleWithPermutation(clientMessages,
                                                    permutation)
       
-      # Also shuffle the messages so they still match the clientMessages:
-      # self.clientLocalKeys[ i ] is the key that unlocks message self.clientMessges[ i ]
-      # This is used afterwards in handleMessage, getNetInfo() == 2
-      self.clientLocalKeys = TU.shuffleWithPermutation(self.clientLocalKeys,
-                                                         permutation)
-      
-      # Forward all the messages to the next server
-      # Send a message to the next server notifying of the numbers of 
-      # messages that will be sent
-      firstMsg = Message()
-      firstMsg.setNetInfo(4)
-      firstMsg.setPayload("{}".format(nMessages))
-      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-      sock.connect((self.nextServerIP, self.nextServerPort))
-      sock.sendall(str(firstMsg).encode("utf-8"))
-      sock.close()
+      # Preallocate the slots for the responses. The response to the 
+      # message stored i-th is stored in position i, so clientSecrets and
+      # clientFingerprints are not shuffled
+      self.roundSlots = RoundSlots(self.roundID, clientSecrets, 
+                                   range(nMessages), permutation)
       
-      # Send all the messages to the next server
-      for msg in shuffledMessages:
-         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-         sock.connect((self.nextServerIP, self.nextServerPort))
-         sock.sendall(str(msg).encode("utf-8"))
-         sock.close()
+      # The responses come back through the link as soon as the round is 
+      # complete, so the future must exist before sending anything
+      self.responses = asyncio.get_running_loop().create_future()
       
-      # Restart the messages so that we receive the responses from the 
-      # next server
-      self.clientMessages = []
+      # Forward the whole round to the next server in a single batch
+      batch = RoundBatch(1, self.roundID, shuffledMessages)
+      self.nextLink.sendBatch(batch)
+      roundInfo.endPhase("forward")
       
       # Wait until we have received all the responses. These responses are
-      # handled in the main thread using the method handleMsg with 
-      # msg.getNetInfo == 2
+      # handled by handleMsg with msg.getNetInfo == 4, which sets the future
       print("Front Server waiting for responses from Middle Server")
-      while len(self.clientMessages) < nMessages:
-         continue
+      try:
+         responses = await asyncio.wait_for(self.responses, self.roundTimeout)
+      except asyncio.TimeoutError:
+         print("Front server error: no responses for round {}".format(
+               self.roundID))
+         roundInfo.endPhase("timeout")
+         return
+      finally:
+         self.responses = None
+         self.roundSlots = None
+      roundInfo.endPhase("responses")
       
-      # Unshuffle the messages
-      self.clientMessages = TU.unshuffleWithPermutation(self.clientMessages, 
-                                                        permutation)
+      # Send each response back to the correct client. The responses are
+      # already in the order the messages arrived, no need to unshuffle
+      await self.sendToClients(self.buildResponses(clientFingerprints, 
+                                                   responses))
+      roundInfo.endPhase("deliver")
+      print("Front Server finished round: ", self.roundID)
+   
+   # Called by the dialing scheduler when a dialing round starts. Tells the
+   # clients that they can send their invitations
+   async def startDialRound(self, roundInfo):
+      self.dialIngestor.openRound(roundInfo.roundID)
+      self.dialClients = set()
+      self.dialRoundID = roundInfo.roundID
+      self.currentDialRound = roundInfo
+      print("Front Server starts dialing round: ", self.dialRoundID)
       
-      # Send each response back to the correct client
-      for clientPK, msg in zip(self.clientPublicKeys, self.clientMessages):
-         # Find the client ip and port using the clients keys
-         matches = [ (ip, port) for ((ip, port), pk) in self.clientList 
-                     if clientPK == pk]
-         if len(matches) == 0:
-            print("Front server error: couldn't find client where to send the response")            
-            continue
-         elif len(matches) > 1:
-            print("Front server error: too many clients where to send the response")
-            continue
-         clientIP, clientPort = matches[0]
-         clientPort = int(clientPort)
-         
-         tempSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-         tempSock.connect((clientIP, clientPort))
-         tempSock.sendall(str(msg).encode("utf-8"))
-         tempSock.close()
+      firstMsg = Message()
+      firstMsg.setNetInfo(7)
+      firstMsg.setRoundID(self.dialRoundID)
+      await self.sendToClients([ (address, firstMsg) 
+                                 for address in self.clients.addresses() ])
+   
+   # Runs a dialing round, called by the dialing scheduler once it is 
+   # closed. Takes the invitations of the round from the ingestor, shuffles
+   # them and forwards them to the next server in a single batch. 
+   # Invitations have no responses, so the round ends there
+   async def runDialRound(self, roundInfo):
+      roundBuffer = await self.dialIngestor.closeRound(roundInfo.roundID)
+      roundInfo.endPhase("ingest")
+      
+      # TODO -> Cover invitations should be added here, so that the 
+      # dialing rounds always run
+      if roundBuffer is None or len(roundBuffer) == 0:
+         return
+      
+      invitations = [ newPayload for _, newPayload in roundBuffer.results ]
+      permutation = TU.generatePermutation(len(invitations))
+      shuffledInvitations = TU.shuffleWithPermutation(invitations, 
+                                                      permutation)
+      
+      self.nextLink.sendBatch(RoundBatch(3, roundInfo.roundID, 
+                                         shuffledInvitations))
+      roundInfo.endPhase("forward")
+      print("Front Server finished dialing round: ", roundInfo.roundID)
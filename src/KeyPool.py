@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import threading
+import queue
+import TorzelaUtils as TU
+
+# A bounded pool of ephemeral key pairs (sk, pk). A background thread
+# generates key pairs until the pool is full and refills it as soon as keys
+# are taken, so the keys needed for a message are usually ready when the
+# round starts and their generation doesn't delay the submission.
+class KeyPool:
+   # keyGenerator is the one returned by TU.createKeyGenerator and size is
+   # the maximum number of key pairs kept in the pool
+   def __init__(self, keyGenerator, size):
+      self.keyGenerator = keyGenerator
+      self.keys = queue.Queue(maxsize=size)
+
+      # Number of keys that were taken from the pool (hits) and the ones
+      # that had to be generated on the spot because it was empty (misses)
+      self.hits = 0
+      self.misses = 0
+
+      threading.Thread(target=self.fill, args=(), daemon=True).start()
+
+   # Run by the background thread. put blocks while the pool is full
+   def fill(self):
+      while True:
+         self.keys.put(TU.generateKeys(self.keyGenerator))
+
+   # Returns a key pair (sk, pk). If the pool is empty, the key pair is
+   # generated right away instead of waiting for the background thread
+   def take(self):
+      try:
+         keys = self.keys.get_nowait()
+         self.hits += 1
+      except queue.Empty:
+         keys = TU.generateKeys(self.keyGenerator)
+         self.misses += 1
+      return keys
+
+   # Returns n key pairs
+   def takeMany(self, n):
+      return [ self.take() for _ in range(n) ]
+
+   # Number of key pairs ready to be used
+   def available(self):
+      return self.keys.qsize()
+
+   def getStats(self):
+      return { "hits" : self.hits, "misses" : self.misses,
+               "available" : self.available() }
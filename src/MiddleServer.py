@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
 
-import socket
-import threading
-import time
-from message import Message
+from message import Message, RoundBatch
+from ServerLink import ServerLink
+import ServerCore
+from CryptoEngine import CryptoEngine
+from RoundSlots import RoundSlots
 import TorzelaUtils as TU
 
 class MiddleServer:
    # Set the next server's IP and listening port
    # also set listening port for this middle server
-   def __init__(self, nextServerIP, nextServerPort, localPort):
+   # keyMode is the key agreement mode used by the network, one of 
+   # TU.keyModes. cryptoWorkers is the number of processes used for the
+   # crypto, see CryptoEngine
+   def __init__(self, nextServerIP, nextServerPort, localPort, 
+                keyMode=TU.classicMode, cryptoWorkers=None):
       self.nextServerIP = nextServerIP
       self.nextServerPort = nextServerPort
       self.localPort = localPort
@@ -21,202 +26,196 @@ class MiddleServer:
       self.previousServerPort = 0
 
       # Used for onion rotuing in the conversational protocol  
-      # The keys and messages will be updated each round
-      self.clientLocalKeys = []
-      self.clientMessages = []
-      self.nMessages = 0
+      # The return path state of the round (see RoundSlots) is created when
+      # the round is forwarded
+      self.roundSlots = None
+      self.roundID = 0
       
       # The server keys
       self.__privateKey, self.publicKey = TU.generateKeys( 
-            TU.createKeyGenerator() )
+            TU.createKeyGenerator(keyMode) )
+
+      # Peels and wraps the onion layers of the rounds in a process pool
+      self.cryptoEngine = CryptoEngine(self.__privateKey, cryptoWorkers)
+      
+      # Persistent links with both neighbours. The previous server opens
+      # its link with us, we open the one with the next server
+      self.previousLink = ServerLink("MiddleServer", self.handleMsg)
+      self.nextLink = ServerLink("MiddleServer", self.handleMsg)
+      self.connectionMade = False
       
-      # We need to spawn off a thread here, else we will block
-      # the entire program
-      threading.Thread(target=self.setupConnection, args=()).start()
- 
-      # Setup main listening socket to accept incoming connections
-      threading.Thread(target=self.listen, args=()).start()
+      # Everything runs in the shared event loop, setupConnection also
+      # starts listening once we are connected to the next server
+      self.server = None
+      self.setup = ServerCore.runInLoop(self.setupConnection())
       
    def getPublicKey(self):
       return self.publicKey
 
-   def setupConnection(self):
+   # Stops the server: it stops listening, and the processes of its
+   # crypto engine exit. Can be called from any thread, returns a 
+   # concurrent.futures.Future
+   def stop(self):
+      return ServerCore.runInLoop(self.shutdown())
+
+   async def shutdown(self):
+      self.setup.cancel()
+      if self.server is not None:
+         self.server.close()
+      self.cryptoEngine.shutdown()
+
+   async def setupConnection(self):
       # Before we can connect to the next server, we need
       # to send a setup message to the next server
       setupMsg = Message()
       setupMsg.setType(0)
       setupMsg.setPayload("{}".format(self.localPort))
 
-      self.connectionMade = False
-      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-      while not self.connectionMade:
-         try:
-            sock.connect((self.nextServerIP, self.nextServerPort))
-            sock.sendall(str.encode(str(setupMsg)))
-            self.connectionMade = True
-         except:
-            # Put a delay here so we don't burn CPU time
-            time.sleep(1)
-      sock.close()
+      # Open the link with the next server. It keeps retrying until the
+      # next server is up
+      await self.nextLink.connect((self.nextServerIP, self.nextServerPort), 
+                                  setupMsg)
+      self.connectionMade = True
       print("MiddleServer successfully connected!")
+      
+      await self.listen()
 
-
-   # This is where all messages are handled
-   def listen(self):
-      # Wait until we have connected to the next server
-      while not self.connectionMade:
-         time.sleep(1)
-
-      # 1. Bind to localhost. We need to have the sock object
-      #    available to other methods.
-      self.listenSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-      self.listenSock.bind(('localhost', self.localPort))
-      self.listenSock.listen(1)
-   
-      while True:
-         print("MiddleServer awaiting connection")
-         conn, client_addr = self.listenSock.accept()
-
-         print("MiddleServer accepted connection from " + str(client_addr))
-
-         # Spawn a thread to handle the client
-         threading.Thread(target=self.handleMsg, args=(conn, client_addr,)).start()
+   # Listen for incoming connections. All messages are handled by handleMsg
+   async def listen(self):
+      self.server = await ServerCore.listen(self.localPort, self.handleMsg)
+      print("MiddleServer listening on port {}".format(self.localPort))
    
-   # This runs in a thread and handles messages from clients
-   def handleMsg(self, conn, client_addr):
-      # Receive data from client
-      clientData = conn.recv(32768).decode("utf-8")
-
-      # Format as message
-      clientMsg = Message()
-      clientMsg.loadFromString(clientData)
-      
-      if clientMsg.getNetInfo() != 1 and clientMsg.getNetInfo() != 2:
-         print("Middle Server got " + clientData)
+   # Handles every message received, both from new connections and through
+   # the links. It runs as a task in the event loop
+   async def handleMsg(self, clientMsg, connection):
+      if clientMsg.getNetInfo() != 4:
+         print("Middle Server got " + str(clientMsg))
 
       # Check if the packet is for setting up a connection
       if clientMsg.getNetInfo() == 0:
-         # If it is, add the previous server's IP and Port
-         self.previousServerIP = client_addr[0]
-         self.previousServerPort = int(clientMsg.getPayload())
-         conn.close()
-      elif clientMsg.getNetInfo() == 1: 
-         print("Middle Server received message from Front server")
-         # In here, we handle packets being sent towards
-         # the dead drop. There is only one way to send packets
-         
-         # TODO -> Add lock to this whole part
-         
-         if self.nMessages <= len(self.clientMessages):
-            print("Middle server error: received more messages than expected")
-         
-         # Decrypt one layer of the onion message
-         clientLocalKey, newPayload = TU.decryptOnionLayer(
-               self.__privateKey, clientMsg.getPayload(), serverType=0)
-         clientMsg.setPayload(newPayload)
-         
-         # Save the message data
-         self.clientLocalKeys.append(clientLocalKey)
-         self.clientMessages.append(clientMsg)
-         
-         if self.nMessages == len(self.clientMessages):
-            self.forwardMessages()
-         
-      elif clientMsg.getNetInfo() == 2: 
-         print("Middle Server received message from Spreading server")
-         # In here, we are handling messages send back
-         # to the client. There is only one way to send packets
-         
-         if self.nMessages <= len(self.clientMessages):
-            print("Middle server error: received more messages than expected")
+         # If it is, add the previous server's IP and Port and keep the
+         # connection as the link with it
+         self.previousServerIP = connection.getPeerAddress()[0]
+         self.previousServerPort = int(clientMsg.getPayloadString())
+         self.previousLink.attach(connection)
+      elif clientMsg.getNetInfo() == 4: 
+         # In here, we handle a whole round sent by one of our neighbours
+         batch = RoundBatch()
+         batch.loadFromMessage(clientMsg)
          
-         # Encrypt one layer of the onion message
-         clientLocalKey = self.clientLocalKeys[ len(self.clientMessages) ]
-         newPayload = TU.encryptOnionLayer(self.__privateKey, 
-                                           clientLocalKey, 
-                                           clientMsg.getPayload())
-         clientMsg.setPayload(newPayload)
-         self.clientMessages.append(clientMsg)
+         if batch.getNetInfo() == 1:
+            print("Middle Server received round {} from Front server".format(
+                  batch.getRoundID()))
+            await self.handleRound(batch)
+         elif batch.getNetInfo() == 2:
+            print("Middle Server received responses from Spreading server")
+            await self.handleResponses(batch)
+         elif batch.getNetInfo() == 3:
+            # Dialing Protocol: the invitations of a dialing round
+            print("Middle Server received dialing round {} from Front server".format(
+                  batch.getRoundID()))
+            await self.handleDialRound(batch)
          
-         if self.nMessages == len(self.clientMessages):
-            self.forwardResponses()
-      elif clientMsg.getNetInfo() == 3: 
-         # Dialing Protocol: Client -> DeadDrop
+   # In here, we handle the messages of a round being sent towards the
+   # dead drop. There is only one way to send packets
+   async def handleRound(self, batch):
+      self.roundID = batch.getRoundID()
+      
+      # Decrypt one layer of every onion message in the crypto engine
+      results = await self.cryptoEngine.peelRound(batch.getPayloads(), 0)
          
-         _, newPayload = TU.decryptOnionLayer(
-               self.__privateKey, clientMsg.getPayload(), serverType=0)
-         clientMsg.setPayload(newPayload)
+      # Save the message data. The messages that couldn't be decrypted are
+      # None, they are answered with an empty response
+      clientSecrets = [ None if result is None else result[0] 
+                        for result in results ]
+      clientMessages = [ None if result is None else result[1]
+                         for result in results ]
          
-         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-         sock.connect((self.nextServerIP, self.nextServerPort))
-         sock.sendall(str(clientMsg).encode("utf-8"))
-         sock.close()
-      elif clientMsg.getNetInfo() == 4: 
-         # In here, we handle the first message sent by the previous server.
-         # It notifies us of a new round and how many messages are coming
+      self.forwardMessages(batch.getSlots(), clientSecrets, clientMessages)
+      
+   # In here, we handle the invitations of a dialing round. They are 
+   # peeled and shuffled like the messages of a round, but they have no
+   # responses, so nothing is kept once they are forwarded
+   async def handleDialRound(self, batch):
+      results = await self.cryptoEngine.peelRound(batch.getPayloads(), 0)
+      invitations = [ result[1] for result in results if result is not None ]
+      if len(invitations) < len(results):
+         print("Middle server error: couldn't decrypt {} invitations".format(
+               len(results) - len(invitations)))
+      
+      permutation = TU.generatePermutation(len(invitations))
+      shuffledInvitations = TU.shuffleWithPermutation(invitations, 
+                                                      permutation)
+      self.nextLink.sendBatch(RoundBatch(3, batch.getRoundID(), 
+                                         shuffledInvitations))
+      
+   # In here, we are handling the responses of the round being sent back
+   # to the clients. There is only one way to send packets, but responses 
+   # can arrive in any order and in several batches
+   async def handleResponses(self, batch):
+      roundSlots = self.roundSlots
+      if roundSlots is None or batch.getRoundID() != roundSlots.roundID:
+         print("Middle server error: received responses for a different round")
+         return
+      
+      # Encrypt one layer of each onion message. Each response carries the
+      # slot of the message it answers, which tells the secret to use
+      slots, payloads = roundSlots.selectPending(batch.getSlots(), 
+                                                 batch.getPayloads())
+      responses = await self.cryptoEngine.wrapRound(
+            roundSlots.getSecrets(slots), payloads)
          
-         # TODO -> Add lock to this whole part
-         self.nMessages = int(clientMsg.getPayload())
-         self.clientMessages = []
-         self.clientLocalKeys = []
+      # Only the batch that completes the round forwards it
+      if roundSlots.store(slots, responses) and roundSlots.isComplete():
+         self.forwardResponses(roundSlots)
          
-   # Assuming that the messages are stores in self.clientMessages this method
-   # adds noise, shuffles the messages and forwards them to the next server
-   def forwardMessages(self):
+   # This method adds noise, shuffles the messages and forwards them to the 
+   # next server. slots, clientSecrets and clientMessages are in the order 
+   # the messages were received. The messages that are None are not 
+   # forwarded, their slots are answered right away with an empty response
+   def forwardMessages(self, slots, clientSecrets, clientMessages):
       
       # TODO (jose): Noise addition goes here
       
       # Apply the mixnet by shuffling the messages
-      self.permutation = TU.generatePermutation(self.nMessages)
-      shuffledMessages = TU.shuffleWithPermutation(self.clientMessages,
-                                                   self.permutation)
-      
-      # Also shuffle the messages so they still match the clientMessages:
-      # self.clientLocalKeys[ i ] is the key that unlocks message self.clientMessges[ i ]
-      # This is used afterwards in handleMessage, getNetInfo() == 2
-      self.clientLocalKeys = TU.shuffleWithPermutation(self.clientLocalKeys,
-                                                         self.permutation)
-      
-      # Forward all the messages to the next server
-      # Send a message to the next server notifying of the numbers of 
-      # messages that will be sent
-      firstMsg = Message()
-      firstMsg.setNetInfo(4)
-      firstMsg.setPayload("{}".format(self.nMessages))
-      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-      sock.connect((self.nextServerIP, self.nextServerPort))
-      sock.sendall(str(firstMsg).encode("utf-8"))
-      sock.close()
-      
-      # Send all the messages to the next server
-      for msg in shuffledMessages:
-         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-         sock.connect((self.nextServerIP, self.nextServerPort))
-         sock.sendall(str(msg).encode("utf-8"))
-         sock.close()
-      
-      # Restart the messages so that we receive the responses from the 
-      # next server
-      self.clientMessages = []
-      
-   def forwardResponses(self):
-      # Unshuffle the messages
-      self.clientMessages = TU.unshuffleWithPermutation(self.clientMessages, 
-                                                 self.permutation)
-      
-      # Send the responses back to the previous server
-      for msg in self.clientMessages:
-         tempSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-         tempSock.connect((self.previousServerIP, self.previousServerPort))
-         tempSock.sendall(str(msg).encode("utf-8"))
-         tempSock.close()
-         
-
-
-
-
-
-
-
-
-
+      permutation = TU.generatePermutation(len(clientMessages))
+      shuffledMessages = TU.shuffleWithPermutation(clientMessages,
+                                                   permutation)
+      
+      # Preallocate the slots for the responses of the round. The slot of
+      # each message is its position in the shuffled round
+      roundSlots = RoundSlots(self.roundID, clientSecrets, slots, 
+                              permutation)
+      self.roundSlots = roundSlots
+      
+      # Leave out the messages that couldn't be decrypted, each forwarded 
+      # message keeps its position in the shuffled round as slot
+      forwardedSlots = [ slot for slot, message in enumerate(shuffledMessages)
+                         if message is not None ]
+      forwardedMessages = [ shuffledMessages[ slot ] 
+                            for slot in forwardedSlots ]
+      failedSlots = [ slot for slot, message in enumerate(shuffledMessages)
+                      if message is None ]
+      if len(failedSlots) > 0:
+         print("Middle server error: couldn't decrypt {} messages".format(
+               len(failedSlots)))
+         roundSlots.store(failedSlots, [ b"" ] * len(failedSlots))
+         if roundSlots.isComplete():
+            self.forwardResponses(roundSlots)
+            return
+      
+      # Forward the whole round to the next server in a single batch
+      self.nextLink.sendBatch(RoundBatch(1, self.roundID, forwardedMessages,
+                                         forwardedSlots))
+      
+   def forwardResponses(self, roundSlots):
+      # The responses are already unshuffled, they were written in the slots
+      # of the messages they answer. Send them back to the previous server
+      # in a single batch
+      self.previousLink.sendBatch(RoundBatch(2, roundSlots.roundID, 
+                                             roundSlots.responses,
+                                             roundSlots.getSlots()))
+      
+      # A newer round may have started while the responses were wrapped
+      if self.roundSlots is roundSlots:
+         self.roundSlots = None
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import secrets
+import numpy as np
+
+# Permutations used by the servers to shuffle the rounds. A permutation of
+# n elements is an array of n uint32 indices: permutation[i] is the
+# position of the element i once shuffled, so
+#   shuffled[ permutation[i] ] = toShuffle[i]
+#
+# A round is made of several parallel columns (the messages, the dead drop
+# server of each one, ...) that must be shuffled the same way. The inverse
+# of the permutation is computed once and every column is gathered with it
+# in a single pass: numpy arrays with fancy indexing and lists with one
+# comprehension over the indices, nothing is written element by element.
+#
+# Every permutation is drawn from a Philox generator keyed with 128 bits
+# from the OS CSPRNG, so the permutation of a round tells nothing about the
+# ones of the other rounds.
+
+indexType = np.uint32
+
+# Returns a generator keyed with fresh randomness from the OS
+def randomGenerator():
+   return np.random.Generator(np.random.Philox(key=secrets.randbits(128)))
+
+# Returns a random permutation of n elements
+def generatePermutation(n):
+   return randomGenerator().permutation(n).astype(indexType)
+
+# Returns the inverse of permutation: if permutation moves the element i to
+# the position j, the inverse maps j back to i
+def invertPermutation(permutation):
+   permutation = np.asarray(permutation, dtype=indexType)
+   inverse = np.empty_like(permutation)
+   inverse[ permutation ] = np.arange(len(permutation), dtype=indexType)
+   return inverse
+
+# Returns column[ indices[0] ], column[ indices[1] ], ... with the same type
+# as column: an array if it is a numpy array, a list otherwise
+def gather(column, indices):
+   if isinstance(column, np.ndarray):
+      return column[ indices ]
+   return [ column[i] for i in indices.tolist() ]
+
+# Shuffles every column following permutation. Returns the list of
+# shuffled columns. Raises ValueError if a column doesn't have the size of
+# the permutation
+def shuffleColumns(permutation, *columns):
+   return unshuffleColumns(invertPermutation(permutation), *columns)
+
+# Reverses shuffleColumns: unshuffled[i] = shuffled[ permutation[i] ] for
+# every column. Returns the list of unshuffled columns
+def unshuffleColumns(permutation, *columns):
+   permutation = np.asarray(permutation, dtype=indexType)
+   for column in columns:
+      if len(column) != len(permutation):
+         raise ValueError("The size of the permutation and the number of " +
+                          "elements to shuffle must be the same")
+   return [ gather(column, permutation) for column in columns ]
+
+# Checks that the permutations are valid and that shuffling and unshuffling
+# several columns at once gives back the original columns
+def testPermutation():
+   from random import randrange
+   error = False
+
+   for _ in range(100):
+      n = randrange(0, 10**4)
+      permutation = generatePermutation(n)
+      messages = [ str(i) for i in range(n) ]
+      servers = np.arange(n, dtype=np.uint32) % 7
+
+      if sorted(permutation.tolist()) != list(range(n)):
+         print("FAILURE: not a permutation of {} elements".format(n))
+         error = True
+         continue
+
+      shuffledMessages, shuffledServers = shuffleColumns(permutation,
+                                                         messages, servers)
+      if any(shuffledMessages[ j ] != messages[ i ] 
+             for i, j in enumerate(permutation.tolist())) or \
+            not (shuffledServers[ permutation ] == servers).all():
+         print("FAILURE: shuffling {} elements".format(n))
+         error = True
+
+      unshuffledMessages, unshuffledServers = unshuffleColumns(
+            permutation, shuffledMessages, shuffledServers)
+      if unshuffledMessages != messages or \
+            not (unshuffledServers == servers).all():
+         print("FAILURE: unshuffling {} elements".format(n))
+         error = True
+
+      inverse = invertPermutation(permutation)
+      if not (inverse[ permutation ] == np.arange(n)).all():
+         print("FAILURE: inverting {} elements".format(n))
+         error = True
+
+   if not error:
+      print("SUCESS")
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+import asyncio
+
+# The messages of a round received by a server, written only by the writer
+# task of a RoundIngestor. keys[i] identifies the sender of the i-th message
+# written and results[i] is the result of peeling it (see
+# TU.decryptOnionLayer). failedKeys identifies the senders of the messages
+# that couldn't be decrypted. pending counts the messages admitted in the 
+# round that are not written yet
+class RoundBuffer:
+   def __init__(self, roundID):
+      self.roundID = roundID
+      self.open = True
+      self.keys = []
+      self.results = []
+      self.failedKeys = []
+      self.pending = 0
+      self.drained = asyncio.Event()
+      self.drained.set()
+
+   def __len__(self):
+      return len(self.results)
+
+# Ingestion pipeline of the messages of a round:
+#   readers -> bounded queue -> crypto workers -> single writer -> RoundBuffer
+# The readers (the tasks handling the received messages) only admit each
+# message to its round and put it in the queue, waiting while it is full.
+# The server limits how many readers run at once (see 
+# ServerCore.AdmissionLimit), so a burst of messages stays in the sockets
+# and slows down the senders instead of piling up in memory. The crypto 
+# workers take the messages in batches and peel them in the CryptoEngine,
+# and a single writer task appends the results to the buffer of their 
+# round, so nothing else ever modifies a round while it is being filled.
+#
+# When a round closes no more messages are admitted to it, and closeRound
+# waits until the ones already admitted are written before handing the
+# buffer over. Every message is tagged with the buffer of its round, so a
+# message can't end up in a different one.
+class RoundIngestor:
+   # serverType is the one passed to TU.decryptOnionLayer. queueSize is the
+   # maximum number of messages waiting for the crypto workers, nWorkers the
+   # number of crypto workers (by default one per process of the engine)
+   # and batchSize the maximum number of messages peeled at once
+   def __init__(self, cryptoEngine, serverType, queueSize=1024,
+                nWorkers=None, batchSize=64):
+      self.cryptoEngine = cryptoEngine
+      self.serverType = serverType
+      self.queueSize = queueSize
+      self.nWorkers = max(1, cryptoEngine.nWorkers) if nWorkers is None \
+                      else nWorkers
+      self.batchSize = batchSize
+
+      # roundID -> RoundBuffer of the rounds admitting messages
+      self.buffers = {}
+      self.queue = None
+      self.peeled = None
+      self.tasks = []
+
+   # Starts the crypto workers and the writer. Must be called from the
+   # event loop
+   def start(self):
+      self.queue = asyncio.Queue(maxsize=self.queueSize)
+      self.peeled = asyncio.Queue(maxsize=self.nWorkers)
+      loop = asyncio.get_running_loop()
+      self.tasks = [ loop.create_task(self.cryptoWorker())
+                     for _ in range(self.nWorkers) ]
+      self.tasks.append(loop.create_task(self.writer()))
+
+   def stop(self):
+      for task in self.tasks:
+         task.cancel()
+
+   # Starts admitting messages for round roundID
+   def openRound(self, roundID):
+      self.buffers[roundID] = RoundBuffer(roundID)
+
+   # Admits the message payload sent by key to round roundID. Waits while
+   # the queue is full. Returns False if the round isn't admitting messages
+   async def submit(self, roundID, key, payload):
+      buffer = self.buffers.get(roundID)
+      if buffer is None:
+         return False
+
+      buffer.pending += 1
+      buffer.drained.clear()
+      await self.queue.put((buffer, key, payload))
+      return True
+
+   # Stops admitting messages for round roundID and waits until all the
+   # admitted ones are written. Returns the RoundBuffer of the round, or
+   # None if the round wasn't open
+   async def closeRound(self, roundID):
+      buffer = self.buffers.pop(roundID, None)
+      if buffer is None:
+         return None
+      buffer.open = False
+      await buffer.drained.wait()
+      return buffer
+
+   # Peels the payloads. The result of the ones that can't be decrypted is
+   # None, see CryptoEngine.peelRound
+   async def peelBatch(self, payloads):
+      try:
+         results = await self.cryptoEngine.peelRound(payloads, 
+                                                     self.serverType)
+      except Exception as e:
+         print("Round ingestor error: couldn't peel batch: {!r}".format(e))
+         return [ None ] * len(payloads)
+      
+      failed = results.count(None)
+      if failed > 0:
+         print("Round ingestor error: couldn't peel {} messages".format(failed))
+      return results
+
+   async def cryptoWorker(self):
+      while True:
+         items = [ await self.queue.get() ]
+         while len(items) < self.batchSize and not self.queue.empty():
+            items.append(self.queue.get_nowait())
+
+         results = await self.peelBatch([ payload for _, _, payload in items ])
+         await self.peeled.put(list(zip(items, results)))
+
+   # The only task that writes in the round buffers
+   async def writer(self):
+      while True:
+         for (buffer, key, _), result in await self.peeled.get():
+            if result is not None:
+               buffer.keys.append(key)
+               buffer.results.append(result)
+            else:
+               buffer.failedKeys.append(key)
+            buffer.pending -= 1
+            if buffer.pending == 0:
+               buffer.drained.set()
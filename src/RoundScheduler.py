@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import asyncio
+import time
+
+# Information of a round. It tracks if the round is open (clients can send
+# messages only while it is), the identifying number of the round and how
+# long each one of its phases took
+class RoundInfo:
+   def __init__(self, roundID):
+      self.open = True
+      self.roundID = roundID
+
+      # Times are taken from the monotonic clock, so they don't change if
+      # the system time does. timings maps each phase to its duration in
+      # seconds, in the order the phases ended
+      self.startTime = time.monotonic()
+      self.phaseStart = self.startTime
+      self.timings = {}
+
+   # Marks the end of the current phase of the round and the start of the
+   # next one
+   def endPhase(self, phase):
+      now = time.monotonic()
+      self.timings[phase] = now - self.phaseStart
+      self.phaseStart = now
+
+   # Total duration of the round up to the end of its last phase
+   def getDuration(self):
+      return self.phaseStart - self.startTime
+
+   def __str__(self):
+      phases = " ".join("{}={:.3f}s".format(phase, duration)
+                        for phase, duration in self.timings.items())
+      return "round {} took {:.3f}s: {}".format(self.roundID,
+                                               self.getDuration(), phases)
+
+# Runs the rounds of a Front Server in the shared event loop. Every round:
+#   1) waits roundGap seconds after the end of the previous one
+#   2) starts the round calling startRound(roundInfo) and leaves it open
+#      for roundWindow seconds, counted from the moment startRound returns,
+#      so the time spent telling the clients doesn't shorten the window
+#   3) closes the round and calls runRound(roundInfo), which forwards the
+#      messages and sends the responses back to the clients
+# startRound and runRound are coroutine functions. All the waiting is done
+# with timers of the event loop, so no CPU is used while waiting.
+class RoundScheduler:
+   # Number of finished rounds whose RoundInfo is kept in self.rounds
+   historySize = 100
+
+   # name is only used for logging, it tells apart the schedulers running
+   # in the same server
+   def __init__(self, startRound, runRound, roundWindow=2, roundGap=10,
+                firstRound=1, name="Round scheduler"):
+      self.name = name
+      self.startRound = startRound
+      self.runRound = runRound
+      self.roundWindow = roundWindow
+      self.roundGap = roundGap
+
+      self.roundID = firstRound
+      self.rounds = {}
+      self.task = None
+
+   # Starts running rounds. Must be called from the event loop
+   def start(self):
+      self.task = asyncio.get_running_loop().create_task(self.run())
+
+   def stop(self):
+      if self.task is not None:
+         self.task.cancel()
+
+   # Sleeps until the monotonic clock reaches deadline
+   async def sleepUntil(self, deadline):
+      delay = deadline - time.monotonic()
+      if delay > 0:
+         await asyncio.sleep(delay)
+
+   async def run(self):
+      nextStart = time.monotonic() + self.roundGap
+      while True:
+         await self.sleepUntil(nextStart)
+
+         roundInfo = RoundInfo(self.roundID)
+         self.rounds[self.roundID] = roundInfo
+         self.rounds.pop(self.roundID - self.historySize, None)
+
+         await self.startRound(roundInfo)
+         roundInfo.endPhase("start")
+
+         # Now wait for the end of the window and close the round
+         await self.sleepUntil(time.monotonic() + self.roundWindow)
+         roundInfo.open = False
+         roundInfo.endPhase("window")
+
+         try:
+            await self.runRound(roundInfo)
+         except Exception as e:
+            print("{} error: round {} failed: {!r}".format(
+                  self.name, roundInfo.roundID, e))
+
+         print("{}: {}".format(self.name, roundInfo))
+         self.roundID += 1
+         nextStart = time.monotonic() + self.roundGap
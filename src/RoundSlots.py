@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import TorzelaUtils as TU
+
+# Return path state of a round in a server. The arrays are preallocated
+# when the round is forwarded and indexed by the position of each message
+# in the round as the server received it (its incoming index):
+#   secrets[i] -> shared secret of the onion layer of message i
+#   slots[i]   -> slot the previous server gave to message i, responses are
+#                 sent back with it
+#   responses[i] -> encrypted response of message i, None until it arrives
+#
+# Messages are forwarded shuffled and each one of them gets as slot its
+# position in the shuffled round. A response carrying slot j belongs to the
+# message owners[j], so responses can be handled in any order and as soon
+# as they arrive: unshuffling is just writing each one in its position.
+class RoundSlots:
+   # permutation is the one used to shuffle the round, see
+   # TU.shuffleWithPermutation. The incoming message i was forwarded with
+   # slot permutation[i]. If permutation is None, the messages were not
+   # shuffled
+   def __init__(self, roundID, secrets, slots, permutation=None):
+      self.roundID = roundID
+      self.secrets = secrets
+      self.slots = slots
+      if permutation is None:
+         self.owners = range(len(secrets))
+      else:
+         self.owners = TU.invertPermutation(permutation).tolist()
+
+      self.responses = [ None ] * len(secrets)
+      self.remaining = len(secrets)
+
+   def __len__(self):
+      return len(self.responses)
+
+   # Returns the incoming index of the message forwarded with slot, or None
+   # if there is no such slot
+   def getOwner(self, slot):
+      if 0 <= slot < len(self.owners):
+         return self.owners[slot]
+      return None
+
+   # Keeps only the responses that can be stored: the ones for known slots
+   # that haven't been answered yet. Returns the lists (slots, payloads)
+   def selectPending(self, slots, payloads):
+      pending = [ (slot, payload) for slot, payload in zip(slots, payloads)
+                  if self.getOwner(slot) is not None and
+                     self.responses[self.getOwner(slot)] is None ]
+      return [ slot for slot, _ in pending ], [ p for _, p in pending ]
+
+   # Returns the secrets needed to encrypt the responses for the given
+   # slots of the forwarded round
+   def getSecrets(self, slots):
+      return [ self.secrets[self.owners[slot]] for slot in slots ]
+
+   # Stores the encrypted responses, responses[k] answers slots[k] of the
+   # forwarded round. Responses for unknown slots or slots that were
+   # already answered are ignored. Returns the number of stored responses
+   def store(self, slots, responses):
+      stored = 0
+      for slot, response in zip(slots, responses):
+         owner = self.getOwner(slot)
+         if owner is None or self.responses[owner] is not None:
+            continue
+         self.responses[owner] = response
+         stored += 1
+      self.remaining -= stored
+      return stored
+
+   # Returns True if every slot of the forwarded round has been answered
+   def isComplete(self):
+      return self.remaining == 0
+
+   # Returns the slots the responses must be sent back with
+   def getSlots(self):
+      return self.slots
+
+# Checks that responses arriving in any order, in several batches, with
+# repeated and unknown slots, end up in the position of the message they
+# answer
+def testRoundSlots():
+   from random import randrange, shuffle
+   error = False
+
+   for _ in range(100):
+      n = randrange(1, 1000)
+      slots = [ 3 * i for i in range(n) ]
+      permutation = TU.generatePermutation(n)
+      roundSlots = RoundSlots(1, [ "secret{}".format(i) for i in range(n) ],
+                              slots, permutation)
+
+      # The message i was forwarded with slot permutation[i], the next 
+      # server answers it with "response<i>"
+      forwarded = list(range(n))
+      shuffle(forwarded)
+      forwarded += forwarded[:randrange(0, n)] + [ n, n + 5 ]
+      start = 0
+      while start < len(forwarded):
+         end = start + randrange(1, 50)
+         incoming = [ int(permutation[ i ]) if i < n else i 
+                      for i in forwarded[start:end] ]
+         pending, payloads = roundSlots.selectPending(
+               incoming, [ "response{}".format(roundSlots.getOwner(slot))
+                           for slot in incoming ])
+         if roundSlots.getSecrets(pending) != \
+               [ "secret{}".format(roundSlots.getOwner(slot)) 
+                 for slot in pending ]:
+            print("FAILURE: secrets of the slots")
+            error = True
+         roundSlots.store(pending, payloads)
+         start = end
+
+      if not roundSlots.isComplete() or roundSlots.responses != \
+            [ "response{}".format(i) for i in range(n) ] or \
+            roundSlots.getSlots() != slots:
+         print("FAILURE: round of {} messages".format(n))
+         error = True
+
+   if not error:
+      print("SUCESS")
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+import asyncio
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from message import Message
+from Framing import FrameReader, FrameTooLargeError, frameHeader, \
+                    defaultMaxFrameSize
+
+# All the servers running in this process share a single asyncio event loop,
+# which runs in its own thread. Connections don't get a thread each anymore:
+# every received message is handled by a task in this loop, and the CPU
+# heavy work (the onion routing crypto) is sent to an executor so it 
+# doesn't block the loop.
+eventLoop = None
+cryptoExecutor = None
+coreLock = threading.Lock()
+
+# Returns the shared event loop, starting it the first time
+def getEventLoop():
+   global eventLoop, cryptoExecutor
+   with coreLock:
+      if eventLoop is None:
+         eventLoop = asyncio.new_event_loop()
+         cryptoExecutor = ThreadPoolExecutor(thread_name_prefix="crypto")
+         threading.Thread(target=eventLoop.run_forever, daemon=True).start()
+   return eventLoop
+
+# Runs the coroutine coro in the shared event loop. It can be called from 
+# any thread, returns a concurrent.futures.Future
+def runInLoop(coro):
+   return asyncio.run_coroutine_threadsafe(coro, getEventLoop())
+
+# Returns True if the caller is running inside the shared event loop
+def inEventLoop():
+   try:
+      return asyncio.get_running_loop() is eventLoop
+   except RuntimeError:
+      return False
+
+# Runs func(*args) in the crypto executor. Must be awaited from the loop
+def runCrypto(func, *args):
+   return getEventLoop().run_in_executor(cryptoExecutor, func, *args)
+
+# Starts listening on localhost:port. handler(msg, connection) is a 
+# coroutine function called for every message received on any connection.
+# Connections announcing frames bigger than maxFrameSize bytes are closed
+# (see FrameReader). If maxHandlers is given, at most maxHandlers handler
+# tasks run at once for all the connections of the listener (see 
+# AdmissionLimit)
+async def listen(port, handler, maxFrameSize=defaultMaxFrameSize, 
+                 maxHandlers=None):
+   loop = asyncio.get_running_loop()
+   admission = None if maxHandlers is None else AdmissionLimit(maxHandlers)
+   return await loop.create_server(
+         lambda: Connection(handler, maxFrameSize=maxFrameSize, 
+                            admission=admission), 
+         'localhost', port)
+
+# Opens a connection to address. Returns the Connection object
+async def connect(address, handler, onClose=None):
+   loop = asyncio.get_running_loop()
+   _, connection = await loop.create_connection(
+         lambda: Connection(handler, onClose), address[0], address[1])
+   return connection
+
+# Opens a new connection to address, sends a single message and closes it.
+# Used for the short lived connections between servers and clients
+async def sendMessageTo(address, msg):
+   _, writer = await asyncio.open_connection(address[0], address[1])
+   buffers = msg.toBuffers()
+   length = sum(memoryview(buf).nbytes for buf in buffers)
+   writer.writelines([frameHeader.pack(length)] + buffers)
+   await writer.drain()
+   writer.close()
+   await writer.wait_closed()
+
+# Limits the number of handler tasks running at once for the connections
+# of a listener. The messages are admitted before their task is created: 
+# while the limit is reached, the connections stop reading and wait their 
+# turn, so the messages that can't be handled yet stay in the sockets 
+# instead of piling up in tasks. A connection is woken up every time a 
+# task finishes
+class AdmissionLimit:
+   def __init__(self, limit):
+      self.limit = limit
+      self.running = 0
+      self.waiting = collections.deque()
+
+   def full(self):
+      return self.running >= self.limit
+
+   # Called when a task is created and when it finishes
+   def acquire(self):
+      self.running += 1
+
+   def release(self, task=None):
+      self.running -= 1
+      while self.waiting and not self.full():
+         self.waiting.popleft().admissionReady()
+
+   # connection will be woken up with admissionReady once a task finishes
+   def wait(self, connection):
+      self.waiting.append(connection)
+
+# A framed connection handled by the event loop. Incoming data is received
+# straight into the buffer of a FrameReader (this is what 
+# asyncio.BufferedProtocol is for) and every complete frame is loaded as a 
+# Message and handled by a new task running handler(msg, connection).
+# The tasks are created in the same order the messages arrive.
+#
+# The receive buffer is reused, so each frame is copied once out of it
+# before the task runs. The message payload then points into that copy.
+# If the peer announces a frame bigger than maxFrameSize the connection is
+# closed before anything is allocated for it. With an AdmissionLimit, no
+# task is created while the limit is reached: the connection stops reading
+# until it is woken up, and then handles the frames it already received.
+class Connection(asyncio.BufferedProtocol):
+   def __init__(self, handler, onClose=None, 
+                maxFrameSize=defaultMaxFrameSize, admission=None):
+      self.handler = handler
+      self.onClose = onClose
+      self.reader = FrameReader(maxFrameSize=maxFrameSize)
+      self.admission = admission
+      self.waitingAdmission = False
+      self.transport = None
+      self.peerAddress = None
+      self.pauses = 0
+
+   def connection_made(self, transport):
+      self.transport = transport
+      self.peerAddress = transport.get_extra_info("peername")
+      if self.admission is not None and self.admission.full():
+         self.waitAdmission()
+
+   def get_buffer(self, sizehint):
+      return self.reader.getBuffer()
+
+   def buffer_updated(self, nbytes):
+      self.reader.bufferUpdated(nbytes)
+      self.handleFrames()
+
+   # Creates a task for every complete frame received, as long as the
+   # admission limit allows it
+   def handleFrames(self):
+      if self.waitingAdmission:
+         return
+      loop = asyncio.get_running_loop()
+      try:
+         while self.admission is None or not self.admission.full():
+            frame = self.reader.nextFrame()
+            if frame is None:
+               return
+            msg = Message()
+            msg.loadFromBuffer(bytes(frame))
+            task = loop.create_task(self.handler(msg, self))
+            if self.admission is not None:
+               self.admission.acquire()
+               task.add_done_callback(self.admission.release)
+         self.waitAdmission()
+      except FrameTooLargeError as e:
+         print("Connection error: closing connection with {}: {}".format(
+               self.peerAddress, e))
+         self.close()
+
+   def waitAdmission(self):
+      self.waitingAdmission = True
+      self.pauseReading()
+      self.admission.wait(self)
+
+   # Called by the AdmissionLimit when a task can be created again
+   def admissionReady(self):
+      self.waitingAdmission = False
+      self.resumeReading()
+      self.handleFrames()
+
+   def connection_lost(self, exc):
+      self.transport = None
+      if self.onClose is not None:
+         self.onClose(self)
+
+   def getPeerAddress(self):
+      return self.peerAddress
+
+   def isOpen(self):
+      return self.transport is not None and not self.transport.is_closing()
+
+   # Stops reading from the socket until resumeReading is called as many
+   # times as pauseReading was. Used for backpressure
+   def pauseReading(self):
+      self.pauses += 1
+      if self.pauses == 1 and self.isOpen():
+         self.transport.pause_reading()
+
+   def resumeReading(self):
+      self.pauses -= 1
+      if self.pauses == 0 and self.isOpen():
+         self.transport.resume_reading()
+
+   # Sends the concatenation of buffers as a single frame. Must be called 
+   # from the event loop
+   def sendBuffers(self, buffers):
+      length = sum(memoryview(buf).nbytes for buf in buffers)
+      self.transport.writelines([frameHeader.pack(length)] + list(buffers))
+
+   def send(self, msg):
+      self.sendBuffers(msg.toBuffers())
+
+   def close(self):
+      if self.transport is not None:
+         self.transport.close()
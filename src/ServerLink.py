@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import asyncio
+import ServerCore
+
+# A persistent, bidirectional link between two adjacent servers of a chain.
+# It is opened once during setupConnection and then reused for every round
+# in both directions: the server that opened it sends the messages towards
+# the dead drops and receives the responses through it, and the server on the
+# other end does the opposite.
+#
+# Only the side that opened the link (the one that called connect) knows
+# how to reopen it. If the connection breaks it keeps trying to reconnect
+# and sends the setup message again, so the other side can attach the new
+# connection to the same link. Messages sent while the link is down are
+# kept and sent as soon as it is up again.
+#
+# The link lives in the shared event loop (see ServerCore), but messages
+# can be sent through it from any thread.
+class ServerLink:
+   # Seconds to wait before trying to connect again, so a server that 
+   # keeps refusing the link doesn't make us reconnect in a loop
+   reconnectDelay = 1
+   
+   # name is only used for logging. handler(msg, connection) is the 
+   # coroutine function handling every message received through the link
+   def __init__(self, name, handler):
+      self.name = name
+      self.handler = handler
+      self.loop = ServerCore.getEventLoop()
+
+      # The connection currently used by the link, None while it is down
+      self.connection = None
+      
+      # Lists of buffers waiting for the link to be up
+      self.pending = []
+
+      # Only set on the side that opens the link
+      self.address = None
+      self.setupMsg = None
+
+   # Open the link towards address. setupMsg is the first message sent on
+   # every new connection. Returns once the link is up
+   async def connect(self, address, setupMsg):
+      self.address = address
+      self.setupMsg = setupMsg
+      await self.reconnect()
+
+   async def reconnect(self, delay=0):
+      await asyncio.sleep(delay)
+      while True:
+         try:
+            connection = await ServerCore.connect(self.address, self.handler,
+                                                  self.connectionLost)
+            break
+         except OSError:
+            # Put a delay here so we don't burn CPU time
+            await asyncio.sleep(self.reconnectDelay)
+      connection.send(self.setupMsg)
+      self.attach(connection)
+
+   # Use an already established connection for this link. This is used by
+   # the server accepting the link, after it receives the setup message
+   def attach(self, connection):
+      oldConnection = self.connection
+      self.connection = connection
+      connection.onClose = self.connectionLost
+      if oldConnection is not None and oldConnection is not connection:
+         oldConnection.close()
+
+      for buffers in self.pending:
+         connection.sendBuffers(buffers)
+      self.pending = []
+
+   def isUp(self):
+      return self.connection is not None
+
+   # Sends a message through the link
+   def send(self, msg):
+      self.sendBuffers(msg.toBuffers())
+
+   # Sends a whole round (a RoundBatch) through the link in a single frame
+   def sendBatch(self, batch):
+      self.sendBuffers(batch.toBuffers())
+
+   # Sends the concatenation of buffers as a single frame
+   def sendBuffers(self, buffers):
+      if not ServerCore.inEventLoop():
+         self.loop.call_soon_threadsafe(self.sendBuffers, buffers)
+      elif self.connection is None or not self.connection.isOpen():
+         self.pending.append(buffers)
+      else:
+         self.connection.sendBuffers(buffers)
+
+   def connectionLost(self, connection):
+      # The connection was already replaced
+      if self.connection is not connection:
+         return
+      self.connection = None
+
+      print("{} lost its link with {}".format(self.name, 
+                                              connection.getPeerAddress()))
+      if self.address is not None:
+         self.loop.create_task(self.reconnect(self.reconnectDelay))
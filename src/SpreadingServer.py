@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 
-import socket
-import threading
-import time
-from message import Message
+import asyncio
+from message import Message, RoundBatch
+from ServerLink import ServerLink
+import ServerCore
+from CryptoEngine import CryptoEngine
+from RoundSlots import RoundSlots
 import TorzelaUtils as TU
 
 class SpreadingServer:
@@ -11,9 +13,16 @@ class SpreadingServer:
    #  (<IP>, <Port>)
    # where <IP> is the IP address of a Dead Drop and
    # <Port> is the port that the Dead Drop is listening on
-   def __init__(self, nextServers, localPort):
+   # keyMode is the key agreement mode used by the network, one of 
+   # TU.keyModes. cryptoWorkers is the number of processes used for the
+   # crypto, see CryptoEngine. chainID is the number of the chain this
+   # server belongs to, the clients send it in their messages so the dead
+   # drops know where to send the responses
+   def __init__(self, nextServers, localPort, keyMode=TU.classicMode, 
+                cryptoWorkers=None, chainID=0):
       self.nextServers = nextServers
       self.localPort = localPort
+      self.chainID = chainID
 
       # We only allow one connect to the SpreadingServer
       # Initialize these to 0 here, we will set them
@@ -22,215 +31,253 @@ class SpreadingServer:
       self.previousServerPort = 0
 
       # Used for onion rotuing in the conversational protocol  
-      # The keys and messages will be updated each round
-      self.clientLocalKeys = []
-      self.clientMessages = []
-      self.nMessages = 0
+      # The return path state of the round (see RoundSlots) is created when
+      # the round is forwarded
+      self.roundSlots = None
+      self.roundID = 0
       
       # The server keys
       self.__privateKey, self.publicKey = TU.generateKeys( 
-            TU.createKeyGenerator() )
-      
-      # We need to wait for all connections to setup, so create
-      # an integer and initialize it with the number of dead drops
-      # we are connecting to. Every time we successfully connect to
-      # one, decrement this value. When it is equal to 0, we know 
-      # all of the connections are good
-      self.allConnectionsGood = len(nextServers)
-      for ddServer in nextServers:
-         # We need to spawn off a thread here, else we will block
-         # the entire program.
-         threading.Thread(target=self.setupConnection, args=(ddServer,)).start()
- 
-      # Setup main listening socket to accept incoming connections
-      threading.Thread(target=self.listen, args=()).start()
+            TU.createKeyGenerator(keyMode) )
+
+      # Peels and wraps the onion layers of the rounds in a process pool
+      self.cryptoEngine = CryptoEngine(self.__privateKey, cryptoWorkers)
+      
+      # Persistent links with the neighbours. The previous server opens its
+      # link with us. self.nextLinks[i] is our link with self.nextServers[i]
+      self.previousLink = ServerLink("SpreadingServer", self.handleMsg)
+      self.nextLinks = [ ServerLink("SpreadingServer", self.handleMsg) 
+                         for _ in nextServers ]
+      
+      # Everything runs in the shared event loop, setupConnection also
+      # starts listening once we are connected to all the dead drops
+      self.server = None
+      self.setup = ServerCore.runInLoop(self.setupConnection())
       
    def getPublicKey(self):
       return self.publicKey
 
-   def setupConnection(self, ddServer):
+   # Stops the server: it stops listening, and the processes of its
+   # crypto engine exit. Can be called from any thread, returns a 
+   # concurrent.futures.Future
+   def stop(self):
+      return ServerCore.runInLoop(self.shutdown())
+
+   async def shutdown(self):
+      self.setup.cancel()
+      if self.server is not None:
+         self.server.close()
+      self.cryptoEngine.shutdown()
+
+   async def setupConnection(self):
       # Before we can connect to the next server, we need
       # to send a setup message to the next server
       setupMsg = Message()
       setupMsg.setType(0)
-      setupMsg.setPayload("{}".format(self.localPort))
-
-      connectionMade = False
-      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-      while not connectionMade:
-         try:
-            sock.connect(ddServer)
-            sock.sendall(str.encode(str(setupMsg)))
-            connectionMade = True
-            # When self.allConnectionsGood is 0, we know all of 
-            # the connections have been setup properly
-            self.allConnectionsGood -= 1
-         except:
-            # Put a delay here so we don't burn CPU time
-            time.sleep(1)
-      sock.close()
+      setupMsg.setPayload("{}|{}".format(self.localPort, self.chainID))
 
+      # Open the links with all the dead drops. They keep retrying until the
+      # dead drops are up. We need to wait for all connections to be setup
+      # before listening
+      await asyncio.gather(*[ link.connect(ddServer, setupMsg) 
+                              for ddServer, link in zip(self.nextServers, 
+                                                        self.nextLinks) ])
+      
+      await self.listen()
 
-   # This is where all incoming messages are handled
-   def listen(self):
-      # Wait until we have connected to the next server
-      while self.allConnectionsGood != 0:
-         time.sleep(1)
-
-      # Listen for incoming connections
-      self.listenSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-      self.listenSock.bind(('localhost', self.localPort))
-      self.listenSock.listen(10)
-   
-      while True:
-         print("SpreadingServer awaiting connection")
-         conn, client_addr = self.listenSock.accept()
-
-         print("SpreadingServer accepted connection from " + str(client_addr))
-
-         # Spawn a thread to handle the client
-         threading.Thread(target=self.handleMsg, args=(conn, client_addr,)).start()
+   # Listen for incoming connections. All messages are handled by handleMsg
+   async def listen(self):
+      self.server = await ServerCore.listen(self.localPort, self.handleMsg)
+      print("SpreadingServer listening on port {}".format(self.localPort))
    
-   # This runs in a thread and handles messages from clients
-   def handleMsg(self, conn, client_addr):
-      # Receive data from client
-      clientData = conn.recv(32768).decode("utf-8")
-
-      # Format as message
-      clientMsg = Message()
-      clientMsg.loadFromString(clientData)
-
-      if clientMsg.getNetInfo() != 1 and clientMsg.getNetInfo() != 2:
-         print("Spreading Server got " + clientData)
+   # Handles every message received, both from new connections and through
+   # the links. It runs as a task in the event loop
+   async def handleMsg(self, clientMsg, connection):
+      if clientMsg.getNetInfo() != 4:
+         print("Spreading Server got " + str(clientMsg))
 
       # Check if the packet is for setting up a connection
       if clientMsg.getNetInfo() == 0:
-         # If it is, record it's IP and Port
-         self.previousServerIP = client_addr[0]
-         self.previousServerPort = int(clientMsg.getPayload())
-         conn.close()
-      elif clientMsg.getNetInfo() == 1: 
-         print("Spreading Server received message from Middle server")
-         # In here, we handle messages going from a client towards a dead drop
-         # Send message to all dead drops
-         
-         # TODO -> Add lock to this whole part
-         
-         if self.nMessages <= len(self.clientMessages):
-            print("Spreading server error: received more messages than expected")
-         
-         # Decrypt one layer of the onion message
-         deadDropServer, clientLocalKey, newPayload = TU.decryptOnionLayer(
-               self.__privateKey, clientMsg.getPayload(), serverType=1)
-         clientMsg.setPayload(newPayload)
-         
-         # TODO (jose): deadDropServer contains towards which server
-         # the message has to be sent, manage that
-         
-         # Save the message data
-         self.clientLocalKeys.append(clientLocalKey)
-         self.clientMessages.append(clientMsg)
+         # If it is, record it's IP and Port and keep the connection as
+         # the link with the previous server
+         self.previousServerIP = connection.getPeerAddress()[0]
+         self.previousServerPort = int(clientMsg.getPayloadString())
+         self.previousLink.attach(connection)
+      elif clientMsg.getNetInfo() == 4: 
+         # In here, we handle a whole round sent by one of our neighbours
+         batch = RoundBatch()
+         batch.loadFromMessage(clientMsg)
          
-         if self.nMessages == len(self.clientMessages):
-            self.forwardMessages()
+         if batch.getNetInfo() == 1:
+            print("Spreading Server received round {} from Middle server".format(
+                  batch.getRoundID()))
+            await self.handleRound(batch)
+         elif batch.getNetInfo() == 2:
+            print("Spreading Server received responses from Dead Drop server")
+            await self.handleResponses(batch)
+         elif batch.getNetInfo() == 3:
+            # Dialing Protocol: the invitations of a dialing round
+            print("Spreading Server received dialing round {} from Middle server".format(
+                  batch.getRoundID()))
+            await self.handleDialRound(batch)
             
-      elif clientMsg.getNetInfo() == 2: 
-         print("Spreading Server received message from Dead Drop server")
-         # Here we handle messages coming from a dead drop back
-         # towards a client. Just forward back to server
-         
-         if self.nMessages <= len(self.clientMessages):
-            print("Middle server error: received more messages than expected")
-         
-         # Encrypt one layer of the onion message
-         clientLocalKey = self.clientLocalKeys[ len(self.clientMessages) ]
-         newPayload = TU.encryptOnionLayer(self.__privateKey, 
-                                           clientLocalKey, 
-                                           clientMsg.getPayload())
-         clientMsg.setPayload(newPayload)
-         self.clientMessages.append(clientMsg)
-         
-         if self.nMessages == len(self.clientMessages):
-            self.forwardResponses()
-      elif clientMsg.getNetInfo() == 3: 
-         # Dialing Protocol: Client -> DeadDrop         
-         # Onion routing stuff
-         deadDropServer, self.clientLocalKey, newPayload = TU.decryptOnionLayer(
-               self.__privateKey, clientMsg.getPayload(), serverType=1)
-         clientMsg.setPayload(newPayload)
-         
-         # TODO (matthew): deadDropServer contains towards which server
-         # the message has to be sent :D
+   # In here, we handle the messages of a round going from the clients 
+   # towards the dead drops
+   async def handleRound(self, batch):
+      self.roundID = batch.getRoundID()
+      
+      # Decrypt one layer of every onion message in the crypto engine
+      results = await self.cryptoEngine.peelRound(batch.getPayloads(), 1)
          
-         for ddrop in self.nextServers:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.connect(ddrop)
-            self.sock.sendall(str(clientMsg).encode("utf-8"))
-            self.sock.close()
-
-      elif clientMsg.getNetInfo() == 4: 
-         # In here, we handle the first message sent by the previous server.
-         # It notifies us of a new round and how many messages are coming
+      # Save the message data. deadDropServers[ i ] is the index of the 
+      # dead drop server the message i has to be sent to. The data of the
+      # messages that couldn't be decrypted is None
+      failedResult = (None, None, None)
+      results = [ failedResult if result is None else result 
+                  for result in results ]
+      deadDropServers = [ deadDropServer for deadDropServer, _, _ in results ]
+      clientSecrets = [ clientSecret for _, clientSecret, _ in results ]
+      clientMessages = [ newPayload for _, _, newPayload in results ]
          
-         # TODO -> Add lock to this whole part
+      unroutable, failed = self.forwardMessages(batch.getSlots(), 
+                                                clientSecrets, clientMessages,
+                                                deadDropServers)
+      roundSlots = self.roundSlots
+      
+      # The messages that couldn't be decrypted have no secret, they are
+      # answered with an empty response as it is
+      if len(failed) > 0:
+         print("Spreading server error: couldn't decrypt {} messages".format(
+               len(failed)))
+         roundSlots.store(failed, [ b"" ] * len(failed))
+      
+      # The messages for dead drop servers that don't exist are answered
+      # right away with an empty response
+      if len(unroutable) > 0:
+         print("Spreading server error: {} messages for unknown dead drop servers".format(
+               len(unroutable)))
+         await self.storeResponses(roundSlots, unroutable, 
+                                   [ b"" ] * len(unroutable))
+      elif len(failed) > 0 and roundSlots.isComplete():
+         self.forwardResponses(roundSlots)
+      
+   # In here, we handle the invitations of a dialing round. They are peeled
+   # and shuffled, and each invitation dead drop server gets the ones for
+   # it in a single batch. Invitations have no responses
+   async def handleDialRound(self, batch):
+      results = await self.cryptoEngine.peelRound(batch.getPayloads(), 1)
+      nFailed = results.count(None)
+      if nFailed > 0:
+         print("Spreading server error: couldn't decrypt {} invitations".format(
+               nFailed))
+         results = [ result for result in results if result is not None ]
+      deadDropServers = [ deadDropServer for deadDropServer, _, _ in results ]
+      invitations = [ newPayload for _, _, newPayload in results ]
+      
+      permutation = TU.generatePermutation(len(results))
+      shuffledServers, shuffledInvitations = TU.shuffleColumns(
+            permutation, deadDropServers, invitations)
+      
+      subBatches = [ [] for _ in self.nextLinks ]
+      unroutable = 0
+      for deadDropServer, invitation in zip(shuffledServers, 
+                                            shuffledInvitations):
+         if deadDropServer < len(subBatches):
+            subBatches[ deadDropServer ].append(invitation)
+         else:
+            unroutable += 1
+      if unroutable > 0:
+         print("Spreading server error: {} invitations for unknown dead drop servers".format(
+               unroutable))
+      
+      # Dead drop servers don't wait for the dialing rounds, so the ones 
+      # without invitations get nothing
+      for link, invitations in zip(self.nextLinks, subBatches):
+         if len(invitations) > 0:
+            link.sendBatch(RoundBatch(3, batch.getRoundID(), invitations))
+      
+   # Here we handle the responses coming from a dead drop back towards
+   # the clients. Responses can arrive in any order and in several batches
+   async def handleResponses(self, batch):
+      # The dead drops that got an empty sub-batch answer with an empty one
+      if len(batch.getPayloads()) == 0:
+         return
+      roundSlots = self.roundSlots
+      if roundSlots is None or batch.getRoundID() != roundSlots.roundID:
+         print("Spreading server error: received responses for a different round")
+         return
+      
+      # Each dead drop server answers the sub-batch it got, the responses
+      # are merged back in the slots of their messages
+      await self.storeResponses(roundSlots, batch.getSlots(), 
+                                batch.getPayloads())
+   
+   # Encrypts one layer of the responses for the given slots of the round
+   # and stores them. Slots that were already answered are skipped
+   async def storeResponses(self, roundSlots, slots, payloads):
+      slots, payloads = roundSlots.selectPending(slots, payloads)
+      
+      # Encrypt one layer of each onion message. Each response carries the
+      # slot of the message it answers, which tells the secret to use
+      responses = await self.cryptoEngine.wrapRound(
+            roundSlots.getSecrets(slots), payloads)
          
-         self.nMessages = int(clientMsg.getPayload())
-         self.clientMessages = []
-         self.clientLocalKeys = []
+      # Only the batch that completes the round forwards it
+      if roundSlots.store(slots, responses) and roundSlots.isComplete():
+         self.forwardResponses(roundSlots)
 
-   # Assuming that the messages are stores in self.clientMessages this method
-   # adds noise, shuffles the messages and forwards them to the next server
-   def forwardMessages(self):
+   # This method adds noise, shuffles the messages and forwards each one of
+   # them to its dead drop server. slots, clientSecrets, clientMessages and
+   # deadDropServers are in the order the messages were received. Returns
+   # the slots of the messages for dead drop servers that don't exist and
+   # the slots of the messages that are None, none of them are sent
+   def forwardMessages(self, slots, clientSecrets, clientMessages, 
+                       deadDropServers):
       
       # TODO (jose): Noise addition goes here
       
       # Apply the mixnet by shuffling the messages
-      self.permutation = TU.generatePermutation(self.nMessages)
-      shuffledMessages = TU.shuffleWithPermutation(self.clientMessages,
-                                                   self.permutation)
-      
-      # Also shuffle the messages so they still match the clientMessages:
-      # self.clientLocalKeys[ i ] is the key that unlocks message self.clientMessges[ i ]
-      # This is used afterwards in handleMessage, getNetInfo() == 2
-      self.clientLocalKeys = TU.shuffleWithPermutation(self.clientLocalKeys,
-                                                         self.permutation)
-      
-      # Forward all the messages to the next server
-      # Send a message to the next server notifying of the numbers of 
-      # messages that will be sent
-      firstMsg = Message()
-      firstMsg.setNetInfo(4)
-      firstMsg.setPayload("{}".format(self.nMessages))
-      
-      # TODO send it only to the correct dds and the correct number of messages
-      for ddrop in self.nextServers:
-         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-         sock.connect(ddrop)
-         sock.sendall(str(firstMsg).encode("utf-8"))
-         sock.close()
-      
-      # Send all the messages to the next server
-      # TODO send it only to the correct dds
-      for msg in shuffledMessages:
-         for ddrop in self.nextServers:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect(ddrop)
-            sock.sendall(str(msg).encode("utf-8"))
-            sock.close()
-      
-      # Restart the messages so that we receive the responses from the 
-      # next server
-      self.clientMessages = []
-      
-   def forwardResponses(self):
-      # Unshuffle the messages
-      self.clientMessages = TU.unshuffleWithPermutation(self.clientMessages, 
-                                                 self.permutation)
-      
-      # Send the responses back to the previous server
-      for msg in self.clientMessages:
-         tempSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-         tempSock.connect((self.previousServerIP, self.previousServerPort))
-         tempSock.sendall(str(msg).encode("utf-8"))
-         tempSock.close()
-      
\ No newline at end of file
+      permutation = TU.generatePermutation(len(clientMessages))
+      shuffledMessages, shuffledServers = TU.shuffleColumns(
+            permutation, clientMessages, deadDropServers)
+      
+      # Preallocate the slots for the responses of the round. The slot of
+      # each message is its position in the shuffled round
+      self.roundSlots = RoundSlots(self.roundID, clientSecrets, slots, 
+                                   permutation)
+      
+      # Split the shuffled round in one sub-batch per dead drop server, 
+      # each message keeps its slot so the responses can be merged back
+      subBatches = [ ([], []) for _ in self.nextLinks ]
+      unroutable = []
+      failed = []
+      for slot, (deadDropServer, message) in enumerate(zip(shuffledServers,
+                                                           shuffledMessages)):
+         if message is None:
+            failed.append(slot)
+         elif deadDropServer < len(subBatches):
+            payloads, subSlots = subBatches[ deadDropServer ]
+            payloads.append(message)
+            subSlots.append(slot)
+         else:
+            unroutable.append(slot)
+      
+      # Send every sub-batch only to its dead drop server. They are all 
+      # written at once, so the dead drops get them in parallel. The ones
+      # without messages still get an empty sub-batch, so that every dead
+      # drop knows the round has nothing else for it
+      for link, (payloads, subSlots) in zip(self.nextLinks, subBatches):
+         link.sendBatch(RoundBatch(1, self.roundID, payloads, subSlots))
+      return unroutable, failed
+      
+   def forwardResponses(self, roundSlots):
+      # The responses are already unshuffled, they were written in the slots
+      # of the messages they answer. Send them back to the previous server
+      # in a single batch
+      self.previousLink.sendBatch(RoundBatch(2, roundSlots.roundID, 
+                                             roundSlots.responses,
+                                             roundSlots.getSlots()))
+      
+      # A newer round may have started while the responses were wrapped
+      if self.roundSlots is roundSlots:
+         self.roundSlots = None
@@ -1,14 +1,17 @@
 #!/usr/bin/env python3
 
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.asymmetric import dh
+from cryptography.hazmat.primitives.asymmetric import dh, x25519
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives import padding
 from cryptography.hazmat.primitives import serialization
 
-from random import randrange, shuffle
+import struct
+import hashlib
+import Permutation
+
+from random import randrange
 
 from string import ascii_letters
 from random import choice
@@ -17,12 +20,37 @@ def createRandomMessage(messageSize):
    chars = ascii_letters + ".,:;-+*/?!()[]{}"
    return ''.join(choice(chars) for i in range(messageSize))
 
-def createKeyGenerator():
-   p = 0xFFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F14374FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7EDEE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF0598DA48361C55D39A69163FA8FD24CF5F83655D23DCA3AD961C62F356208552BB9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3BE39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF6955817183995497CEA956AE515D2261898FA051015728E5A8AACAA68FFFFFFFFFFFFFFFF
-   g = 2
-   params_numbers = dh.DHParameterNumbers(p,g)
-   parameters = params_numbers.parameters(default_backend())
-   return parameters
+# Key agreement modes. The classic mode uses 2048-bit finite field 
+# Diffie-Hellman (the MODP group below), the x25519 mode uses elliptic curve
+# Diffie-Hellman over Curve25519, which is much faster for the ephemeral keys 
+# created for every onion layer. All the servers and clients of a network
+# must use the same mode
+classicMode = "classic"
+x25519Mode = "x25519"
+keyModes = (classicMode, x25519Mode)
+
+# The 2048-bit MODP group used by the classic mode
+modpParameters = dh.DHParameterNumbers(
+   0xFFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F14374FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7EDEE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF0598DA48361C55D39A69163FA8FD24CF5F83655D23DCA3AD961C62F356208552BB9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3BE39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF6955817183995497CEA956AE515D2261898FA051015728E5A8AACAA68FFFFFFFFFFFFFFFF, 2)
+
+# Size in bytes of the raw encoding of the public keys of each mode. See
+# encodePublicKey
+publicKeySizes = { classicMode : 256, x25519Mode : 32 }
+
+# X25519 has no parameters, this gives it the same interface as the DH 
+# parameters so generateKeys works with both modes
+class X25519KeyGenerator:
+   def generate_private_key(self):
+      return x25519.X25519PrivateKey.generate()
+
+def createKeyGenerator(mode=classicMode):
+   if mode == x25519Mode:
+      return X25519KeyGenerator()
+   elif mode != classicMode:
+      raise ValueError("Unknown key mode {}, must be one of {}".format(
+            mode, keyModes))
+   
+   return modpParameters.parameters(default_backend())
 
 def createCipher(sharedSecret):
    # iv initialization vector is a 16 block of random bytes generated 
@@ -51,48 +79,102 @@ def computeSharedSecret(myPrivateKey, otherPublicKey):
    return sharedSecret
 
 # Encrypt the message using symmetric encryption.
-# sharedSecret is the shared secret and msg is a string containing the 
-# message to encrypt. Returns a stream of bytes
+# sharedSecret is the shared secret and msg is a bytes-like object (or a
+# string, which is encoded as utf-8) containing the message to encrypt.
+# Returns a stream of bytes. The message is padded with PKCS7 and
+# encrypted straight into the output buffer, without joining the padding
+# to a copy of the message
 def encryptMessage(shared_secret, msg):
-   padder = padding.PKCS7(128).padder()
-   padded_data = padder.update(msg.encode()) + padder.finalize()
+   if isinstance(msg, str):
+      msg = msg.encode()
+   msg = memoryview(msg).cast("B")
+   
+   blockSize = 16
+   nPadding = blockSize - len(msg) % blockSize
+   fullBlocks = len(msg) - (blockSize - nPadding)
+   lastBlock = bytes(msg[fullBlocks:]) + bytes([nPadding]) * nPadding
    
    cipher = createCipher(shared_secret)
    encryptor = cipher.encryptor()
-   e = encryptor.update(padded_data) + encryptor.finalize()
+   e = bytearray(fullBlocks + 2 * blockSize)
+   n = encryptor.update_into(msg[:fullBlocks], e)
+   n += encryptor.update_into(lastBlock, memoryview(e)[n:])
+   encryptor.finalize()
+   del e[n:]
    
-   return e
+   return bytes(e)
 
 # Decrypt the message using symmetric encryption.
-# sharedSecret is the shared secret and msg is an array of bytes containing
-# the encrypted message. Returns a string
+# sharedSecret is the shared secret and msg is a bytes-like object 
+# containing the encrypted message. The message is decrypted in a single
+# pass into a preallocated buffer. Returns a memoryview over that buffer
+# with the padding removed, so the headers can be read from it without
+# making more copies
 def decryptMessage(shared_secret, msg):
+   msg = memoryview(msg).cast("B")
    
    cipher = createCipher(shared_secret)
    decryptor = cipher.decryptor()
-   dt = decryptor.update(msg) + decryptor.finalize()
+   dt = bytearray(len(msg) + 15)
+   n = decryptor.update_into(msg, dt)
+   decryptor.finalize()
    
-   unpadder = padding.PKCS7(128).unpadder()
-   unpadded_data = unpadder.update(dt) + unpadder.finalize()
+   # Remove the PKCS7 padding
+   nPadding = dt[n - 1] if n > 0 else 0
+   if nPadding < 1 or nPadding > 16 or \
+         dt[n - nPadding : n] != bytes([nPadding]) * nPadding:
+      raise ValueError("Invalid padding bytes.")
    
-   return unpadded_data.decode()
+   return memoryview(dt)[:n - nPadding]
+
+# Returns the key mode of a public or private key
+def getKeyMode(key):
+   if isinstance(key, (x25519.X25519PrivateKey, x25519.X25519PublicKey)):
+      return x25519Mode
+   return classicMode
 
-# Given a RSA public key, returns its serialization as a string
-   # This is for testing. We should never send a private key over the network
+# Returns the raw encoding of a public key: a fixed number of bytes, given
+# by publicKeySizes. This is what goes inside the onion headers, the PEM
+# serialization is only used to register the clients
+def encodePublicKey(public_key):
+   if getKeyMode(public_key) == x25519Mode:
+      return public_key.public_bytes(encoding=serialization.Encoding.Raw,
+                                     format=serialization.PublicFormat.Raw)
+   return public_key.public_numbers().y.to_bytes(
+         publicKeySizes[classicMode], "big")
+
+# Reverse encodePublicKey. raw is a bytes-like object, mode is the key mode
+# of the key. Returns a public key object
+def decodePublicKey(raw, mode):
+   if mode == x25519Mode:
+      return x25519.X25519PublicKey.from_public_bytes(bytes(raw))
+   y = int.from_bytes(raw, "big")
+   return dh.DHPublicNumbers(y, modpParameters).public_key(default_backend())
+
+# Returns the fingerprint of a raw encoded public key: a short hash used to
+# identify the owner of the key
+def fingerprintPublicKey(raw):
+   return hashlib.blake2b(raw, digest_size=16).digest()
+
+# Given a public key (of any of the key modes), returns its serialization 
+# as a string
 def serializePublicKey(public_key):
    return public_key.public_bytes(
       encoding=serialization.Encoding.PEM,
       format=serialization.PublicFormat.SubjectPublicKeyInfo
    ).decode()
 
-# Given a string representing a RSA public key, 
-# returns a public key object
-# This is for testing. We should never send a private key over the network
+# Given a string (or a bytes-like object) representing a public key, 
+# returns a public key object. The mode of the key is stored in the 
+# serialization
 def deserializePublicKey(public_key):
-   return serialization.load_pem_public_key(public_key.encode(), 
+   if isinstance(public_key, str):
+      public_key = public_key.encode()
+   return serialization.load_pem_public_key(bytes(public_key), 
                                             backend=default_backend())
    
-# Given a RSA private key, returns its serialization as a string
+# Given a private key, returns its serialization as a string
+# This is for testing. We should never send a private key over the network
 def serializePrivateKey(privateKey):
    return privateKey.private_bytes(
       encoding=serialization.Encoding.PEM,
@@ -100,75 +182,175 @@ def serializePrivateKey(privateKey):
       encryption_algorithm=serialization.NoEncryption()
    ).decode()
 
-# Given a string representing a RSA private key, 
+# Given a string representing a private key, 
 # returns a private key object
 def deserializePrivateKey(privateKey):
    return serialization.load_pem_private_key(privateKey.encode(),
                                              password=None,
                                              backend=default_backend())
    
+# Binary headers used by the onion routing. All the data is bytes and the
+# headers are read at fixed offsets, there are no separators.
+#
+# Every onion layer is: raw_pk + encrypted_data where raw_pk is the public 
+# key the layer was encrypted with, encoded with encodePublicKey. Its size
+# only depends on the key mode of the network.
+# Spreading servers find this in front of their decrypted layer:
+# deadDropServer (2 bytes) + next_layer
+deadDropServerFormat = struct.Struct("!H")
+# Dead drop servers find this in front of their decrypted layer:
+# clientChain (4 bytes) + deadDrop (16 bytes) + payload
+deadDropFormat = struct.Struct("!I16s")
+
+# Returns the bytes of an onion layer: data prefixed by publicKey
+def packOnionLayer(publicKey, data):
+   return encodePublicKey(publicKey) + data
+
+# Reverse packOnionLayer. mode is the key mode of the network. Returns 
+# (raw_pk, data), both of them memoryviews over layer
+def unpackOnionLayer(layer, mode):
+   view = memoryview(layer).cast("B")
+   keySize = publicKeySizes[mode]
+   return view[:keySize], view[keySize:]
+
+# Returns the header a client adds in front of the dead drop layer
+def packDeadDropHeader(clientChain, deadDrop):
+   return deadDropFormat.pack(clientChain, deadDrop.to_bytes(16, "big"))
+
 # Decrypts one layer of the onion routing. This is used by the servers.
-# Takes an private key object (serverPrivateKey) and a string (msgPayload).
+# Takes an private key object (serverPrivateKey) and a bytes-like object
+# (msgPayload) with the form "raw_pk|encrypted_data".
 # serverType is an int. It dictates the form of the msgPayload after 
 # decoding it:
-# 0 -> FrontServers and MiddleServers. decodedMsgPayload = "nest_pk#payload"
-#     In this case, it returns (ppk, payload="nest_pk#payload")
-# 1 -> SpreadingServers. decodedMsgPayload = "DDS#next_pk#payload"
-#     In this case, it returns (ppk, DDS, payload="next_pk#payload")
+# 0 -> FrontServers and MiddleServers. decodedMsgPayload = next_layer
+#     In this case, it returns (secret, payload=next_layer)
+# 1 -> SpreadingServers. decodedMsgPayload = "DDS|next_layer"
+#     In this case, it returns (DDS, secret, payload=next_layer)
 #     Where DDS is the index of the deadropServer where the msg must be sent
-# 2 -> DeadDropServer. decodedMsgPayload = "clientChain#DD#payload"
-#     In this case, it returns (ppk, clientChain, DD, payload)
+# 2 -> DeadDropServer. decodedMsgPayload = "clientChain|DD|payload"
+#     In this case, it returns (secret, clientChain, DD, payload)
 #     Where clientChain is the chain where the response must be sent back
-#     And DD is the deadDrop
-# payload is a string, the rest of returned arguments are intergers or keys
+#     And DD is the deadDrop, its 16 bytes
+# secret is the shared secret of the layer. The servers keep it to encrypt 
+# the response with encryptOnionLayer, so the key exchange is only done once
+# per layer and round trip.
+# payload is a memoryview, the rest of returned arguments are intergers or 
+# bytes
 def decryptOnionLayer(serverPrivateKey, msgPayload, serverType):
-   ppk, payload = msgPayload.split("#", maxsplit=1)
-   ppk = deserializePublicKey(ppk)
-   payload = payload.encode("latin_1")
-   sharedSecret = computeSharedSecret(serverPrivateKey, ppk)
-   decryptedPayload = decryptMessage(sharedSecret, payload)
+   mode = getKeyMode(serverPrivateKey)
+   ppk, payload = unpackOnionLayer(msgPayload, mode)
+   ppk = decodePublicKey(ppk, mode)
+   secret = computeSharedSecret(serverPrivateKey, ppk)
+   decryptedPayload = decryptMessage(secret, payload)
       
    if serverType == 0:
-      return ppk, decryptedPayload    
+      return secret, decryptedPayload    
    elif serverType == 1:
-      DDS, next_ppk, payload = decryptedPayload.split("#", maxsplit=2)
-      decryptedPayload = "{}#{}".format(next_ppk, payload)         
-      return int(DDS), ppk, decryptedPayload
+      DDS, = deadDropServerFormat.unpack_from(decryptedPayload)
+      return DDS, secret, decryptedPayload[deadDropServerFormat.size:]
    elif serverType == 2:
-      clientChain, DD, payload = decryptedPayload.split("#", maxsplit=2)
-      return ppk, int(clientChain), int(DD), payload
+      clientChain, DD = deadDropFormat.unpack_from(decryptedPayload)
+      return secret, clientChain, DD, decryptedPayload[deadDropFormat.size:]
    else:
       print("ERROR decryptOnionLayer: serverType must be in {0,1,2}")
 
-# Encrypts a single onion layer. Returns a string.
-def encryptOnionLayer(serverPrivateKey, clientPublicKey, msgPayload):
-   sharedSecret = computeSharedSecret(serverPrivateKey, clientPublicKey)
-   encryptedPayload = encryptMessage(sharedSecret, msgPayload)
-   return encryptedPayload.decode("latin_1")
+# Encrypts a single onion layer of a response. sharedSecret is the secret 
+# returned by decryptOnionLayer for the message. Returns bytes.
+def encryptOnionLayer(sharedSecret, msgPayload):
+   return encryptMessage(sharedSecret, msgPayload)
 
-# Apply onion routing. On each layer the message looks like this:
-# "serialized_pk#encrypted_data"
+# Apply onion routing. data is a bytes-like object. On each layer the 
+# message looks like this: "raw_pk|encrypted_data"
+# Returns the bytes of the message and the shared secrets of each layer, 
+# in the same order as chainServersPublicKeys. The secrets are needed to
+# decrypt the response
 def applyOnionRouting(localKeys, chainServersPublicKeys, data):
-      localKeys.reverse()
-      chainServersPublicKeys.reverse()
-      for local_keys, server_pk in zip (localKeys, chainServersPublicKeys):
+      sharedSecrets = []
+      for local_keys, server_pk in zip(reversed(localKeys), 
+                                       reversed(chainServersPublicKeys)):
          local_sk, local_pk = local_keys
          sharedSecret = computeSharedSecret(local_sk, server_pk)
-         data = encryptMessage(sharedSecret, data)
-         serialized_local_pk = serializePublicKey(local_pk)
-         data = "{}#{}".format(serialized_local_pk, data.decode("latin_1"))
+         data = packOnionLayer(local_pk, encryptMessage(sharedSecret, data))
+         sharedSecrets.append(sharedSecret)
          
-      chainServersPublicKeys.reverse()
-      return data
-
-# Warning: This is not the most secure way to create a random permutation.
-# For real deployment, a different way to generate this permutation should
-# be implemented. This is beyond the scope of this project. Mpre information:
-# https://docs.python.org/3/library/random.html
-def generatePermutation(n):
-   l = list(range(n))
-   shuffle(l)
-   return (l)
+      sharedSecrets.reverse()
+      return data, sharedSecrets
+
+# Returns the tag of the registration of a client listening on address 
+# (<IP>, <Port>), sharedSecret is the one of the client key and the Front
+# Server key. Only the owner of the key can compute it, so nobody can 
+# register someone else's key to get their messages
+def registrationTag(sharedSecret, address):
+   return hashlib.blake2b("{}|{}".format(*address).encode(), 
+                          key=sharedSecret, digest_size=32).digest()
+
+# Invitations of the dialing protocol. Every dialing round the invitations
+# are stored in nInvitationBuckets buckets, the bucket of an invitation
+# depends only on the public key of its recipient. Clients download only
+# their own bucket.
+nInvitationBuckets = 256
+
+# Every invitation starts with a tag that only the dialer and the recipient
+# can compute, see invitationTag. The dead drops publish a Bloom filter of
+# the tags of each bucket, so clients can fetch only the invitations from 
+# their contacts
+invitationTagSize = 16
+
+# Requests for invitations start with the bucket, see the netinfo 6 of 
+# Message. The tags requested follow it
+invitationRequestFormat = struct.Struct("!I")
+
+# Returns the invitation bucket of the client with raw encoded public key 
+# raw (see encodePublicKey)
+def invitationBucket(raw):
+   return int.from_bytes(fingerprintPublicKey(raw)[:8], "big") % \
+          nInvitationBuckets
+
+# Returns the tag of the invitations sent in dialRound between two clients
+# whose long term keys have the shared secret sharedSecret
+def invitationTag(sharedSecret, dialRound):
+   return hashlib.blake2b(dialRound.to_bytes(4, "big"), key=sharedSecret,
+                          digest_size=invitationTagSize).digest()
+
+# Returns the bytes of an invitation from the client with public key 
+# senderPublicKey to the one with recipientPublicKey. ephemeralKeys is a 
+# key pair (sk, pk) only used for this invitation and tag its tag. The 
+# invitation is:
+#   tag + raw_pk + encrypted(fingerprint of the recipient + raw sender key)
+# so only the recipient can read it and know it is for them
+def packInvitation(ephemeralKeys, senderPublicKey, recipientPublicKey, tag):
+   local_sk, local_pk = ephemeralKeys
+   sharedSecret = computeSharedSecret(local_sk, recipientPublicKey)
+   data = fingerprintPublicKey(encodePublicKey(recipientPublicKey)) + \
+          encodePublicKey(senderPublicKey)
+   return tag + packOnionLayer(local_pk, encryptMessage(sharedSecret, data))
+
+# Reverse packInvitation. Returns the public key of the sender, or None if
+# the invitation is not for the owner of privateKey
+def unpackInvitation(privateKey, invitation):
+   mode = getKeyMode(privateKey)
+   publicKey = encodePublicKey(privateKey.public_key())
+   fingerprint = fingerprintPublicKey(publicKey)
+   try:
+      ppk, data = unpackOnionLayer(memoryview(invitation)[invitationTagSize:],
+                                   mode)
+      sharedSecret = computeSharedSecret(privateKey, 
+                                         decodePublicKey(ppk, mode))
+      data = decryptMessage(sharedSecret, data)
+   except ValueError:
+      return None
+   
+   if bytes(data[:len(fingerprint)]) != fingerprint or \
+         len(data) != len(fingerprint) + publicKeySizes[mode]:
+      return None
+   return decodePublicKey(data[len(fingerprint):], mode)
+
+# The permutations are generated and applied by the vectorized engine in
+# Permutation. generatePermutation returns an array of uint32 indices
+generatePermutation = Permutation.generatePermutation
+invertPermutation = Permutation.invertPermutation
+shuffleColumns = Permutation.shuffleColumns
+unshuffleColumns = Permutation.unshuffleColumns
    
 # Shuffles the elements in the array toShuffle following the given permutation
 def shuffleWithPermutation(toShuffle, permutation):
@@ -177,11 +359,7 @@ def shuffleWithPermutation(toShuffle, permutation):
             "the number of elements to shuffle must be the same")
       return (-1)
    
-   shuffled = [ 0 for _ in range(len(permutation)) ]
-   for i, msg in zip(permutation, toShuffle):
-      shuffled[i] = msg
-      
-   return shuffled
+   return shuffleColumns(permutation, toShuffle)[0]
 
 # Unshuffles the messages following the given permutation
 def unshuffleWithPermutation(toShuffle, permutation):
@@ -190,11 +368,7 @@ def unshuffleWithPermutation(toShuffle, permutation):
             "the number of messages must be the same")
       return (-1)
    
-   unshuffled = []
-   for i in permutation:
-      unshuffled.append( toShuffle[i] )
-      
-   return unshuffled
+   return unshuffleColumns(permutation, toShuffle)[0]
       
 def testShuffling():
    error = False
@@ -202,7 +376,7 @@ def testShuffling():
       size = randrange(10**3, 10**5)
       
       # For testing we just shuffle numbers instead of messages
-      messages = generatePermutation(size)
+      messages = list(range(size))
       
       perm = generatePermutation(size)
       shuffledMessages = shuffleWithPermutation(messages, perm)
@@ -214,9 +388,9 @@ def testShuffling():
    if not error:
       print("SUCESS")
 
-def testEncryption():
+def testEncryption(mode=classicMode):
    
-   keyGenerator = createKeyGenerator()
+   keyGenerator = createKeyGenerator(mode)
    
    error = False
    
@@ -234,7 +408,7 @@ def testEncryption():
       
       # Bob decrypts the message using his private key and Alice's public key
       b_shared_secret = computeSharedSecret(b_private_key, a_public_key)
-      answer = decryptMessage(b_shared_secret, e)
+      answer = str(decryptMessage(b_shared_secret, e), "utf-8")
       
       error = error or a_shared_secret != b_shared_secret or answer != msg
       if a_shared_secret != b_shared_secret:
@@ -247,15 +421,15 @@ def testEncryption():
    if not error:
       print("SUCESS")
       
-def testKeySerialization():
+def testKeySerialization(mode=classicMode):
    error = False
    
    for _ in range(10000):
       size = randrange(10, 256)
       msg = createRandomMessage(size)
       
-      a_private_key, a_public_key = generateKeys(createKeyGenerator())
-      b_private_key, b_public_key = generateKeys(createKeyGenerator())
+      a_private_key, a_public_key = generateKeys(createKeyGenerator(mode))
+      b_private_key, b_public_key = generateKeys(createKeyGenerator(mode))
       
       # Alice encrypts the message using her private key and Bob's public key
       a_shared_secret = computeSharedSecret(a_private_key, b_public_key)
@@ -265,9 +439,12 @@ def testKeySerialization():
       a_public_key_serialized = serializePublicKey(a_public_key)
       a_public_key = deserializePublicKey(a_public_key_serialized)
       
+      # And the same with the raw encoding used in the onion headers
+      a_public_key = decodePublicKey(encodePublicKey(a_public_key), mode)
+      
       # Decrypt the message using the key after serialization
       b_shared_secret = computeSharedSecret(b_private_key, a_public_key)
-      answer = decryptMessage(b_shared_secret, e)
+      answer = str(decryptMessage(b_shared_secret, e), "utf-8")
       
       if msg != answer:
          print("FAILURE: on serialization. Size: {}, Message: #{}#, Answer: #{}#".format(size, msg, answer))
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+# Benchmarks of the cryptography used by Torzela. Everything runs offline in
+# a single process, no sockets are opened, so the numbers show only the cost
+# of the onion routing.
+#
+# Usage: python3 benchmark.py [nMessages]
+
+import os
+import sys
+import time
+import TorzelaUtils as TU
+import ServerCore
+from CryptoEngine import CryptoEngine
+import DeadDropMatcher
+from DeadDrop import DeadDrop
+from BloomFilter import createBloomFilter
+import numpy as np
+
+# Number of servers in the chain (Front, Middle and Spreading Server). The
+# Dead Drop adds one more layer
+nChainServers = 3
+
+# Number of dead drop accesses of the rounds used to benchmark the matching
+matchingSizes = [ 10**4, 10**5, 10**6 ]
+
+# Number of invitations in a bucket used to benchmark the Bloom filters, 
+# their false positive rate and the number of tags checked to measure it
+bucketLoads = [ 1, 2, 3, 5, 10, 100, 1000, 10**4, 10**5 ]
+filterFalsePositiveRate = 0.01
+filterQueries = 10**5
+filterSamples = 1000
+
+# Number of messages of the rounds used to benchmark the permutations
+permutationSizes = [ 10**3, 10**4, 10**5, 10**6, 10**7 ]
+
+# Creates the keys of the servers of a network. Returns the chain servers
+# keys and the dead drop server keys, as lists of (sk, pk)
+def createNetwork(keyGenerator):
+   chainServers = [ TU.generateKeys(keyGenerator)
+                    for _ in range(nChainServers) ]
+   deadDropServer = TU.generateKeys(keyGenerator)
+   return chainServers, deadDropServer
+
+# Builds the onion message of one client the same way Client.preparePayload
+# does. Returns the onion and the temporary keys used to build it
+def buildOnion(keyGenerator, chainServers, deadDropServer, clientChain,
+               deadDrop, data):
+   temporaryKeys = [ TU.generateKeys(keyGenerator)
+                     for _ in range(len(chainServers) + 1) ]
+
+   data = TU.packDeadDropHeader(clientChain, deadDrop) + data
+   local_sk, local_pk = temporaryKeys[-1]
+   sharedSecret = TU.computeSharedSecret(local_sk, deadDropServer[1])
+   data = TU.deadDropServerFormat.pack(0) + \
+          TU.packOnionLayer(local_pk, TU.encryptMessage(sharedSecret, data))
+
+   data, _ = TU.applyOnionRouting(temporaryKeys[:-1],
+                                  [ pk for _, pk in chainServers ], data)
+   return data, temporaryKeys
+
+# Measures the cost of a single onion layer in the given mode: creating the
+# ephemeral key, wrapping the layer in the client, peeling it in a server
+# and encrypting the response on the way back. Returns a dict with the
+# average time in milliseconds of each operation
+def benchmarkLayer(mode, iterations=200):
+   keyGenerator = TU.createKeyGenerator(mode)
+   server_sk, server_pk = TU.generateKeys(keyGenerator)
+   data = TU.createRandomMessage(256).encode()
+
+   results = {}
+
+   start = time.perf_counter()
+   keys = [ TU.generateKeys(keyGenerator) for _ in range(iterations) ]
+   results["keygen"] = (time.perf_counter() - start) / iterations
+
+   start = time.perf_counter()
+   layers = [ TU.applyOnionRouting([ localKeys ], [ server_pk ], data)[0]
+              for localKeys in keys ]
+   results["wrap"] = (time.perf_counter() - start) / iterations
+
+   start = time.perf_counter()
+   peeled = [ TU.decryptOnionLayer(server_sk, layer, 0) for layer in layers ]
+   results["peel"] = (time.perf_counter() - start) / iterations
+
+   start = time.perf_counter()
+   for secret, payload in peeled:
+      TU.encryptOnionLayer(secret, payload)
+   results["respond"] = (time.perf_counter() - start) / iterations
+
+   return { name : value * 1000 for name, value in results.items() }
+
+# Runs a whole round of nMessages through the servers in the given mode:
+# every chain server and the dead drop peel their layer of all the messages,
+# then the responses are encrypted on the way back. Returns the time the
+# clients took to build the onions and the time the servers took to run the
+# round, in seconds
+def benchmarkRound(mode, nMessages):
+   keyGenerator = TU.createKeyGenerator(mode)
+   chainServers, deadDropServer = createNetwork(keyGenerator)
+   data = TU.createRandomMessage(256).encode()
+
+   start = time.perf_counter()
+   messages = [ buildOnion(keyGenerator, chainServers, deadDropServer, 0,
+                           i // 2, data)[0]
+                for i in range(nMessages) ]
+   clientTime = time.perf_counter() - start
+
+   start = time.perf_counter()
+   roundSecrets = []
+   for i, (server_sk, _) in enumerate(chainServers):
+      if i < len(chainServers) - 1:
+         results = [ TU.decryptOnionLayer(server_sk, msg, 0)
+                     for msg in messages ]
+         roundSecrets.append([ secret for secret, _ in results ])
+         messages = [ payload for _, payload in results ]
+      else:
+         results = [ TU.decryptOnionLayer(server_sk, msg, 1)
+                     for msg in messages ]
+         roundSecrets.append([ secret for _, secret, _ in results ])
+         messages = [ payload for _, _, payload in results ]
+
+   results = [ TU.decryptOnionLayer(deadDropServer[0], msg, 2)
+               for msg in messages ]
+   messages = [ TU.encryptOnionLayer(result[0], result[3])
+                for result in results ]
+
+   for secrets in reversed(roundSecrets):
+      messages = [ TU.encryptOnionLayer(secret, msg)
+                   for secret, msg in zip(secrets, messages) ]
+   serverTime = time.perf_counter() - start
+
+   return clientTime, serverTime
+
+# Peels and wraps a whole round of nMessages with a CryptoEngine of nWorkers
+# processes, like a Middle Server does. Returns the time it took in seconds
+def benchmarkEngine(mode, nMessages, nWorkers):
+   keyGenerator = TU.createKeyGenerator(mode)
+   server_sk, server_pk = TU.generateKeys(keyGenerator)
+   data = TU.createRandomMessage(256).encode()
+   messages = [ TU.applyOnionRouting([ TU.generateKeys(keyGenerator) ],
+                                     [ server_pk ], data)[0]
+                for _ in range(nMessages) ]
+
+   engine = CryptoEngine(server_sk, nWorkers)
+
+   async def runRound():
+      results = await engine.peelRound(messages, 0)
+      await engine.wrapRound([ secret for secret, _ in results ],
+                             [ payload for _, payload in results ])
+
+   # The first round also starts the worker processes, don't measure it
+   ServerCore.runInLoop(runRound()).result()
+   start = time.perf_counter()
+   ServerCore.runInLoop(runRound()).result()
+   elapsed = time.perf_counter() - start
+
+   engine.shutdown()
+   return elapsed
+
+# Matches a round of nAccesses dead drop accesses, where every dead drop is
+# accessed by two clients, and exchanges the messages. Returns the time it
+# took in seconds matching the whole round at once, the time spent adding 
+# the accesses to a DeadDropIndex while they arrive, in chunks of 
+# DeadDrop.chunkSize, and the time left to close the round with the index
+def benchmarkMatching(nAccesses):
+   deadDropIDs = [ os.urandom(DeadDropMatcher.deadDropSize) 
+                   for _ in range(nAccesses // 2) ] * 2
+   messages = list(range(len(deadDropIDs)))
+
+   start = time.perf_counter()
+   partners = DeadDropMatcher.matchDeadDrops(deadDropIDs)
+   DeadDropMatcher.exchangeMessages(messages, partners)
+   batchTime = time.perf_counter() - start
+
+   start = time.perf_counter()
+   index = DeadDropMatcher.DeadDropIndex()
+   for first in range(0, len(deadDropIDs), DeadDrop.chunkSize):
+      index.addChunk(deadDropIDs[first : first + DeadDrop.chunkSize])
+   indexTime = time.perf_counter() - start
+
+   start = time.perf_counter()
+   DeadDropMatcher.exchangeMessages(messages, index.getPartners())
+   closeTime = time.perf_counter() - start
+   return batchTime, indexTime, closeTime
+
+# Builds the Bloom filter of the tags of a bucket with nInvitations 
+# invitations and checks filterQueries tags that are not in the bucket.
+# The rate of a single small filter depends a lot on which bits its few 
+# keys set, so the queries are spread over filterSamples / nInvitations
+# filters (at least one).
+# Returns the size of the filter in bytes, the false positive rate measured
+# and the size in bytes of downloading the whole bucket instead
+def benchmarkBloomFilter(mode, nInvitations):
+   keyGenerator = TU.createKeyGenerator(mode)
+   sender_sk, sender_pk = TU.generateKeys(keyGenerator)
+   invitation = TU.packInvitation(TU.generateKeys(keyGenerator), sender_pk,
+                                  sender_pk, 
+                                  os.urandom(TU.invitationTagSize))
+
+   nSamples = max(1, filterSamples // nInvitations)
+   falsePositives = 0
+   for _ in range(nSamples):
+      tags = [ os.urandom(TU.invitationTagSize) 
+               for _ in range(nInvitations) ]
+      bloomFilter = createBloomFilter(tags, filterFalsePositiveRate)
+      falsePositives += sum(os.urandom(TU.invitationTagSize) in bloomFilter
+                            for _ in range(filterQueries // nSamples))
+   return len(bloomFilter), falsePositives / filterQueries, \
+          nInvitations * len(invitation)
+
+# Shuffles a round of nMessages messages the way the Spreading Server does:
+# the messages (a list) and the dead drop server of each one (an array) with
+# the same permutation, and then unshuffles them. Returns the time it took
+# in seconds generating the permutation, shuffling and unshuffling
+def benchmarkPermutation(nMessages):
+   messages = [ b"" ] * nMessages
+   deadDropServers = np.zeros(nMessages, dtype=np.uint32)
+
+   start = time.perf_counter()
+   permutation = TU.generatePermutation(nMessages)
+   generateTime = time.perf_counter() - start
+
+   start = time.perf_counter()
+   shuffledMessages, shuffledServers = TU.shuffleColumns(
+         permutation, messages, deadDropServers)
+   shuffleTime = time.perf_counter() - start
+
+   start = time.perf_counter()
+   TU.unshuffleColumns(permutation, shuffledMessages, shuffledServers)
+   unshuffleTime = time.perf_counter() - start
+   return generateTime, shuffleTime, unshuffleTime
+
+def runBenchmarks(nMessages=200):
+   print("Per layer cost (ms)")
+   print("{:>10} {:>10} {:>10} {:>10} {:>10}".format(
+         "mode", "keygen", "wrap", "peel", "respond"))
+   for mode in TU.keyModes:
+      results = benchmarkLayer(mode)
+      print("{:>10} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+            mode, results["keygen"], results["wrap"], results["peel"],
+            results["respond"]))
+
+   print()
+   print("Round of {} messages through {} servers and a dead drop".format(
+         nMessages, nChainServers))
+   print("{:>10} {:>14} {:>14} {:>14}".format(
+         "mode", "clients (s)", "servers (s)", "msgs/s"))
+   for mode in TU.keyModes:
+      clientTime, serverTime = benchmarkRound(mode, nMessages)
+      print("{:>10} {:>14.3f} {:>14.3f} {:>14.1f}".format(
+            mode, clientTime, serverTime, nMessages / serverTime))
+
+   print()
+   print("One server peeling and wrapping a round of {} messages".format(
+         nMessages))
+   print("{:>10} {:>10} {:>14} {:>14}".format(
+         "mode", "workers", "time (s)", "msgs/s"))
+   workerCounts = sorted({ 0, 1, 2, 4, os.cpu_count() })
+   for mode in TU.keyModes:
+      for nWorkers in workerCounts:
+         elapsed = benchmarkEngine(mode, nMessages, nWorkers)
+         print("{:>10} {:>10} {:>14.3f} {:>14.1f}".format(
+               mode, nWorkers, elapsed, nMessages / elapsed))
+
+   print()
+   print("Dead drop matching")
+   print("{:>10} {:>14} {:>14} {:>14}".format(
+         "accesses", "batch (s)", "index (s)", "close (s)"))
+   for nAccesses in matchingSizes:
+      batchTime, indexTime, closeTime = benchmarkMatching(nAccesses)
+      print("{:>10} {:>14.3f} {:>14.3f} {:>14.3f}".format(
+            nAccesses, batchTime, indexTime, closeTime))
+
+   print()
+   print("Permutation of a round, two columns")
+   print("{:>10} {:>14} {:>14} {:>14} {:>14}".format(
+         "messages", "generate (s)", "shuffle (s)", "unshuffle (s)", 
+         "msgs/s"))
+   for nPermuted in permutationSizes:
+      generateTime, shuffleTime, unshuffleTime = \
+            benchmarkPermutation(nPermuted)
+      print("{:>10} {:>14.3f} {:>14.3f} {:>14.3f} {:>14.1f}".format(
+            nPermuted, generateTime, shuffleTime, unshuffleTime,
+            nPermuted / (generateTime + shuffleTime)))
+
+   print()
+   print("Bloom filter of invitation tags, target false positive rate {}".format(
+         filterFalsePositiveRate))
+   print("{:>10} {:>10} {:>14} {:>14} {:>16}".format(
+         "mode", "load", "filter (B)", "fp rate", "whole bucket (B)"))
+   for mode in TU.keyModes:
+      for nInvitations in bucketLoads:
+         filterSize, fpRate, bucketSize = benchmarkBloomFilter(mode, 
+                                                               nInvitations)
+         print("{:>10} {:>10} {:>14} {:>14.4f} {:>16}".format(
+               mode, nInvitations, filterSize, fpRate, bucketSize))
+
+if __name__ == "__main__":
+   runBenchmarks(*[ int(arg) for arg in sys.argv[1:2] ])
@@ -1,69 +1,243 @@
 #!/usr/bin/env python3
 
+import struct
+
 # A message object which is used to
 # communicate between the clients and servers
 # The netinfo field is only used in the networking
-# subsystem 
+# subsystem
 class Message:
-   # A message has three components:
+   # A message has four components:
    #   1) A type (which is an integer) this is us
    #      to distinguish between different types of messages.
    #      (i.e. server round message, encryption message, etc.)
    #
-   #   2) A payload which is a string. This is the actual message
+   #   2) A payload which is an array of bytes. This is the actual message
    #      that is being sent
-   #  
+   #
    #   3) The netinfo field, which is used internally by the
    #      networking subsystem
+   #
+   #   4) The ID of the round the message belongs to
+   #
+   # Messages are sent in binary: a fixed header with the netinfo (1 byte),
+   # the type (1 byte), the round ID (4 bytes) and the length of the
+   # payload (4 bytes), followed by the raw payload.
+
+   # Messages are created by the thousands in every round, so don't give
+   # each one of them a __dict__
+   __slots__ = ("netinfo", "msg_type", "roundID", "payload")
+
+   headerFormat = struct.Struct("!BBII")
+
    def __init__(self):
       # Just initialize these to some default value
-      self.netinfo = "0"
-      self.msg_type = "0"
-      self.payload = ""
+      self.netinfo = 0
+      self.msg_type = 0
+      self.roundID = 0
+      self.payload = b""
    """
    Netinfo field values:
-    Value 0: Messages with this value are used for 
-             configuring the initial channel
+    Value 0: Messages with this value are used for
+             configuring the initial channel. Clients register with
+             "<Port>|<Public key>|<Registration tag in hex>", the tag 
+             proves they own the key (see TU.registrationTag)
     Value 1: Used when the packet is going from the client
              and is headed towards the dead drop
-    Value 2: Used when the packet is going from the 
+    Value 2: Used when the packet is going from the
              dead drop back to the client. The dead drop
              will flip this value from 1 to 2 when sending
              the message back
-    Value 3: Dialing Protocol: Send Invitation
-    Value 4: Used during the conversational protocol between servers
-             to show how many messages will be sent to the next server
-             in this round
+    Value 3: Dialing Protocol: Send Invitation from a client to the Front
+             Server. The round ID is the dialing round
+    Value 4: Round batch. Used between servers to send all the messages of
+             a round at once. The type field holds the direction of the
+             messages in the batch (1 or 2, see above, or 3 for the 
+             invitations of a dialing round) and the payload is built by
+             RoundBatch
     Value 5: Empty message used by the Front Servers to tell the clients
              that a new round just started
-    Value 6: Dialing Protocol: Download invitations from invitation dead drop
+    Value 6: Dialing Protocol: Download invitations from invitation dead drop.
+             The round ID is the dialing round and the payload starts with
+             the bucket (see TU.invitationRequestFormat). The type field 
+             says what the client wants:
+                0 -> all the invitations of its bucket
+                1 -> the Bloom filter of the tags of its bucket
+                2 -> only the invitations with the tags listed after the
+                     bucket in the payload (TU.invitationTagSize bytes each)
+             The dead drop answers on the same connection. For types 0 
+             and 2 it sends a RoundBatch whose type is 6, holding the 
+             invitations. For type 1 it sends a plain message with 
+             netinfo 6 and type 1 whose payload is the Bloom filter (see
+             BloomFilter)
+    Value 7: Empty message used by the Front Servers to tell the clients
+             that a new dialing round just started
    """
    def setNetInfo(self, netinfo):
-      self.netinfo = str(netinfo)
+      self.netinfo = int(netinfo)
 
    def getNetInfo(self):
-      return int(self.netinfo)
+      return self.netinfo
 
    def setType(self, msg_type):
-      self.msg_type = str(msg_type)
-  
+      self.msg_type = int(msg_type)
+
    def getType(self):
-      return int(self.msg_type)
+      return self.msg_type
 
+   def setRoundID(self, roundID):
+      self.roundID = int(roundID)
+
+   def getRoundID(self):
+      return self.roundID
+
+   # The payload can be any bytes-like object. Strings are stored encoded
+   # as latin_1, so every character is stored in a single byte
    def setPayload(self, payload):
+      if isinstance(payload, str):
+         payload = payload.encode("latin_1")
       self.payload = payload
- 
+
+   # Returns the payload as a bytes-like object. After loadFromBuffer it is a
+   # memoryview over the received buffer
    def getPayload(self):
       return self.payload
 
-   # Store the content of the message in a string for transmission
+   # Returns the payload as a string, reversing setPayload
+   def getPayloadString(self):
+      return str(self.payload, "latin_1")
+
+   # Returns the message as a list of buffers (the header and the payload)
+   # to be sent over the network without joining them
+   def toBuffers(self):
+      header = self.headerFormat.pack(self.netinfo, self.msg_type,
+                                      self.roundID,
+                                      memoryview(self.payload).nbytes)
+      return [header, self.payload]
+
+   # Store the content of the message in an array of bytes for transmission
    # over the network
+   def __bytes__(self):
+      return b"".join(self.toBuffers())
+
+   # Reverse the __bytes__ method: Given a bytes-like object, construct the
+   # message. The payload is not copied, it keeps pointing to buffer
+   def loadFromBuffer(self, buffer):
+      view = memoryview(buffer)
+      self.netinfo, self.msg_type, self.roundID, length = \
+            self.headerFormat.unpack_from(view)
+      start = self.headerFormat.size
+      self.payload = view[start : start + length]
+
+   # Readable representation of the message, only used for logging
    def __str__(self):
-      return self.netinfo + "|" + self.msg_type + "|" + self.payload
+      return "{}|{}|{}|{}".format(self.netinfo, self.msg_type, self.roundID,
+                                  self.getPayloadString())
+
+# All the messages of a round travelling between two servers, sent as a
+# single message with netinfo 4. A batch has four components:
+#   1) The direction of the messages (1 towards the dead drops, 2 back to
+#      the clients, 3 invitations of a dialing round and 6 invitations 
+#      downloaded from a dead drop, see the netinfo field above). It is 
+#      stored in the type field of the message
+#
+#   2) The ID of the round the messages belong to
+#
+#   3) The payloads of the messages, already shuffled by the sender.
+#
+#   4) The slot of each payload. Going towards the dead drops, the slot is
+#      the position of the message in the round of the sender. Responses 
+#      carry the slot of the message they answer, so the sender knows where
+#      each response goes even if they arrive in a different order or split
+#      in several batches.
+#
+# The payload of the message is the number of payloads (4 bytes), the length
+# of each one of them (4 bytes each), the slot of each one of them (4 bytes
+# each) and then all the payloads one after another. The batch is sent as a
+# list of buffers, so the whole round goes out in one scatter-gather send 
+# without joining the payloads
+class RoundBatch:
+   countFormat = struct.Struct("!I")
+
+   # If slots is None, the slot of each payload is its position in payloads
+   def __init__(self, netinfo=1, roundID=0, payloads=None, slots=None):
+      self.netinfo = netinfo
+      self.roundID = roundID
+      self.payloads = payloads if payloads is not None else []
+      self.slots = slots if slots is not None else range(len(self.payloads))
+
+   def getNetInfo(self):
+      return self.netinfo
+
+   def getRoundID(self):
+      return self.roundID
+
+   # Returns the payloads of the batch. After loadFromMessage they are
+   # memoryviews over the received message
+   def getPayloads(self):
+      return self.payloads
+
+   # Returns the slots of the payloads, slots[i] is the slot of payloads[i]
+   def getSlots(self):
+      return self.slots
+
+   # Returns the list of buffers to send over the network
+   def toBuffers(self):
+      payloads = [ payload.encode("latin_1") if isinstance(payload, str)
+                   else payload for payload in self.payloads ]
+      lengths = [ memoryview(payload).nbytes for payload in payloads ]
+
+      index = self.countFormat.pack(len(payloads)) + \
+              struct.pack("!{}I".format(len(lengths)), *lengths) + \
+              struct.pack("!{}I".format(len(lengths)), *self.slots)
+      header = Message.headerFormat.pack(4, self.netinfo, self.roundID,
+                                         len(index) + sum(lengths))
+      return [header, index] + payloads
+
+   # Reverse toBuffers: given a message with netinfo 4, load the batch.
+   # The payloads are not copied
+   def loadFromMessage(self, msg):
+      self.netinfo = msg.getType()
+      self.roundID = msg.getRoundID()
+
+      view = memoryview(msg.getPayload())
+      count, = self.countFormat.unpack_from(view)
+      lengths = struct.unpack_from("!{}I".format(count), view,
+                                   self.countFormat.size)
+      self.slots = struct.unpack_from("!{}I".format(count), view,
+                                      self.countFormat.size + 4 * count)
+
+      self.payloads = []
+      start = self.countFormat.size + 8 * count
+      for length in lengths:
+         self.payloads.append(view[start : start + length])
+         start += length
+
+# Checks that a RoundBatch sent as a message is loaded back with the same
+# round, direction, payloads and slots
+def testRoundBatch():
+   import os
+   from random import randrange, sample
+   error = False
+
+   for _ in range(1000):
+      n = randrange(0, 100)
+      payloads = [ os.urandom(randrange(0, 300)) for _ in range(n) ]
+      slots = sample(range(10 * n + 1), n) if randrange(2) else None
+      batch = RoundBatch(randrange(1, 4), randrange(2**32), payloads, slots)
+
+      msg = Message()
+      msg.loadFromBuffer(b"".join(batch.toBuffers()))
+      loaded = RoundBatch()
+      loaded.loadFromMessage(msg)
 
-   # Reverse the __str__ method: Given a string, construct the message 
-   def loadFromString(self, string):
-      # The "2" means we only split on the first two occurrences of "|"
-      # This is to make sure we don't try to split on the data section
-      self.netinfo, self.msg_type, self.payload = str(string).split('|', 2)
+      if msg.getNetInfo() != 4 or \
+            loaded.getNetInfo() != batch.getNetInfo() or \
+            loaded.getRoundID() != batch.getRoundID() or \
+            [ bytes(p) for p in loaded.getPayloads() ] != payloads or \
+            list(loaded.getSlots()) != list(batch.getSlots()):
+         print("FAILURE: batch of {} payloads".format(n))
+         error = True
 
+   if not error:
+      print("SUCESS")
@@ -23,7 +23,8 @@ def testNetwork():
    
    c = Client('localhost', initial_port+1, initial_port, clientId=1)
    c_partner = Client('localhost', initial_port+1, initial_port-1, clientId=2)
-   front = FrontServer('localhost', initial_port+2, initial_port+1)
+   front = FrontServer('localhost', initial_port+2, initial_port+1, 
+                       dialWindow=2, dialGap=4)
    middle = MiddleServer('localhost', initial_port+3, initial_port+2)
    spreading = SpreadingServer([('localhost', initial_port+4)], initial_port+3)
    dead = DeadDrop(initial_port+4)
@@ -68,7 +69,8 @@ def testDialingProtocol():
    initial_port = 7780
    clients = [Client('localhost', initial_port+1, initial_port-1, clientId=1),
               Client('localhost', initial_port+1, initial_port, clientId=2)]
-   front = FrontServer('localhost', initial_port+2, initial_port+1)
+   front = FrontServer('localhost', initial_port+2, initial_port+1, 
+                       dialWindow=2, dialGap=4)
    middle = MiddleServer('localhost', initial_port+3, initial_port+2)
    spreading = SpreadingServer([('localhost', initial_port+4)], initial_port+3)
    dead = DeadDrop(initial_port+4)
@@ -82,17 +84,28 @@ def testDialingProtocol():
    for client in clients:
       client.chainServersPublicKeys = [ppk_frontServer, ppk_middleServer, ppk_spreadingServer]
       client.deadDropServersPublicKeys = [ ppk_deadDropServer ]
-      
-      # potential partners = set of all other available clients to speak to
-      # not the same as partner client, the client w/ whom you are currently speaking with
-      client.potential_partner_pks = [client.publicKey for client in clients]
   
    # Let client 0 dial client 1 (1st arg = partner w/ whom to contact w/)
    clients[0].dial(clients[1].publicKey)
-   # Let client 1 listen to invitations in its designated invitation deaddrop
-   invitation = clients[1].download_invitations(initial_port+4)
    
-   print("RECEIVED INVITATION: " + invitation.getPayload())
+   # The invitation is sent when the next dialing round starts. Give it
+   # some time to go through the chain once the round closes
+   while not clients[0].dialQueue.empty():
+      time.sleep(0.5)
+   dialRound = clients[0].dialRound
+   time.sleep(3)
+   
+   # Let client 1 download the invitations in its designated invitation 
+   # deaddrop
+   dialers = clients[1].download_invitations(initial_port+4, dialRound)
+   
+   print("RECEIVED INVITATIONS: {}".format(len(dialers)))
+   print("FROM CLIENT 1: {}".format(
+         TU.encodePublicKey(clients[0].publicKey) in 
+         [ TU.encodePublicKey(dialer) for dialer in dialers ]))
+   
+   for server in (front, middle, spreading, dead):
+      server.stop().result()
 
 
 if __name__ == "__main__":
@@ -148,8 +161,8 @@ c2 = T.newClient()
 # Up to this point rounds should be happening already in the server, but with empty messages
 
 # Dialing protocol
-c1.dial( c2.getPublicKey() )
-c2.download_invitations() # This should automatically connect c2 to c1
+c1.dial( c2.getPublicKey() ) # Sent in the next dialing round
+c2.download_invitations(T.initial_port+3) # Once the dialing round is over, this should automatically connect c2 to c1
 
 # Conversation protocol
 c1.newMessage("Hello Torzela!")